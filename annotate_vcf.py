@@ -8,8 +8,25 @@ import subprocess
 import shlex
 import argparse
 import re
+import sys
 import os 
+import gzip
+import shutil
+import tempfile
+import time
+import itertools
+import concurrent.futures
 import cyvcf2
+from annotation_cache import AnnotationCache, DEFAULT_MAX_ENTRIES
+import bgzf
+from bgzf import VcfWriter
+from checkpoint import Checkpoint, DEFAULT_INTERVAL
+from previous_annotation import PreviousAnnotation
+from regions import has_index, read_regions, iter_regions
+from jobs import scheduler, configure, DEFAULT_CONCURRENCY
+from annotation_server import AnnotationClient, SERVER_BATCH_SIZE
+from csq import CSQDecoder
+from metrics import metrics, file_size, configure as configure_metrics
 
 # Local GRChX installation and Cache version for assemblies
 cache_version_mapper = dict({
@@ -17,15 +34,37 @@ cache_version_mapper = dict({
     "GRCh38": 93
     })
 
+DEFAULT_DECODER = CSQDecoder.default()
+SHARD_RETRIES = 2 # times a failed VEP shard is rerun before giving up
+
 
 def argument_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input_vcf', required=True, help='Input vcf or vcf.gz file to be annotated with VEP')
     parser.add_argument('-o', '--output_dir', required=False, default=os.getcwd(), help='Output directory')
     parser.add_argument('-g', '--genome_assembly', required=False, default='GRCh37', help='Genome Assembly version to use. Default=GRCh37')
+    parser.add_argument('-c', '--cache', required=False, default=None, help='Persistent annotation cache (sqlite file). Only variants missing from the cache are sent to VEP')
+    parser.add_argument('--cache_size', required=False, default=DEFAULT_MAX_ENTRIES, type=int, help=f'Maximum number of variants kept in the annotation cache, least recently used are evicted. Default={DEFAULT_MAX_ENTRIES}')
+    parser.add_argument('-s', '--shards', required=False, default=1, type=int, help='Split the input into this many chunks of consecutive records and run VEP on them concurrently. Default=1')
+    parser.add_argument('--stream', required=False, action='store_true', help='Read VEP output from its stdout, keep only the canonical annotation and write BGZF directly, without temporary uncompressed vcfs')
+    parser.add_argument('--checkpoint', required=False, default=None, type=int, help='Save a checkpoint every this many records so that an interrupted run can be continued with --resume. Requires --stream')
+    parser.add_argument('--resume', required=False, action='store_true', help='Continue from the last checkpoint of a previous run with --checkpoint, VEP is run only on the remaining records')
+    parser.add_argument('-p', '--previous', required=False, default=None, help='Previously annotated, tabix indexed vcf.gz of the same sample. CSQ of records with the same CHROM, POS, REF and ALT is reused and only the other records are sent to VEP')
+    parser.add_argument('-j', '--jobs', required=False, default=DEFAULT_CONCURRENCY, type=int, help='Maximum number of external tools (VEP) running at once. Default=number of CPUs')
+    parser.add_argument('-@', '--compress_threads', required=False, default=1, type=int, help='Number of threads compressing the output vcf.gz. Default=1')
+    parser.add_argument('-r', '--regions', required=False, default=None, help='Only annotate variants in these regions, a BED file or comma separated chr:start-end. Requires a tabix indexed input')
+    parser.add_argument('--server', required=False, default=None, help='Unix socket of a running annotation_server.py. Variants are annotated by its warm VEP workers instead of starting VEP')
+    parser.add_argument('--metrics', required=False, default=None, help='Write time per stage, external tool runs, records, bytes and peak memory of the run to this JSON file')
+    parser.add_argument('--profile', required=False, action='store_true', help='Sample the hot loops and add their most frequent frames to --metrics')
     args = vars(parser.parse_args())
+    if args['resume'] and not args['checkpoint']:
+        args['checkpoint'] = DEFAULT_INTERVAL
+    if args['server'] and args['checkpoint']:
+        parser.error('--checkpoint and --resume cannot be used with --server')
+    if args['checkpoint'] and (not args['stream'] or args['shards'] > 1):
+        parser.error('--checkpoint and --resume require --stream without --shards')
     
-    return args['input_vcf'], args['output_dir'], args['genome_assembly']
+    return args['input_vcf'], args['output_dir'], args['genome_assembly'], args['cache'], args['cache_size'], args['shards'], args['stream'], args['checkpoint'], args['resume'], args['previous'], args['regions'], args['jobs'], args['compress_threads'], args['server'], args['metrics'], args['profile']
 
 def outputfile(vcffile, output_dir):
     if vcffile.endswith('vcf.gz'):
@@ -38,88 +77,503 @@ def outputfile(vcffile, output_dir):
 
     return outputfile 
 
-def vep_annotate(input_vcf, temp_annotated_vcf, assembly_version, cache_version, display=True):
-    ''' if you want single annotation then use --per_gene option'''
+def setup_vep_environment():
     # DEFINE PERL5LIB PATH for other people's use
     os.environ['PERL5LIB'] = '/home/users/cjyoon/anaconda3/envs/vep/lib/perl5/site_perl/5.22.0/x86_64-linux-thread-multi' 
     os.environ['PATH'] = '/home/usrs/cjyoon/anaconda3/bin:' + os.environ['PATH']
     os.environ['PATH'] = '/home/users/cjyoon/anaconda3/envs/vep/bin:' + os.environ['PATH']
     print(os.environ['PATH'])    
+    activate_environment = os.system('source activate /home/users/cjyoon/anaconda3/envs/vep')
+
+    return 0
+
+def vep_command(input_vcf, temp_annotated_vcf, assembly_version, cache_version):
 # DEFINE VEP CACHE directory to use
 #    dir = '/home/users/cjyoon/vep_dir'
-    dir = '/home/users/cjyoon/.vep'
-    activate_environment = os.system('source activate /home/users/cjyoon/anaconda3/envs/vep')
+    dir = os.environ.get('VEP_DIR', '/home/users/cjyoon/.vep')
 
 #    VEP_PATH = '/home/users/cjyoon/anaconda3/envs/vep/bin/variant_effect_predictor.pl'
     # 2018.11.13 cjyoon
-    VEP_PATH = '/home/users/cjyoon/anaconda3/envs/vep/bin/vep'
+    # VEP_PATH in the environment overrides the installation, e.g. benchmarks/fake_vep.py
+    VEP_PATH = os.environ.get('VEP_PATH', '/home/users/cjyoon/anaconda3/envs/vep/bin/vep')
     CACHE_VER = f' --cache_version {cache_version}'
     ASSEMBLY_VER = assembly_version
     cmd = f'{VEP_PATH} --dir {dir} --sift b --ccds --uniprot --hgvs --symbol --numbers --domains --gene_phenotype --canonical --protein --biotype --uniprot --tsl --pubmed --variant_class --shift_hgvs 1 --check_existing --total_length --allele_number --no_escape --xref_refseq --failed 1 --vcf --flag_pick_allele --pick_order canonical,tsl,biotype,rank,ccds,length  --offline --no_progress --no_stats  --polyphen b  --regulatory --af --af_1kg --af_gnomad --af_esp --max_af -i {input_vcf} -o {temp_annotated_vcf} --force_overwrite --nearest symbol {CACHE_VER} --assembly {ASSEMBLY_VER}'
 
+    return cmd
+
+def vep_annotate(input_vcf, temp_annotated_vcf, assembly_version, cache_version, display=True):
+    ''' if you want single annotation then use --per_gene option
+    returns the exit code of VEP'''
+    setup_vep_environment()
+    cmd = vep_command(input_vcf, temp_annotated_vcf, assembly_version, cache_version)
+
     if display==True:
         print(cmd)
 
-    vep_cmd = subprocess.Popen(shlex.split(cmd))
-    vep_cmd.wait()
-    return 0
+    result = scheduler().run(cmd, check=False)
+    if result.returncode != 0:
+        print(result.stderr)
+    return result.returncode
 
-def find_canonical_annotation(vep_annotation_string):
+def find_canonical_annotation(vep_annotation_string, decoder=DEFAULT_DECODER):
     """VEP annotates with many alternative transcripts as well as canonical transcript
     this function finds the canonical transcript within vep_annotation_string. 
     If there is no canonical transcript, which is usually the case fore intergenic, 
     will just report the first annotation. 
     """
-    annotations = vep_annotation_string.split(',')
-    return_status = 0
-    for annotation in annotations:
-        CANONICAL = annotation.split('|')[26] # CANONICAL
-        if CANONICAL == 'YES':
-            return_status = 1
-            return annotation
-    
-    if return_status == 0:
-        return vep_annotation_string.split(',')[0]
+    return decoder.canonical(vep_annotation_string)
 
 def get_canonical_annotation(temp_annotated_vcf, annotated_vcf):
     """get only the canonical annotation into the CSQ INFO field"""
     vcf_handle = cyvcf2.VCF(temp_annotated_vcf)
-    vcf_writer = cyvcf2.Writer(annotated_vcf, vcf_handle)
+    decoder = CSQDecoder.from_vcf(vcf_handle)
+    print('writing ' + annotated_vcf)
+    with metrics().stage('canonical', profile=True) as stage, open_output(annotated_vcf) as f:
+        f.write(vcf_handle.raw_header)
+        for variant in vcf_handle:
+            canonical_annotation = find_canonical_annotation(variant.INFO['CSQ'], decoder)
+            variant.INFO['CSQ'] = canonical_annotation
+            f.write(str(variant))
+            stage.records += 1
+    vcf_handle.close()
+    stage.bytes_read += file_size(temp_annotated_vcf)
+    stage.bytes_written += file_size(annotated_vcf)
+
+    return 0
+
+def canonical_vcf_line(line, decoder=DEFAULT_DECODER):
+    '''a VEP annotated vcf line with the CSQ INFO field reduced to its canonical annotation'''
+    if line.startswith('#'):
+        return line
+    fields = line.rstrip('\n').split('\t')
+    info = fields[7].split(';')
+    for i, entry in enumerate(info):
+        if entry.startswith('CSQ='):
+            info[i] = 'CSQ=' + find_canonical_annotation(entry[4:], decoder)
+    fields[7] = ';'.join(info)
+
+    return '\t'.join(fields) + '\n'
+
+def stream_vep_annotate(input_vcf, output_handle, assembly_version, cache_version, display=True):
+    '''runs VEP writing to its stdout and writes each record with only the canonical annotation to output_handle as it arrives
+    returns the exit code of VEP'''
+    vep_cmd = vep_process(input_vcf, assembly_version, cache_version, display)
+    for line in canonical_lines(vep_cmd.stdout):
+        output_handle.write(line)
+    vep_cmd.wait()
+    return vep_cmd.returncode
+
+def vep_process(input_vcf, assembly_version, cache_version, display=True):
+    '''starts VEP writing the annotated vcf to its stdout once the job scheduler has a free slot,
+    killed after the timeout of the scheduler. The slot is given back when the process is waited for'''
+    cmd = vep_command(input_vcf, 'STDOUT', assembly_version, cache_version)
+    if display==True:
+        print(cmd)
+
+    return scheduler().popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+
+def canonical_lines(vep_lines):
+    '''lines of VEP output with only the canonical annotation of each record, decoded with the CSQ header of the output.
+    Time spent on the CSQ rewrite, apart from waiting for VEP, is added to the canonical_csq stage'''
+    decoder = DEFAULT_DECODER
+    elapsed, records, size = 0.0, 0, 0
+    try:
+        for line in vep_lines:
+            start = time.perf_counter()
+            if line.startswith('##INFO=<ID=CSQ,'):
+                decoder = CSQDecoder.from_header(line)
+            canonical_line = canonical_vcf_line(line, decoder)
+            elapsed += time.perf_counter() - start
+            records += not line.startswith('#')
+            size += len(line)
+            yield canonical_line
+    finally:
+        metrics().add('canonical_csq', wall=elapsed, records=records, bytes_read=size)
+
+def write_regions(input_vcf, output_vcf, regions):
+    '''writes the header and the records of input_vcf in merged regions to output_vcf, read through the tabix index'''
+    vcf_handle = cyvcf2.VCF(input_vcf)
+    writer = cyvcf2.Writer(output_vcf, vcf_handle)
+    total = 0
+    with metrics().stage('regions') as stage:
+        for variant in iter_regions(vcf_handle, regions):
+            writer.write_record(variant)
+            total += 1
+        writer.close()
+        stage.records += total
+        stage.bytes_written += file_size(output_vcf)
+    vcf_handle.close()
+    print(f'{total} variants in {len(regions)} regions')
+
+    return 0
+
+def skip_records(input_vcf, output_vcf, skip):
+    '''writes the header and all but the first skip records of input_vcf to output_vcf.
+    Lines are copied as they are, so that VEP sees the same text as in an uninterrupted run'''
+    opener = gzip.open if input_vcf.endswith('.gz') else open
+    records = 0
+    with opener(input_vcf, 'rt') as vcf, open(output_vcf, 'w') as f:
+        for line in vcf:
+            if line.startswith('#'):
+                f.write(line)
+            else:
+                records += 1
+                if records > skip:
+                    f.write(line)
+
+def checkpointed_vep_annotate(input_vcf, annotated_vcf, assembly_version, cache_version, interval, resume=False):
+    '''streaming VEP annotation into BGZF, saving a checkpoint every interval records.
+    When resuming, VEP is run only on the records after the last checkpoint and its records are appended to the output
+    returns the exit code of VEP'''
+    checkpoint = Checkpoint(annotated_vcf, input_vcf, interval, {'assembly': assembly_version, 'cache_version': cache_version})
+    try:
+        resumed = resume and checkpoint.load()
+    except ValueError as error:
+        print(error)
+        print('Exiting...')
+        sys.exit(1)
+    if not resumed:
+        checkpoint.remove()
+    remaining_vcf = input_vcf
+    if resumed:
+        print(f'resuming {annotated_vcf} after {checkpoint.records} records')
+        remaining_vcf = annotated_vcf + '.remaining.vcf'
+        skip_records(input_vcf, remaining_vcf, checkpoint.records)
+
+    vep_cmd = vep_process(remaining_vcf, assembly_version, cache_version)
+    with checkpoint.open_output(resumed) as f:
+        for line in canonical_lines(vep_cmd.stdout):
+            if not line.startswith('#'):
+                f.write(line)
+                checkpoint.advance(f)
+            elif not resumed:
+                f.write(line)
+                if line.startswith('#CHROM'):
+                    checkpoint.save(f)
+        vep_cmd.wait()
+    if remaining_vcf != input_vcf:
+        os.remove(remaining_vcf)
+    if vep_cmd.returncode == 0:
+        checkpoint.remove()
+    return vep_cmd.returncode
+
+def open_output(path):
+    '''BGZF writer that also writes the tabix index for a .gz path, plain text file otherwise'''
+    return VcfWriter(path) if path.endswith('.gz') else open(path, 'w')
+
+def split_vcf(input_vcf, shard_dir, shards):
+    '''splits input_vcf into at most `shards` vcfs of consecutive records, so that concatenating them keeps the input order
+    returns the list of shard vcf paths'''
+    total = sum(1 for variant in cyvcf2.VCF(input_vcf))
+    shard_size = max(1, -(-total // max(1, shards)))
+    vcf_handle = cyvcf2.VCF(input_vcf)
+    shard_vcfs = []
+    writer = None
+    for i, variant in enumerate(vcf_handle):
+        if i % shard_size == 0:
+            if writer is not None:
+                writer.close()
+            shard_vcfs.append(os.path.join(shard_dir, f'shard{len(shard_vcfs):04d}.vcf'))
+            writer = cyvcf2.Writer(shard_vcfs[-1], vcf_handle)
+        writer.write_record(variant)
+    if writer is not None:
+        writer.close()
+    vcf_handle.close()
+
+    return shard_vcfs
+
+def annotate_shard(shard_vcf, assembly_version, cache_version, stream=False):
+    '''runs VEP and the canonical rewrite on a single shard, retrying the shard alone when VEP fails
+    returns the canonical annotated shard vcf'''
+    temp_annotated_vcf = shard_vcf + '.vep.vcf'
+    annotated_shard_vcf = shard_vcf + '.canonical.vcf'
+    # VEP runs through the job scheduler, which retries the shard and raises JobError if it keeps failing
+    if not stream:
+        cmd = vep_command(shard_vcf, temp_annotated_vcf, assembly_version, cache_version)
+        print(cmd)
+        scheduler().run(cmd, retries=SHARD_RETRIES)
+        get_canonical_annotation(temp_annotated_vcf, annotated_shard_vcf)
+        os.remove(temp_annotated_vcf)
+        return annotated_shard_vcf
+
+    def write_shard(vep_lines):
+        with open(annotated_shard_vcf, 'w') as f:
+            for line in canonical_lines(vep_lines):
+                f.write(line)
+
+    cmd = vep_command(shard_vcf, 'STDOUT', assembly_version, cache_version)
+    print(cmd)
+    scheduler().stream(cmd, write_shard, retries=SHARD_RETRIES)
+
+    return annotated_shard_vcf
+
+def sharded_vep_annotate(input_vcf, annotated_vcf, assembly_version, cache_version, shards, stream=False):
+    '''splits input_vcf into shards of consecutive records, runs VEP on the shards concurrently
+    and concatenates the canonical annotated shards back in order into annotated_vcf'''
+    shard_dir = tempfile.mkdtemp(prefix=os.path.basename(annotated_vcf) + '.shards.', dir=os.path.dirname(annotated_vcf) or '.')
+    shard_vcfs = split_vcf(input_vcf, shard_dir, shards)
+    print(f'annotating {input_vcf} in {len(shard_vcfs)} shards')
+    setup_vep_environment()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(shard_vcfs))) as executor:
+        annotated_shards = list(executor.map(lambda shard_vcf: annotate_shard(shard_vcf, assembly_version, cache_version, stream), shard_vcfs))
+
     print('writing ' + annotated_vcf)
-    for variant in vcf_handle:
-        canonical_annotation = find_canonical_annotation(variant.INFO['CSQ'])
-        variant.INFO['CSQ'] = canonical_annotation
-        vcf_writer.write_record(variant)
+    with open_output(annotated_vcf) as f:
+        for i, annotated_shard_vcf in enumerate(annotated_shards):
+            with open(annotated_shard_vcf) as shard:
+                for line in shard:
+                    if i == 0 or not line.startswith('#'):
+                        f.write(line)
+    shutil.rmtree(shard_dir)
+
+    return 0
 
-    vcf_writer.close() 
+def server_vep_annotate(input_vcf, annotated_vcf, assembly_version, server):
+    '''annotates input_vcf through a running annotation server and writes the canonical annotation to annotated_vcf.
+    Batches of records are sent concurrently, up to the number of warm workers of the server.
+    Records VEP gave no annotation for are written with their INFO unchanged, without a CSQ of their own'''
+    try:
+        with AnnotationClient(server) as client:
+            status = client.ping()
+    except ConnectionError as error:
+        print(error)
+        print('Exiting...')
+        sys.exit(1)
+    if status['assembly'] != assembly_version:
+        print(f'annotation server at {server} annotates {status["assembly"]}, not {assembly_version}\nExiting...')
+        sys.exit(1)
+
+    def annotate_batch(variants):
+        with AnnotationClient(server) as client:
+            return client.annotate([variant_key(variant) for variant in variants], assembly_version)[1]
+
+    vcf_handle = cyvcf2.VCF(input_vcf)
+    vcf_handle.add_to_header(status['header'])
+    print('writing ' + annotated_vcf)
+    with metrics().stage('server') as stage, open_output(annotated_vcf) as f, concurrent.futures.ThreadPoolExecutor(status['workers']) as executor:
+        f.write(vcf_handle.raw_header)
+        batches = iter(lambda: list(itertools.islice(vcf_handle, SERVER_BATCH_SIZE)), [])
+        while True:
+            window = list(itertools.islice(batches, status['workers']))
+            if not window:
+                break
+            for variants, csqs in zip(window, executor.map(annotate_batch, window)):
+                for variant, csq in zip(variants, csqs):
+                    # '' when VEP did not annotate the record, its INFO is kept as it is
+                    if csq:
+                        variant.INFO['CSQ'] = csq
+                    f.write(str(variant))
+                stage.records += len(variants)
+    vcf_handle.close()
 
     return 0
 
-def bgzip_tabix(annotated_vcf):
-    bgzipcmd=subprocess.Popen(shlex.split(f'bgzip -f {annotated_vcf}'))
-    bgzipcmd.wait()
-    tabixcmd = subprocess.Popen(shlex.split(f'tabix -p vcf {annotated_vcf}.gz'))
-    tabixcmd.wait()
+def run_vep(input_vcf, annotated_vcf, assembly_version, cache_version, shards=1, stream=False, checkpoint=None, resume=False, server=None):
+    '''annotates input_vcf with VEP and writes only the canonical annotation to annotated_vcf
+    in streaming mode VEP output is rewritten as it arrives, with a checkpoint saved every `checkpoint` records when given.
+    A .gz annotated_vcf is written BGZF compressed together with its tabix index.
+    With server, the warm VEP workers of a running annotation server are used instead'''
+    with metrics().stage('vep') as stage:
+        if server:
+            server_vep_annotate(input_vcf, annotated_vcf, assembly_version, server)
+        elif shards > 1:
+            sharded_vep_annotate(input_vcf, annotated_vcf, assembly_version, cache_version, shards, stream)
+        elif stream and checkpoint:
+            setup_vep_environment()
+            print('writing ' + annotated_vcf)
+            returncode = checkpointed_vep_annotate(input_vcf, annotated_vcf, assembly_version, cache_version, checkpoint, resume)
+            if returncode != 0:
+                raise RuntimeError(f'VEP failed on {input_vcf} with exit code {returncode}, continue with --resume')
+        elif stream:
+            setup_vep_environment()
+            print('writing ' + annotated_vcf)
+            with open_output(annotated_vcf) as f:
+                returncode = stream_vep_annotate(input_vcf, f, assembly_version, cache_version)
+            if returncode != 0:
+                raise RuntimeError(f'VEP failed on {input_vcf} with exit code {returncode}')
+        else:
+            temp_annotated_vcf = annotated_vcf + '.temp.vcf'
+            # run VEP
+            returncode = vep_annotate(input_vcf, temp_annotated_vcf, assembly_version, cache_version)
+            if returncode != 0:
+                raise RuntimeError(f'VEP failed on {input_vcf} with exit code {returncode}')
+
+            # re-write with only canonical variants
+            get_canonical_annotation(temp_annotated_vcf, annotated_vcf)
+            os.remove(temp_annotated_vcf)
+
+        stage.bytes_read += file_size(input_vcf)
+        stage.bytes_written += file_size(annotated_vcf)
 
     return 0
 
+def variant_key(variant):
+    '''(CHROM, POS, REF, ALT) key of a variant in the annotation cache'''
+    return (variant.CHROM, variant.POS, variant.REF, ','.join(variant.ALT))
+
+def csq_header_line(vcf_handle):
+    '''the ##INFO=<ID=CSQ,...> line of a VEP annotated vcf'''
+    for line in vcf_handle.raw_header.split('\n'):
+        if line.startswith('##INFO=<ID=CSQ,'):
+            return line
+
+def cached_vep_annotate(input_vcf, annotated_vcf, assembly_version, cache_version, cache=None, shards=1, stream=False, checkpoint=None, resume=False, previous=None, server=None):
+    '''annotates input_vcf reusing the annotations of a previously annotated vcf and of the persistent annotation cache.
+    Variants found in neither are written to a separate vcf, annotated with VEP and added to the cache,
+    then reused and newly annotated variants are merged back in the input order'''
+    # split input into reused annotations and misses
+    # with a checkpoint the miss list is kept until VEP completes, because the checkpoint of its annotation refers to it.
+    # On resume it is reused rather than regenerated, and variants that are no longer reused since are annotated separately
+    miss_vcf = annotated_vcf + '.cache_miss.vcf'
+    resumed_misses = set()
+    if checkpoint and resume and os.path.isfile(miss_vcf):
+        resumed_misses = {variant_key(variant) for variant in cyvcf2.VCF(miss_vcf)}
+        print(f'resuming with the {len(resumed_misses)} cache misses of {miss_vcf}')
+    new_miss_vcf = annotated_vcf + '.cache_miss.new.vcf' if resumed_misses else miss_vcf
+    vcf_handle = cyvcf2.VCF(input_vcf)
+    miss_writer = cyvcf2.Writer(new_miss_vcf + '.tmp', vcf_handle)
+    hits = dict()
+    total, misses = 0, 0
+    batch = []
+    with metrics().stage('cache_lookup', profile=True) as stage:
+        for variant in vcf_handle:
+            total += 1
+            if variant_key(variant) in resumed_misses:
+                continue
+            batch.append(variant)
+            if len(batch) == 10000:
+                misses += write_cache_misses(batch, hits, cache, assembly_version, cache_version, miss_writer, previous)
+                batch = []
+        misses += write_cache_misses(batch, hits, cache, assembly_version, cache_version, miss_writer, previous)
+        miss_writer.close()
+        vcf_handle.close()
+        os.replace(new_miss_vcf + '.tmp', new_miss_vcf)
+        stage.records += total
+        stage.bytes_read += file_size(input_vcf)
+    if previous is not None:
+        previous.report()
+    if cache is not None:
+        print(f'annotation cache {cache.path}: {total - misses - len(resumed_misses)} hits, {misses + len(resumed_misses)} misses')
+
+    # annotate only the misses with VEP, only the kept miss list is checkpointed
+    annotated = dict()
+    csq_header = None
+    vep_inputs = [(miss_vcf, checkpoint)] if resumed_misses else []
+    if misses > 0:
+        vep_inputs.append((new_miss_vcf, None if resumed_misses else checkpoint))
+    for vep_input, vep_checkpoint in vep_inputs:
+        annotated_miss_vcf = vep_input + ('.canonical.vcf.gz' if stream else '.canonical.vcf')
+        run_vep(vep_input, annotated_miss_vcf, assembly_version, cache_version, shards, stream, vep_checkpoint, resume, server)
+        annotated_handle = cyvcf2.VCF(annotated_miss_vcf)
+        csq_header = csq_header_line(annotated_handle)
+        if cache is not None:
+            cache.set_csq_header(assembly_version, cache_version, csq_header)
+        new_annotations = {variant_key(variant): variant.INFO['CSQ'] for variant in annotated_handle}
+        annotated_handle.close()
+        annotated.update(new_annotations)
+        if cache is not None:
+            cache.put_many(assembly_version, cache_version, new_annotations)
+        for path in (annotated_miss_vcf, annotated_miss_vcf + '.tbi', annotated_miss_vcf + '.csi'):
+            if os.path.exists(path):
+                os.remove(path)
+    for path in {miss_vcf, new_miss_vcf}:
+        if os.path.exists(path):
+            os.remove(path)
+
+    # all reused and new annotations have to share one CSQ format
+    csq_headers = {csq_header} if csq_header else set()
+    if cache is not None and cache.csq_header(assembly_version, cache_version):
+        csq_headers.add(cache.csq_header(assembly_version, cache_version))
+    if previous is not None and previous.reused > 0:
+        csq_headers.add(previous.header_line('CSQ'))
+    if len(csq_headers) > 1:
+        raise ValueError(f'CSQ format of {previous.path if previous else cache.path} differs from the current VEP output, annotate without it')
+
+    # merge reused and new annotations in input order
+    vcf_handle = cyvcf2.VCF(input_vcf)
+    if csq_headers:
+        vcf_handle.add_to_header(csq_headers.pop())
+    print('writing ' + annotated_vcf)
+    with metrics().stage('merge', profile=True) as stage, open_output(annotated_vcf) as f:
+        f.write(vcf_handle.raw_header)
+        for variant in vcf_handle:
+            key = variant_key(variant)
+            variant.INFO['CSQ'] = hits[key] if key in hits else annotated[key]
+            f.write(str(variant))
+            stage.records += 1
+    vcf_handle.close()
+    stage.bytes_written += file_size(annotated_vcf)
+
+    return 0
+
+def write_cache_misses(variants, hits, cache, assembly_version, cache_version, miss_writer, previous=None):
+    '''looks up a batch of variants in the previous annotation and then in the cache, adds hits and writes misses to miss_writer
+    returns the number of misses'''
+    keys = []
+    for variant in variants:
+        key = variant_key(variant)
+        reused = previous.get(variant) if previous is not None else None
+        if reused is not None:
+            hits[key] = reused[0]
+        else:
+            keys.append(key)
+    if cache is not None:
+        hits.update(cache.get_many(assembly_version, cache_version, [key for key in keys if key not in hits]))
+    misses = 0
+    for variant in variants:
+        if variant_key(variant) not in hits:
+            miss_writer.write_record(variant)
+            misses += 1
+
+    return misses
+
 def main():
-    input_vcf, output_dir, genome_assembly = argument_parser()
+    input_vcf, output_dir, genome_assembly, cache_path, cache_size, shards, stream, checkpoint, resume, previous_vcf, regions, jobs, compress_threads, server, metrics_path, profile = argument_parser()
+    configure_metrics(metrics_path, profile)
+    configure(jobs)
+    bgzf.configure(compress_threads)
     
     cache_version = cache_version_mapper[genome_assembly]
 
-    # prepare annotated output file path 
-    annotated_vcf = outputfile(input_vcf, output_dir)
-    temp_annotated_vcf = annotated_vcf + '.temp.vcf'
+    # prepare annotated output file path, written as vcf.gz with its tabix index
+    annotated_vcf = outputfile(input_vcf, output_dir) + '.gz'
 
-    # run VEP
-    vep_annotate(input_vcf, temp_annotated_vcf, genome_assembly, cache_version)
+    if regions:
+        # only records in the target regions are annotated
+        if not has_index(input_vcf):
+            print(f'{input_vcf} needs a tabix index to use --regions\nExiting...')
+            sys.exit(1)
+        regions_vcf = annotated_vcf + '.regions.vcf'
+        write_regions(input_vcf, regions_vcf, read_regions(regions))
+        input_vcf = regions_vcf
 
-    # re-write with only canonical variants
-    get_canonical_annotation(temp_annotated_vcf, annotated_vcf)
-    
-    # bgzip and tabix output vcf
-    bgzip_tabix(annotated_vcf)
+    if cache_path or previous_vcf:
+        # run VEP only for variants not in the previous annotation or the annotation cache
+        cache = AnnotationCache(cache_path, cache_size) if cache_path else None
+        try:
+            previous = PreviousAnnotation(previous_vcf, ['CSQ']) if previous_vcf else None
+        except ValueError as error:
+            print(error)
+            print('Exiting...')
+            sys.exit(1)
+        cached_vep_annotate(input_vcf, annotated_vcf, genome_assembly, cache_version, cache, shards, stream, checkpoint, resume, previous, server)
+        if cache is not None:
+            cache.close()
+        if previous is not None:
+            previous.close()
+    elif server:
+        # warm VEP workers of a running annotation server, no VEP startup
+        run_vep(input_vcf, annotated_vcf, genome_assembly, cache_version, server=server)
+    elif stream:
+        # VEP output is reduced to canonical annotations and BGZF compressed as it is produced
+        run_vep(input_vcf, annotated_vcf, genome_assembly, cache_version, shards, stream, checkpoint, resume)
+    else:
+        # run VEP and re-write with only canonical variants
+        run_vep(input_vcf, annotated_vcf, genome_assembly, cache_version, shards)
+
+    if regions:
+        os.remove(input_vcf)
     
 
 if __name__=='__main__':
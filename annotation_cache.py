@@ -0,0 +1,131 @@
+'''Persistent cache of canonical VEP annotations shared between runs of annotate_vcf.py.
+Keyed by (assembly, VEP cache version, CHROM, POS, REF, ALT) and stored in a single sqlite file
+in WAL mode so that several jobs on one node can read and write it at the same time.
+Lookups run in read transactions, which do not block each other or a writer, and only the
+last_used updates of the hits take the write lock. The number of entries is kept by triggers,
+and least recently used entries are evicted once it grows over max_entries.
+'''
+import sqlite3
+import time
+
+DEFAULT_MAX_ENTRIES = 10000000
+LOCK_TIMEOUT = 600 # seconds to wait for another job holding the write lock
+QUERY_BATCH = 10000
+LOOKUP_CHUNK = 200 # keys per SELECT, 4 parameters each stay under the sqlite limit of 999
+
+
+class AnnotationCache():
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(path, timeout=LOCK_TIMEOUT, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.transaction():
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS annotation (
+                assembly TEXT, cache_version INTEGER, chrom TEXT, pos INTEGER, ref TEXT, alt TEXT,
+                csq TEXT, last_used INTEGER,
+                PRIMARY KEY (assembly, cache_version, chrom, pos, ref, alt)) WITHOUT ROWID''')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS annotation_last_used ON annotation (last_used)')
+            # counted once when the table is created, or for a cache written before the count was kept
+            self.connection.execute('CREATE TABLE IF NOT EXISTS entries (count INTEGER)')
+            if self.connection.execute('SELECT count FROM entries').fetchone() is None:
+                self.connection.execute('INSERT INTO entries SELECT COUNT(*) FROM annotation')
+            self.connection.execute('CREATE TRIGGER IF NOT EXISTS annotation_insert AFTER INSERT ON annotation BEGIN UPDATE entries SET count = count + 1; END')
+            self.connection.execute('CREATE TRIGGER IF NOT EXISTS annotation_delete AFTER DELETE ON annotation BEGIN UPDATE entries SET count = count - 1; END')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS csq_header (
+                assembly TEXT, cache_version INTEGER, header TEXT,
+                PRIMARY KEY (assembly, cache_version))''')
+
+    def __repr__(self):
+        return f'AnnotationCache({self.path}, max_entries={self.max_entries})'
+
+    def transaction(self):
+        '''write transaction that takes the lock up front, so concurrent jobs wait instead of failing midway'''
+        return _Transaction(self.connection)
+
+    def read_transaction(self):
+        '''read transaction, sees one snapshot of the cache without taking the write lock'''
+        return _Transaction(self.connection, 'DEFERRED')
+
+    def get_many(self, assembly, cache_version, keys):
+        '''cached canonical CSQ of (CHROM, POS, REF, ALT) keys, marks the hits as recently used
+        returns {key: csq} for the keys present in the cache'''
+        hits = dict()
+        keys = list(dict.fromkeys(keys))
+        for i in range(0, len(keys), QUERY_BATCH):
+            with self.read_transaction():
+                for j in range(i, min(i + QUERY_BATCH, len(keys)), LOOKUP_CHUNK):
+                    chunk = keys[j:min(j + LOOKUP_CHUNK, i + QUERY_BATCH)]
+                    values = ', '.join(['(?, ?, ?, ?)'] * len(chunk))
+                    rows = self.connection.execute(f'SELECT chrom, pos, ref, alt, csq FROM annotation WHERE assembly=? AND cache_version=? AND (chrom, pos, ref, alt) IN (VALUES {values})',
+                        (assembly, cache_version, *[field for key in chunk for field in key]))
+                    for chrom, pos, ref, alt, csq in rows:
+                        hits[(chrom, pos, ref, alt)] = csq
+        self.touch(assembly, cache_version, list(hits))
+
+        return hits
+
+    def touch(self, assembly, cache_version, keys):
+        '''marks keys as recently used, one write transaction per QUERY_BATCH keys'''
+        now = time.time_ns()
+        for i in range(0, len(keys), QUERY_BATCH):
+            with self.transaction():
+                self.connection.executemany('UPDATE annotation SET last_used=? WHERE assembly=? AND cache_version=? AND chrom=? AND pos=? AND ref=? AND alt=?',
+                    [(now, assembly, cache_version, *key) for key in keys[i:i + QUERY_BATCH]])
+
+        return 0
+
+    def put_many(self, assembly, cache_version, annotations):
+        '''stores {(CHROM, POS, REF, ALT): csq} and evicts least recently used entries over max_entries'''
+        now = time.time_ns()
+        items = list(annotations.items())
+        for i in range(0, len(items), QUERY_BATCH):
+            with self.transaction():
+                # an upsert instead of INSERT OR REPLACE, so that only new entries fire the insert trigger
+                self.connection.executemany('''INSERT INTO annotation VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT DO UPDATE SET csq=excluded.csq, last_used=excluded.last_used''',
+                    [(assembly, cache_version, *key, csq, now) for key, csq in items[i:i + QUERY_BATCH]])
+        self.evict()
+
+        return 0
+
+    def __len__(self):
+        return self.connection.execute('SELECT count FROM entries').fetchone()[0]
+
+    def evict(self):
+        '''removes the least recently used entries so that at most max_entries remain'''
+        with self.transaction():
+            excess = len(self) - self.max_entries
+            if excess > 0:
+                self.connection.execute('''DELETE FROM annotation WHERE (assembly, cache_version, chrom, pos, ref, alt) IN
+                    (SELECT assembly, cache_version, chrom, pos, ref, alt FROM annotation ORDER BY last_used LIMIT ?)''', (excess,))
+                print(f'evicted {excess} least recently used entries from {self.path}')
+
+        return 0
+
+    def csq_header(self, assembly, cache_version):
+        '''##INFO=<ID=CSQ,...> header line VEP wrote for this assembly and cache version, None if not cached'''
+        row = self.connection.execute('SELECT header FROM csq_header WHERE assembly=? AND cache_version=?', (assembly, cache_version)).fetchone()
+        return row[0] if row else None
+
+    def set_csq_header(self, assembly, cache_version, header):
+        with self.transaction():
+            self.connection.execute('INSERT OR REPLACE INTO csq_header VALUES (?, ?, ?)', (assembly, cache_version, header))
+
+    def close(self):
+        self.connection.close()
+
+
+class _Transaction():
+    def __init__(self, connection, mode='IMMEDIATE'):
+        self.connection = connection
+        self.mode = mode
+
+    def __enter__(self):
+        self.connection.execute(f'BEGIN {self.mode}')
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+        return False
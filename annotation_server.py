@@ -0,0 +1,298 @@
+#!/home/users/cjyoon/anaconda3/bin/python
+'''Local annotation server that keeps VEP worker processes warm, so that annotating a few variants
+does not pay the Perl startup and cache loading of a new VEP run every time.
+Each worker is one VEP process reading VCF lines from its stdin and writing annotated lines to its stdout,
+which is a pseudo terminal so that Perl flushes every line instead of buffering the output.
+Clients (annotate_vcf.py --server, svAnnotate.py --server) connect to a Unix socket and exchange
+one JSON object per line
+    {"op": "ping"}
+        -> {"assembly": ..., "cache_version": ..., "workers": n, "header": ##INFO=<ID=CSQ,...> line}
+    {"op": "annotate", "assembly": "GRCh37", "variants": [[CHROM, POS, REF, ALT], ...]}
+        -> {"header": ##INFO=<ID=CSQ,...> line, "csq": [canonical CSQ of every variant, '' when VEP gave none]}
+Errors are returned as {"error": message}. Requests of more than MAX_REQUEST_VARIANTS variants are refused,
+the client splits its variants into requests of SERVER_BATCH_SIZE.
+'''
+import os
+import sys
+import pty
+import tty
+import json
+import shlex
+import queue
+import socket
+import argparse
+import itertools
+import threading
+import subprocess
+import socketserver
+import concurrent.futures
+from csq import CSQDecoder
+
+DEFAULT_SOCKET = os.path.join(os.path.expanduser('~'), '.vep_annotation_server.sock')
+DEFAULT_WORKERS = 2
+WORKER_HEADER = '##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+# VEP may read one line ahead of what it has written, two sentinel records after a batch
+# make sure every record of the batch has come out before the first sentinel does
+SENTINEL = '1\t10000\t{}\tN\tA\t.\t.\t.\n'
+SERVER_BATCH_SIZE = 1000 # variants per request sent by AnnotationClient
+MAX_REQUEST_VARIANTS = 10 * SERVER_BATCH_SIZE
+MAX_REQUEST_BYTES = 1 << 24 # longest request line read from a client
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Keeps VEP workers warm and annotates variants sent over a local Unix socket')
+    parser.add_argument('-g', '--genome_assembly', required=False, default='GRCh37', choices=['GRCh37', 'GRCh38'], help='Genome Assembly version the workers load the cache of. Default=GRCh37')
+    parser.add_argument('-s', '--socket', required=False, default=DEFAULT_SOCKET, help=f'Unix socket the server listens on. Default={DEFAULT_SOCKET}')
+    parser.add_argument('-w', '--workers', required=False, default=DEFAULT_WORKERS, type=int, help=f'Number of VEP processes kept warm, each annotates one request at a time. Default={DEFAULT_WORKERS}')
+
+    args = vars(parser.parse_args())
+    return args['genome_assembly'], args['socket'], args['workers']
+
+
+class VepWorker():
+    '''a running VEP process annotating batches of variants with its cache already loaded'''
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.batches = itertools.count()
+        self.csq_header = None
+        self.decoder = None
+        self.start()
+
+    def __repr__(self):
+        return f'VepWorker(pid={self.process.pid})'
+
+    def start(self):
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.process = subprocess.Popen(shlex.split(self.cmd), stdin=subprocess.PIPE, stdout=slave, text=True)
+        os.close(slave)
+        self.output = os.fdopen(master, 'r')
+        self.process.stdin.write(WORKER_HEADER)
+        # the first record loads the cache and makes VEP write its header
+        self.annotate([])
+
+    def send(self, line):
+        self.process.stdin.write(line)
+
+    def read_line(self):
+        try:
+            line = self.output.readline()
+        except OSError:
+            line = ''
+        if not line:
+            raise RuntimeError(f'VEP worker {self.process.pid} exited with code {self.process.poll()}')
+        return line
+
+    def write_batch(self, lines):
+        '''writes lines to VEP, stops quietly when VEP has exited, which read_line reports'''
+        try:
+            for line in lines:
+                self.send(line)
+            self.process.stdin.flush()
+        except (OSError, ValueError):
+            pass
+
+    def annotate(self, variants):
+        '''canonical CSQ of every (CHROM, POS, REF, ALT) in variants, '' when VEP did not annotate it.
+        The batch is written from a separate thread while the output is read, so that VEP never blocks
+        on a full output buffer while the batch is still being written'''
+        batch = next(self.batches)
+        ids = [f'q{batch}_{i}' for i in range(len(variants))]
+        flush = f'f{batch}'
+        lines = [f'{chrom}\t{pos}\t{record_id}\t{ref}\t{alt}\t.\t.\t.\n' for record_id, (chrom, pos, ref, alt) in zip(ids, variants)]
+        lines += [SENTINEL.format(flush + 'a'), SENTINEL.format(flush + 'b')]
+        writer = threading.Thread(target=self.write_batch, args=(lines,), daemon=True)
+        writer.start()
+
+        annotations = dict()
+        while True:
+            line = self.read_line()
+            if line.startswith('##INFO=<ID=CSQ,'):
+                self.csq_header = line.rstrip('\r\n')
+                self.decoder = CSQDecoder.from_header(self.csq_header)
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\r\n').split('\t')
+            if fields[2] == flush + 'a':
+                break
+            if not fields[2].startswith(f'q{batch}_'):
+                # sentinels of earlier batches
+                continue
+            csq = ''
+            for entry in fields[7].split(';'):
+                if entry.startswith('CSQ='):
+                    csq = self.decoder.canonical(entry[4:])
+            annotations[fields[2]] = csq
+        writer.join()
+
+        return [annotations.get(record_id, '') for record_id in ids]
+
+    def restart(self):
+        self.close()
+        self.start()
+
+    def close(self):
+        if self.process.poll() is None:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.output.close()
+
+
+class AnnotationHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline(MAX_REQUEST_BYTES + 1)
+            if not line:
+                break
+            if len(line) > MAX_REQUEST_BYTES:
+                # the rest of the request is not read, the connection is closed
+                self.wfile.write((json.dumps({'error': f'request longer than {MAX_REQUEST_BYTES} bytes, send at most {SERVER_BATCH_SIZE} variants per request'}) + '\n').encode())
+                break
+            try:
+                response = self.server.respond(json.loads(line))
+            except (ValueError, KeyError, TypeError) as error:
+                response = {'error': f'bad request: {error}'}
+            self.wfile.write((json.dumps(response) + '\n').encode())
+
+
+class AnnotationServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, cmd, assembly_version, cache_version, workers=DEFAULT_WORKERS):
+        self.assembly_version = assembly_version
+        self.cache_version = cache_version
+        # workers load their cache at the same time
+        with concurrent.futures.ThreadPoolExecutor(max(1, workers)) as executor:
+            self.workers = list(executor.map(lambda i: VepWorker(cmd), range(max(1, workers))))
+        self.idle = queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, AnnotationHandler)
+
+    def respond(self, request):
+        if request['op'] == 'ping':
+            return {'assembly': self.assembly_version, 'cache_version': self.cache_version, 'workers': len(self.workers), 'header': self.workers[0].csq_header}
+        if request['op'] != 'annotate':
+            return {'error': f'unknown op {request["op"]}'}
+        if request.get('assembly', self.assembly_version) != self.assembly_version:
+            return {'error': f'server annotates {self.assembly_version}, not {request["assembly"]}'}
+        if len(request['variants']) > MAX_REQUEST_VARIANTS:
+            return {'error': f'{len(request["variants"])} variants in one request, send at most {MAX_REQUEST_VARIANTS}'}
+        variants = [(str(chrom), int(pos), ref, alt) for chrom, pos, ref, alt in request['variants']]
+        worker = self.idle.get()
+        try:
+            return {'header': worker.csq_header, 'csq': worker.annotate(variants)}
+        except (RuntimeError, OSError) as error:
+            # a worker that exited or closed its pipe is replaced
+            worker.restart()
+            return {'error': str(error)}
+        finally:
+            self.idle.put(worker)
+
+    def server_close(self):
+        super().server_close()
+        for worker in self.workers:
+            worker.close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+class AnnotationClient():
+    '''connection to a running annotation server'''
+    def __init__(self, socket_path=DEFAULT_SOCKET):
+        self.socket_path = socket_path
+        self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.connection.connect(socket_path)
+        except OSError as error:
+            raise ConnectionError(f'no annotation server at {socket_path}, start one with annotation_server.py: {error}')
+        self.stream = self.connection.makefile('rw')
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return f'AnnotationClient({self.socket_path})'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def request(self, request):
+        with self.lock:
+            self.stream.write(json.dumps(request) + '\n')
+            self.stream.flush()
+            line = self.stream.readline()
+        if not line:
+            raise ConnectionError(f'annotation server at {self.socket_path} closed the connection')
+        response = json.loads(line)
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response
+
+    def ping(self):
+        return self.request({'op': 'ping'})
+
+    def annotate(self, variants, assembly_version=None):
+        '''canonical CSQ of every (CHROM, POS, REF, ALT) in variants, sent in requests of SERVER_BATCH_SIZE variants
+        returns (##INFO=<ID=CSQ,...> header line, list of CSQ strings)'''
+        variants = list(variants)
+        header, csqs = None, []
+        for i in range(0, max(1, len(variants)), SERVER_BATCH_SIZE):
+            request = {'op': 'annotate', 'variants': [list(variant) for variant in variants[i:i + SERVER_BATCH_SIZE]]}
+            if assembly_version:
+                request['assembly'] = assembly_version
+            response = self.request(request)
+            header = response['header']
+            csqs += response['csq']
+        return header, csqs
+
+    def close(self):
+        self.stream.close()
+        self.connection.close()
+
+
+def worker_command(assembly_version, cache_version):
+    '''VEP command of a worker, reading VCF lines from stdin and writing each annotated line as soon as it is done.
+    VEP cannot detect the format of stdin, so it is given'''
+    # annotate_vcf.py imports the client from this module, so the VEP command is imported only when serving
+    from annotate_vcf import vep_command
+    return vep_command('/dev/stdin', 'STDOUT', assembly_version, cache_version) + ' --format vcf --buffer_size 1'
+
+
+def main():
+    from annotate_vcf import cache_version_mapper, setup_vep_environment
+    assembly_version, socket_path, workers = argument_parser()
+    cache_version = cache_version_mapper[assembly_version]
+    setup_vep_environment()
+    cmd = worker_command(assembly_version, cache_version)
+    print(f'starting {workers} VEP workers for {assembly_version} (cache {cache_version})')
+    try:
+        server = AnnotationServer(socket_path, cmd, assembly_version, cache_version, workers)
+    except RuntimeError as error:
+        print(error)
+        print('Exiting...')
+        sys.exit(1)
+    print(f'annotation server ready: {socket_path}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    main()
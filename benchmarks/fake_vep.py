@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+'''Stand-in for the vep executable so that annotation can be benchmarked offline.
+Accepts the command line of annotate_vcf.vep_command and writes the input VCF with a deterministic
+multi-transcript CSQ field (the same for the same CHROM, POS, REF and ALT) in the layout of csq.DEFAULT_CSQ_FORMAT.
+Use it with VEP_PATH=benchmarks/fake_vep.py. FAKE_VEP_STARTUP seconds of sleep stand for loading the cache.
+Records whose only ALT is * are written without CSQ, as VEP does not annotate spanning deletions.
+With FAKE_VEP_EXIT_AFTER=n it exits with code 1 after writing n records, like a VEP run that was killed.
+'''
+import os
+import sys
+import gzip
+import time
+from synthetic import CSQ_HEADER, variant_csq
+
+
+def option(argv, names, default=None):
+    for i, arg in enumerate(argv):
+        if arg in names and i + 1 < len(argv):
+            return argv[i + 1]
+    return default
+
+
+STDIN = (None, 'STDIN', '-', '/dev/stdin')
+
+
+def open_input(path):
+    if path in STDIN:
+        return sys.stdin
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt')
+    return open(path)
+
+
+def main():
+    argv = sys.argv[1:]
+    input_path = option(argv, ['-i', '--input_file'])
+    output_path = option(argv, ['-o', '--output_file'], 'STDOUT')
+    if input_path in STDIN and option(argv, ['--format']) is None:
+        # like VEP, which cannot detect the format of its stdin
+        print('ERROR: Cannot detect format from STDIN - specify format with --format [format]', file=sys.stderr)
+        sys.exit(1)
+    time.sleep(float(os.environ.get('FAKE_VEP_STARTUP', 0)))
+    exit_after = int(os.environ.get('FAKE_VEP_EXIT_AFTER', -1))
+
+    output = sys.stdout if output_path == 'STDOUT' else open(output_path, 'w')
+    for line in open_input(input_path):
+        if line.startswith('##'):
+            output.write(line)
+        elif line.startswith('#'):
+            output.write('##VEP="fake" cache="synthetic"\n')
+            output.write(CSQ_HEADER)
+            output.write(line)
+        else:
+            if exit_after == 0:
+                output.flush()
+                sys.exit(1)
+            exit_after -= 1
+            fields = line.rstrip('\n').split('\t')
+            if fields[4] == '*':
+                output.write(line)
+                continue
+            csq = ','.join(variant_csq(fields[0], fields[1], fields[3], alt) for alt in fields[4].split(','))
+            fields[7] = f'CSQ={csq}' if fields[7] in ('', '.') else f'{fields[7]};CSQ={csq}'
+            output.write('\t'.join(fields) + '\n')
+    if output is not sys.stdout:
+        output.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+'''Benchmarks of the annotation stages on synthetic inputs, runs offline with benchmarks/fake_vep.py in place of VEP.
+Every stage runs in its own process for each input size, so that its peak RSS is measured alone,
+and reports records/sec and peak RSS. Results can be saved as a baseline and later runs are compared against it.
+Stages whose dependencies are missing (cyvcf2, samtools) are reported as skipped.
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+import synthetic
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_BASELINE = os.path.join(BENCHMARK_DIR, 'baseline.json')
+DEFAULT_TOLERANCE = 0.2 # relative slowdown or memory growth reported as a regression
+CALCULATE_VAF_LIMIT = 1000 # samtools mpileup runs once per position, only this many positions are timed
+NORMAL_BAMS = 2
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Benchmarks the annotation stages on synthetic inputs and compares them with a baseline')
+    parser.add_argument('-s', '--sizes', required=False, nargs='+', type=int, default=DEFAULT_SIZES, help=f'Numbers of records of the synthetic inputs. Default={" ".join(map(str, DEFAULT_SIZES))}')
+    parser.add_argument('--stages', required=False, nargs='+', default=None, choices=list(STAGES), metavar='STAGE', help=f'Only run these stages: {", ".join(STAGES)}. Default=all')
+    parser.add_argument('-w', '--workdir', required=False, default=None, help='Directory of the synthetic inputs and outputs, kept after the run. Default=a temporary directory')
+    parser.add_argument('-b', '--baseline', required=False, default=DEFAULT_BASELINE, help='Baseline results compared against. Default=benchmarks/baseline.json')
+    parser.add_argument('--save_baseline', required=False, action='store_true', help='Write the results of this run as the new baseline')
+    parser.add_argument('--tolerance', required=False, type=float, default=DEFAULT_TOLERANCE, help=f'Slowdown in records/sec or growth in peak RSS, relative to the baseline, reported as a regression. Default={DEFAULT_TOLERANCE}')
+    parser.add_argument('--seed', required=False, type=int, default=1, help='Seed of the synthetic inputs. Default=1')
+    parser.add_argument('--run_stage', required=False, nargs=3, default=None, metavar=('STAGE', 'SIZE', 'WORKDIR'), help=argparse.SUPPRESS)
+
+    args = vars(parser.parse_args())
+    return args['sizes'], args['stages'], args['workdir'], args['baseline'], args['save_baseline'], args['tolerance'], args['seed'], args['run_stage']
+
+
+def input_paths(workdir, size):
+    '''paths of the synthetic inputs of a size'''
+    prefix = os.path.join(workdir, str(size))
+    paths = {style: f'{prefix}.{style}.vcf' for style in synthetic.STYLES}
+    paths.update({f'{style}_vep': f'{prefix}.{style}.vep.vcf' for style in ['mutect', 'strelka', 'freebayes']})
+    paths['fasta'] = os.path.join(workdir, 'reference.fa')
+    paths['bams'] = [os.path.join(workdir, f'normal{i}.bam') for i in range(NORMAL_BAMS)]
+    paths['output'] = os.path.join(workdir, f'{size}.out')
+
+    return paths
+
+
+def prepare_inputs(workdir, sizes, seed=1):
+    '''writes the reference, normal bams and the VCFs of every size that do not exist yet'''
+    fasta = os.path.join(workdir, 'reference.fa')
+    sequences = synthetic.write_fasta(fasta, synthetic.CONTIGS, seed)
+    for i, bam in enumerate(input_paths(workdir, 0)['bams']):
+        if not os.path.exists(bam):
+            synthetic.write_bam(bam, sequences, seed=seed + i)
+    for size in sizes:
+        paths = input_paths(workdir, size)
+        for style in synthetic.STYLES:
+            if not os.path.exists(paths[style]):
+                synthetic.write_vcf(paths[style], style, sequences, size, seed)
+            if f'{style}_vep' in paths and not os.path.exists(paths[f'{style}_vep']):
+                synthetic.write_vcf(paths[f'{style}_vep'], style, sequences, size, seed, annotated=True)
+        os.makedirs(paths['output'], exist_ok=True)
+
+
+def record_count(vcf):
+    with open(vcf) as f:
+        return sum(1 for line in f if not line.startswith('#'))
+
+
+def canonical_csq(paths):
+    '''csq.CSQDecoder.canonical over the CSQ strings of an annotated VCF, read beforehand'''
+    from csq import CSQDecoder
+    decoder = CSQDecoder.default()
+    with open(paths['mutect_vep']) as f:
+        csqs = [line.split('\t')[7][4:] for line in f if not line.startswith('#')]
+    start = time.perf_counter()
+    for csq in csqs:
+        decoder.canonical(csq)
+    return len(csqs), time.perf_counter() - start
+
+
+def get_canonical_annotation(paths):
+    from annotate_vcf import get_canonical_annotation
+    start = time.perf_counter()
+    get_canonical_annotation(paths['mutect_vep'], os.path.join(paths['output'], 'canonical.vcf'))
+    return record_count(paths['mutect_vep']), time.perf_counter() - start
+
+
+def vep_stream(paths):
+    '''annotate_vcf streaming path: fake VEP, canonical rewrite and BGZF output with its index'''
+    from annotate_vcf import run_vep
+    os.environ['VEP_PATH'] = os.path.join(BENCHMARK_DIR, 'fake_vep.py')
+    start = time.perf_counter()
+    run_vep(paths['mutect'], os.path.join(paths['output'], 'mutect.vep.vcf.gz'), 'GRCh37', 91, stream=True)
+    return record_count(paths['mutect']), time.perf_counter() - start
+
+
+def tidy_stage(style):
+    def tidy(paths):
+        from tidy_annotated_vcf import tidy_annotation
+        start = time.perf_counter()
+        tidy_annotation(paths[f'{style}_vep'], paths['output'], 'TUMOR')
+        return record_count(paths[f'{style}_vep']), time.perf_counter() - start
+    return tidy
+
+
+def sites_by_contig(vcf):
+    sites = dict()
+    with open(vcf) as f:
+        for line in f:
+            if not line.startswith('#'):
+                chrom, pos = line.split('\t', 2)[:2]
+                sites.setdefault(chrom, []).append(int(pos))
+    return sites
+
+
+def count_alleles(paths):
+    '''pon_annotate --engine pysam counting of every variant position in the normal bams'''
+    from pon_pileup import count_alleles
+    sites = sites_by_contig(paths['mutect'])
+    start = time.perf_counter()
+    for contig, positions in sites.items():
+        count_alleles(paths['bams'], paths['fasta'], contig, positions)
+    return sum(len(positions) for positions in sites.values()), time.perf_counter() - start
+
+
+def calculate_vaf(paths):
+    '''pon_annotate --engine mpileup, one samtools mpileup per position'''
+    if shutil.which('samtools') is None:
+        raise RuntimeError('samtools is not installed')
+    from pon_annotate import calculate_vaf
+    positions = [(contig, pos) for contig, contig_positions in sites_by_contig(paths['mutect']).items() for pos in contig_positions][:CALCULATE_VAF_LIMIT]
+    start = time.perf_counter()
+    for contig, pos in positions:
+        calculate_vaf(paths['bams'], f'{contig}:{pos}-{pos}', paths['fasta'])
+    return len(positions), time.perf_counter() - start
+
+
+def sv_collapse(paths):
+    '''delly_svannotate breakpoint collection and deduplication within 10bp'''
+    from delly_svannotate import read_svs
+    from svAnnotate import PositionArray
+    start = time.perf_counter()
+    svs = read_svs(paths['delly'])
+    PositionArray.from_positions([bp for bp1, bp2, svtype, orientation in svs for bp in (bp1, bp2)]).collapse(10)
+    return len(svs), time.perf_counter() - start
+
+
+STAGES = {
+    'canonical_csq': canonical_csq,
+    'get_canonical_annotation': get_canonical_annotation,
+    'vep_stream': vep_stream,
+    'tidy_mutect': tidy_stage('mutect'),
+    'tidy_strelka': tidy_stage('strelka'),
+    'tidy_freebayes': tidy_stage('freebayes'),
+    'count_alleles': count_alleles,
+    'calculate_vaf': calculate_vaf,
+    'sv_collapse': sv_collapse,
+}
+
+
+def run_stage(stage, size, workdir):
+    '''runs a single stage in this process and prints its result as JSON'''
+    paths = input_paths(workdir, int(size))
+    # stage output would mix with the result line
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        records, seconds = STAGES[stage](paths)
+    finally:
+        sys.stdout = stdout
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # kilobytes on linux
+    print(json.dumps({'records': records, 'seconds': seconds, 'records_per_sec': records / seconds if seconds > 0 else 0, 'peak_rss_mb': peak_rss}))
+
+
+def measure(stage, size, workdir):
+    '''result of a stage in a fresh process, {'skipped': reason} when it fails'''
+    cmd = [sys.executable, os.path.abspath(__file__), '--run_stage', stage, str(size), workdir]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        lines = result.stderr.strip().split('\n')
+        return {'skipped': lines[-1] if lines else f'exit code {result.returncode}'}
+    return json.loads(result.stdout.strip().split('\n')[-1])
+
+
+def compare(result, baseline, tolerance):
+    '''regressions of a result against its baseline'''
+    regressions = []
+    if result['records_per_sec'] < baseline['records_per_sec'] * (1 - tolerance):
+        regressions.append(f'records/sec {result["records_per_sec"]:.0f} < {baseline["records_per_sec"]:.0f}')
+    if result['peak_rss_mb'] > baseline['peak_rss_mb'] * (1 + tolerance):
+        regressions.append(f'peak RSS {result["peak_rss_mb"]:.1f}MB > {baseline["peak_rss_mb"]:.1f}MB')
+    return regressions
+
+
+def main():
+    sizes, stages, workdir, baseline_path, save_baseline, tolerance, seed, stage_args = argument_parser()
+    if stage_args:
+        run_stage(*stage_args)
+        return 0
+
+    stages = stages or list(STAGES)
+    keep = workdir is not None
+    workdir = workdir or tempfile.mkdtemp(prefix='annotation_benchmarks.')
+    os.makedirs(workdir, exist_ok=True)
+    print(f'writing synthetic inputs to {workdir}')
+    prepare_inputs(workdir, sizes, seed)
+
+    baseline = dict()
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+
+    results = dict()
+    regressions = 0
+    print(f'{"stage":<26}{"records":>10}{"seconds":>10}{"records/s":>12}{"peak MB":>10}  baseline')
+    for stage in stages:
+        for size in sizes:
+            result = measure(stage, size, workdir)
+            if 'skipped' in result:
+                print(f'{stage:<26}{size:>10}  skipped: {result["skipped"]}')
+                continue
+            results.setdefault(stage, dict())[str(size)] = result
+            reference = baseline.get(stage, dict()).get(str(size))
+            if reference is None:
+                status = '-'
+            else:
+                problems = compare(result, reference, tolerance)
+                regressions += bool(problems)
+                status = 'REGRESSION ' + ', '.join(problems) if problems else f'{result["records_per_sec"] / reference["records_per_sec"]:.2f}x'
+            print(f'{stage:<26}{result["records"]:>10}{result["seconds"]:>10.3f}{result["records_per_sec"]:>12.0f}{result["peak_rss_mb"]:>10.1f}  {status}')
+
+    if save_baseline:
+        for stage, stage_results in results.items():
+            baseline.setdefault(stage, dict()).update(stage_results)
+        with open(baseline_path, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f'baseline written: {baseline_path}')
+    if not keep:
+        shutil.rmtree(workdir)
+    if regressions:
+        print(f'{regressions} regressions beyond {tolerance:.0%}')
+        sys.exit(1)
+
+    return 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+'''Generators of synthetic inputs for the benchmarks: reference fasta, caller VCFs in Mutect, Strelka,
+Freebayes and Delly style, VEP annotated VCFs with multi-transcript CSQ strings and normal bams.
+Everything is drawn from a seeded random.Random, so the same seed gives the same files.
+'''
+import os
+import sys
+import zlib
+import random
+import pysam
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from csq import DEFAULT_CSQ_FORMAT
+
+CONTIGS = [('1', 3000000), ('2', 2000000)]
+STYLES = ['mutect', 'strelka', 'freebayes', 'delly']
+CSQ_FIELDS = DEFAULT_CSQ_FORMAT.split('|')
+CSQ_HEADER = f'##INFO=<ID=CSQ,Number=.,Type=String,Description="Consequence annotations from Ensembl VEP. Format: {DEFAULT_CSQ_FORMAT}">\n'
+CONSEQUENCES = [('missense_variant', 'MODERATE'), ('synonymous_variant', 'LOW'), ('intron_variant', 'MODIFIER'),
+    ('stop_gained', 'HIGH'), ('upstream_gene_variant', 'MODIFIER'), ('downstream_gene_variant', 'MODIFIER'),
+    ('3_prime_UTR_variant', 'MODIFIER'), ('splice_region_variant&intron_variant', 'LOW'), ('frameshift_variant', 'HIGH')]
+BIOTYPES = ['protein_coding', 'processed_transcript', 'nonsense_mediated_decay', 'retained_intron', 'lncRNA']
+AF_FIELDS = {field for field in CSQ_FIELDS if field.endswith('AF')}
+
+HEADERS = {
+    'mutect': ['##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+        '##FORMAT=<ID=AD,Number=.,Type=Integer,Description="Allelic depths for the ref and alt alleles">',
+        '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Approximate read depth">',
+        '##FORMAT=<ID=FA,Number=A,Type=Float,Description="Allele fraction of the alternate allele">'],
+    'strelka': ['##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read depth for tier1">'] +
+        [f'##FORMAT=<ID={base}U,Number=2,Type=Integer,Description="Number of \'{base}\' alleles used in tiers 1,2">' for base in 'ACGT'],
+    'freebayes': ['##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+        '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read Depth">',
+        '##FORMAT=<ID=RO,Number=1,Type=Integer,Description="Reference allele observation count">',
+        '##FORMAT=<ID=AO,Number=A,Type=Integer,Description="Alternate allele observation count">'],
+    'delly': ['##INFO=<ID=SVTYPE,Number=1,Type=String,Description="Type of structural variant">',
+        '##INFO=<ID=CHR2,Number=1,Type=String,Description="Chromosome for END coordinate">',
+        '##INFO=<ID=END,Number=1,Type=Integer,Description="End position of the structural variant">',
+        '##INFO=<ID=CT,Number=1,Type=String,Description="Paired-end signature induced connection type">',
+        '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">'],
+}
+SAMPLES = {'mutect': ['NORMAL', 'TUMOR'], 'strelka': ['NORMAL', 'TUMOR'], 'freebayes': ['SAMPLE'], 'delly': ['TUMOR']}
+
+
+def write_fasta(path, contigs=CONTIGS, seed=1):
+    '''random reference of contigs [(name, length)], indexed with samtools faidx
+    returns {name: sequence}'''
+    rng = random.Random(seed)
+    sequences = dict()
+    with open(path, 'w') as f:
+        for name, length in contigs:
+            sequence = ''.join(rng.choices('ACGT', k=length))
+            sequences[name] = sequence
+            f.write(f'>{name}\n')
+            for i in range(0, length, 60):
+                f.write(sequence[i:i + 60] + '\n')
+    pysam.faidx(path)
+
+    return sequences
+
+
+def random_sites(rng, sequences, n):
+    '''n distinct sorted (contig, 1-based position), spread over the contigs by length'''
+    total = sum(len(sequence) for sequence in sequences.values())
+    sites = []
+    for name, sequence in sequences.items():
+        count = max(1, round(n * len(sequence) / total))
+        sites += [(name, pos) for pos in sorted(rng.sample(range(1000, len(sequence) - 1000), count))]
+
+    return sites[:n]
+
+
+def csq_value(rng, field, allele, gene, transcript, consequence, impact, biotype):
+    '''plausible value of a single CSQ field'''
+    if field == 'Allele':
+        return allele
+    if field == 'Consequence':
+        return consequence
+    if field == 'IMPACT':
+        return impact
+    if field in ('SYMBOL', 'NEAREST'):
+        return f'GENE{gene}'
+    if field == 'Gene':
+        return f'ENSG{gene:011d}'
+    if field == 'Feature_type':
+        return 'Transcript'
+    if field == 'Feature':
+        return f'ENST{transcript:011d}'
+    if field == 'BIOTYPE':
+        return biotype
+    if field == 'EXON':
+        return f'{rng.randint(1, 20)}/20' if 'intron' not in consequence else ''
+    if field == 'INTRON':
+        return f'{rng.randint(1, 19)}/19' if 'intron' in consequence else ''
+    if field == 'HGVSc':
+        return f'ENST{transcript:011d}.1:c.{rng.randint(1, 3000)}A>{allele}'
+    if field == 'HGVSp':
+        return f'ENSP{transcript:011d}.1:p.Ala{rng.randint(1, 1000)}Val' if impact in ('MODERATE', 'HIGH') else ''
+    if field in ('cDNA_position', 'CDS_position', 'Protein_position'):
+        return str(rng.randint(1, 3000))
+    if field == 'STRAND':
+        return rng.choice(['1', '-1'])
+    if field == 'ALLELE_NUM':
+        return '1'
+    if field == 'DISTANCE':
+        return str(rng.randint(1, 5000)) if 'stream' in consequence else ''
+    if field == 'VARIANT_CLASS':
+        return 'SNV'
+    if field == 'Existing_variation':
+        return f'rs{rng.randint(1, 10**8)}' if rng.random() < 0.3 else ''
+    if field in ('SIFT', 'PolyPhen'):
+        return f'tolerated({rng.random():.2f})' if impact == 'MODERATE' else ''
+    if field in AF_FIELDS:
+        return f'{rng.random() / 100:.4f}' if rng.random() < 0.3 else ''
+    if field == 'TSL':
+        return str(rng.randint(1, 5))
+
+    return ''
+
+
+def csq_string(rng, allele):
+    '''CSQ of one variant: 1 to 8 transcripts, one of which is usually CANONICAL and one PICKed'''
+    transcripts = rng.randint(1, 8)
+    gene = rng.randint(1, 20000)
+    canonical = rng.randrange(transcripts) if rng.random() < 0.9 else None
+    annotations = []
+    for i in range(transcripts):
+        consequence, impact = rng.choice(CONSEQUENCES)
+        transcript = gene * 10 + i
+        values = []
+        for field in CSQ_FIELDS:
+            if field == 'CANONICAL':
+                values.append('YES' if i == canonical else '')
+            elif field == 'PICK':
+                values.append('1' if i == (canonical or 0) else '')
+            else:
+                values.append(csq_value(rng, field, allele, gene, transcript, consequence, impact, rng.choice(BIOTYPES)))
+        annotations.append('|'.join(values))
+
+    return ','.join(annotations)
+
+
+def variant_csq(chrom, pos, ref, alt):
+    '''CSQ string that depends only on the variant, as the fake VEP writes it'''
+    return csq_string(random.Random(zlib.crc32(f'{chrom}:{pos}:{ref}:{alt}'.encode())), alt)
+
+
+def vcf_header(style, sequences, annotated=False):
+    lines = ['##fileformat=VCFv4.2', f'##source=synthetic_{style}']
+    lines += [f'##contig=<ID={name},length={len(sequence)}>' for name, sequence in sequences.items()]
+    lines += HEADERS[style]
+    header = '\n'.join(lines) + '\n'
+    if annotated:
+        header += CSQ_HEADER
+    return header + '\t'.join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'] + SAMPLES[style]) + '\n'
+
+
+def sample_columns(rng, style, ref, alt):
+    '''FORMAT and sample columns of a record'''
+    depth = rng.randint(10, 200)
+    alt_count = rng.randint(1, depth)
+    if style == 'mutect':
+        return 'GT:AD:DP:FA', [f'0/0:{depth},0:{depth}:0.00', f'0/1:{depth - alt_count},{alt_count}:{depth}:{alt_count / depth:.3f}']
+    if style == 'strelka':
+        columns = []
+        for alt_reads in (0, alt_count):
+            counts = {base: (depth - alt_reads if base == ref else alt_reads if base == alt else 0) for base in 'ACGT'}
+            columns.append(f'{depth}:' + ':'.join(f'{counts[base]},{counts[base]}' for base in 'ACGT'))
+        return 'DP:AU:CU:GU:TU', columns
+    if style == 'freebayes':
+        return 'GT:DP:RO:AO', [f'0/1:{depth}:{depth - alt_count}:{alt_count}']
+    return 'GT', ['0/1']
+
+
+def write_vcf(path, style, sequences, n, seed=1, annotated=False):
+    '''n records of a caller style, with the CSQ INFO field of the fake VEP when annotated
+    returns the (contig, position) of the records'''
+    rng = random.Random(seed)
+    sites = random_sites(rng, sequences, n)
+    contigs = list(sequences)
+    with open(path, 'w') as f:
+        f.write(vcf_header(style, sequences, annotated))
+        for chrom, pos in sites:
+            ref = sequences[chrom][pos - 1]
+            if style == 'delly':
+                chrom2 = rng.choice(contigs)
+                end = rng.randint(1000, len(sequences[chrom2]) - 1000) if chrom2 != chrom else min(pos + rng.randint(100, 100000), len(sequences[chrom]) - 1)
+                svtype = 'BND' if chrom2 != chrom else rng.choice(['DEL', 'DUP', 'INV'])
+                info = f'SVTYPE={svtype};CHR2={chrom2};END={end};CT={rng.choice(["3to5", "5to3", "3to3", "5to5"])}'
+                alt = f'<{svtype}>'
+            else:
+                alt = rng.choice([base for base in 'ACGT' if base != ref])
+                info = '.'
+            if annotated:
+                info = f'CSQ={variant_csq(chrom, pos, ref, alt)}'
+            format_field, samples = sample_columns(rng, style, ref, alt)
+            f.write('\t'.join([chrom, str(pos), '.', ref, alt, '.', 'PASS', info, format_field] + samples) + '\n')
+
+    return sites
+
+
+def write_bam(path, sequences, reads_per_contig=20000, read_length=100, error_rate=0.01, seed=1):
+    '''sorted and indexed bam of reads sampled from the reference with random base errors'''
+    rng = random.Random(seed)
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': name, 'LN': len(sequence)} for name, sequence in sequences.items()],
+        'RG': [{'ID': 'synthetic', 'SM': os.path.basename(path)}]}
+    with pysam.AlignmentFile(path, 'wb', header=header) as bam:
+        for tid, (name, sequence) in enumerate(sequences.items()):
+            for i, start in enumerate(sorted(rng.randrange(len(sequence) - read_length) for _ in range(reads_per_contig))):
+                bases = list(sequence[start:start + read_length])
+                for j in range(read_length):
+                    if rng.random() < error_rate:
+                        bases[j] = rng.choice('ACGT')
+                read = pysam.AlignedSegment()
+                read.query_name = f'{name}_{i}'
+                read.reference_id = tid
+                read.reference_start = start
+                read.mapping_quality = 60
+                read.cigartuples = [(0, read_length)]
+                read.query_sequence = ''.join(bases)
+                read.query_qualities = pysam.qualitystring_to_array('I' * read_length)
+                read.set_tag('RG', 'synthetic')
+                bam.write(read)
+    pysam.index(path)
+
+    return path
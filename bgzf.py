@@ -0,0 +1,218 @@
+'''Minimal BGZF writer so that VCF text can be compressed as it is produced,
+without writing an uncompressed file and running bgzip over it afterwards.
+Blocks can be compressed by several threads (zlib releases the GIL) and are written in order.
+VcfWriter additionally builds the tabix index from the block offsets while records are written,
+so no second pass over the output is needed.
+Output is readable by htslib (bcftools, tabix, cyvcf2, pysam).
+'''
+import os
+import time
+import struct
+import zlib
+import collections
+import concurrent.futures
+from vcf_index import VcfIndexer, record_span
+from metrics import metrics
+
+BLOCK_SIZE = 65280 # uncompressed bytes per block, same as htslib
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+PENDING_PER_THREAD = 4 # blocks queued for compression per thread before the writer waits
+
+_threads = 1
+
+
+def compress_block(data, level=6):
+    '''a single BGZF block (gzip member with the BC extra field) holding data'''
+    start = time.perf_counter()
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    block_size = 18 + len(compressed) + 8
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2, block_size - 1)
+    trailer = struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+    # time is summed over the compression threads
+    metrics().add('bgzf_compress', wall=time.perf_counter() - start, bytes_read=len(data), bytes_written=block_size)
+    return header + compressed + trailer
+
+
+def configure(threads=1):
+    '''number of compression threads used by writers that are not given threads'''
+    global _threads
+    _threads = max(1, threads)
+
+
+class BgzfWriter():
+    '''file-like writer producing a BGZF compressed file.
+    Given offset, an existing file is truncated to that block boundary and appended to'''
+    def __init__(self, path, level=6, offset=None, threads=None):
+        self.path = path
+        self.level = level
+        if offset is None:
+            self.handle = open(path, 'wb')
+        else:
+            self.handle = open(path, 'r+b')
+            self.handle.truncate(offset)
+            self.handle.seek(offset)
+        self.buffer = bytearray()
+        self.threads = _threads if threads is None else max(1, threads)
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.threads) if self.threads > 1 else None
+        self.pending = collections.deque()
+        self.blocks = 0 # blocks handed to compression
+        self.block_offsets = [self.handle.tell()] # compressed offset of every block written, and of the next one
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def address(self):
+        '''(block number, offset within the block) of the next byte written.
+        Turned into a virtual offset with virtual_offset once that block is written'''
+        return self.blocks, len(self.buffer)
+
+    def virtual_offset(self, address):
+        block, within = address
+        return (self.block_offsets[block] << 16) | within
+
+    def write_block(self, block):
+        self.handle.write(block)
+        self.block_offsets.append(self.handle.tell())
+
+    def compress(self, data):
+        self.blocks += 1
+        if self.executor is None:
+            self.write_block(compress_block(data, self.level))
+            return
+        self.pending.append(self.executor.submit(compress_block, data, self.level))
+        while len(self.pending) > PENDING_PER_THREAD * self.threads:
+            self.write_block(self.pending.popleft().result())
+
+    def drain(self):
+        while self.pending:
+            self.write_block(self.pending.popleft().result())
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.buffer += data
+        while len(self.buffer) >= BLOCK_SIZE:
+            self.compress(bytes(self.buffer[:BLOCK_SIZE]))
+            del self.buffer[:BLOCK_SIZE]
+
+        return len(data)
+
+    def flush(self):
+        '''compresses whatever is buffered into a block, so that the file ends at a block boundary'''
+        if self.buffer:
+            self.compress(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.drain()
+        self.handle.flush()
+
+    def tell(self):
+        '''compressed offset of the next block, a block boundary only right after flush'''
+        return self.handle.tell()
+
+    def close(self):
+        if not self.handle.closed:
+            self.flush()
+            self.handle.write(EOF_BLOCK)
+            self.handle.close()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+class VcfWriter(BgzfWriter):
+    '''BGZF writer of VCF text that also writes its .tbi (or .csi) index on close.
+    Lines must be written whole and records in sorted order.
+    When appending to an existing file at offset, the records before it are not seen and the index is built by reading the file on close'''
+    def __init__(self, path, level=6, offset=None, threads=None):
+        super().__init__(path, level, offset, threads)
+        self.indexer = VcfIndexer() if offset is None else None
+
+    def write(self, data):
+        if self.indexer is None:
+            return super().write(data)
+        if isinstance(data, bytes):
+            data = data.decode()
+        for line in data.splitlines(keepends=True):
+            if line.startswith('#'):
+                self.indexer.header(line)
+                super().write(line)
+            else:
+                start = self.address()
+                super().write(line)
+                self.indexer.add(line, start, self.address())
+
+        return len(data)
+
+    def close(self):
+        if self.handle.closed:
+            return
+        super().close()
+        if self.indexer is None or self.indexer.overflow:
+            index_vcf(self.path)
+        else:
+            write_index(self.path, self.indexer, self.virtual_offset)
+
+
+def write_index(path, indexer, virtual_offset):
+    '''writes the index of the VCF at path, returns the index path'''
+    index_path = path + indexer.suffix()
+    with BgzfWriter(index_path, threads=1) as f:
+        f.write(indexer.serialize(virtual_offset))
+
+    return index_path
+
+
+def read_blocks(path):
+    '''compressed offset and uncompressed data of every block of a BGZF file'''
+    with open(path, 'rb') as f:
+        while True:
+            offset = f.tell()
+            header = f.read(18)
+            if len(header) < 18:
+                return
+            block_size = struct.unpack('<H', header[16:18])[0] + 1
+            compressed = f.read(block_size - 18)
+            yield offset, zlib.decompress(compressed[:-8], -15)
+
+
+def iter_records(path, block_offsets):
+    '''(line, start address, end address) of every record of a BGZF VCF, block_offsets is filled while reading'''
+    line, start = b'', None
+    for block, (offset, data) in enumerate(read_blocks(path)):
+        block_offsets.append(offset)
+        position = 0
+        while position < len(data):
+            if not line:
+                start = (block, position)
+            newline = data.find(b'\n', position)
+            if newline < 0:
+                line += data[position:]
+                break
+            line += data[position:newline + 1]
+            position = newline + 1
+            # a full block is written as soon as it fills, so the next address is the start of the next block
+            end = (block + 1, 0) if position == BLOCK_SIZE else (block, position)
+            yield line.decode(), start, end
+            line = b''
+
+
+def index_vcf(path):
+    '''builds the index of an existing BGZF VCF by reading it, for outputs that were not written with VcfWriter
+    returns the index path'''
+    max_length = 0
+    block_offsets = []
+    for line, start, end in iter_records(path, block_offsets):
+        if not line.startswith('#'):
+            max_length = max(max_length, record_span(line)[2])
+    indexer = VcfIndexer(max_length)
+    block_offsets = []
+    for line, start, end in iter_records(path, block_offsets):
+        if not line.startswith('#'):
+            indexer.add(line, start, end)
+    block_offsets.append(os.path.getsize(path))
+
+    return write_index(path, indexer, lambda address: (block_offsets[address[0]] << 16) | address[1])
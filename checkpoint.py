@@ -0,0 +1,115 @@
+'''Checkpoints of long running annotation, so that a pre-empted run can be continued with --resume.
+A checkpoint is kept next to the BGZF output as <output>.ckpt and records how many input records
+are complete and the size of the output after them. The output is flushed to a block boundary before
+every checkpoint, so on resume it is truncated to that size and appended to, and the result is
+identical to an uninterrupted run.
+The checkpoint also records the size and a digest of the start and end of the input together with the
+parameters of the run, and is only resumed when both are unchanged.
+Completed units of work that precede writing (e.g. panel of normal count shards) are appended to
+<output>.ckpt.shards as one json line each.
+'''
+import os
+import json
+import hashlib
+from bgzf import VcfWriter
+
+DEFAULT_INTERVAL = 10000 # records between checkpoints
+DIGEST_BYTES = 1 << 20 # bytes read from each end of the input for its digest
+
+def input_fingerprint(path):
+    '''size and sha256 of the first and last DIGEST_BYTES of a file.
+    Unlike the modification time this stays the same when an intermediate input is written again with the same content'''
+    size = os.path.getsize(path)
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        digest.update(f.read(DIGEST_BYTES))
+        if size > DIGEST_BYTES:
+            f.seek(max(DIGEST_BYTES, size - DIGEST_BYTES))
+            digest.update(f.read())
+
+    return {'size': size, 'sha256': digest.hexdigest()}
+
+
+class Checkpoint():
+    def __init__(self, output, input, interval=DEFAULT_INTERVAL, params=None):
+        self.output = output
+        self.input = os.path.abspath(input)
+        self.params = params or dict()
+        self._fingerprint = None
+        self.interval = max(1, interval)
+        self.path = output + '.ckpt'
+        self.shard_path = output + '.ckpt.shards'
+        self.records = 0
+        self.offset = 0
+
+    def __repr__(self):
+        return f'Checkpoint({self.path}, records={self.records})'
+
+    def load(self):
+        '''reads the last checkpoint, returns False when there is none to resume from'''
+        if not os.path.isfile(self.path) or not os.path.isfile(self.output):
+            return False
+        with open(self.path) as f:
+            state = json.load(f)
+        if state['input'] != self.input:
+            raise ValueError(f'{self.path} was written for {state["input"]}, not {self.input}')
+        if state.get('fingerprint') != self.fingerprint():
+            raise ValueError(f'{self.input} changed since {self.path} was written, run without --resume')
+        if state.get('params') != self.params:
+            raise ValueError(f'{self.path} was written with {state.get("params")}, not {self.params}, run without --resume')
+        if os.path.getsize(self.output) < state['offset']:
+            raise ValueError(f'{self.output} is shorter than its checkpoint {self.path}')
+        self.records = state['records']
+        self.offset = state['offset']
+
+        return True
+
+    def fingerprint(self):
+        '''fingerprint of the input, computed once per run'''
+        if self._fingerprint is None:
+            self._fingerprint = input_fingerprint(self.input)
+        return self._fingerprint
+
+    def open_output(self, resume=False):
+        '''BGZF writer of the VCF output that indexes it on close, truncated to the last checkpoint when resuming'''
+        return VcfWriter(self.output, offset=self.offset if resume else None)
+
+    def save(self, writer):
+        '''flushes writer to a block boundary and records the current position'''
+        writer.flush()
+        os.fsync(writer.handle.fileno())
+        self.offset = writer.tell()
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'input': self.input, 'fingerprint': self.fingerprint(), 'params': self.params, 'records': self.records, 'offset': self.offset}, f)
+        os.replace(temp_path, self.path)
+
+    def advance(self, writer):
+        '''marks one more record as written, saving a checkpoint every interval records'''
+        self.records += 1
+        if self.records % self.interval == 0:
+            self.save(writer)
+
+    def completed_shards(self):
+        '''{key: result} of the shards saved with save_shard'''
+        shards = dict()
+        if os.path.isfile(self.shard_path):
+            with open(self.shard_path) as f:
+                for line in f:
+                    if line.endswith('\n'): # a line cut short by pre-emption is recomputed
+                        shard = json.loads(line)
+                        shards[shard['key']] = shard['result']
+
+        return shards
+
+    def save_shard(self, key, result):
+        with open(self.shard_path, 'a') as f:
+            f.write(json.dumps({'key': key, 'result': result}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def remove(self):
+        '''removes the checkpoint files once the output is complete'''
+        for path in [self.path, self.shard_path]:
+            if os.path.isfile(path):
+                os.remove(path)
@@ -0,0 +1,142 @@
+'''Decoder for the CSQ INFO field written by VEP, shared by annotate_vcf.py, tidy_annotated_vcf.py and svAnnotate.py.
+Field positions are resolved once from the Format: string of the ##INFO=<ID=CSQ> header line,
+so parsing follows the VEP flags that were actually used instead of hard coded indices.
+Fields of an annotation are only extracted when they are accessed.
+'''
+import re
+
+# CSQ layout produced by annotate_vcf.vep_command, used when no header is available
+DEFAULT_CSQ_FORMAT = ('Allele|Consequence|IMPACT|SYMBOL|Gene|Feature_type|Feature|BIOTYPE|EXON|INTRON|HGVSc|HGVSp|'
+    'cDNA_position|CDS_position|Protein_position|Amino_acids|Codons|Existing_variation|ALLELE_NUM|DISTANCE|STRAND|FLAGS|'
+    'PICK|VARIANT_CLASS|SYMBOL_SOURCE|HGNC_ID|CANONICAL|TSL|CCDS|ENSP|SWISSPROT|TREMBL|UNIPARC|RefSeq|GENE_PHENO|NEAREST|'
+    'SIFT|PolyPhen|DOMAINS|HGVS_OFFSET|AF|AFR_AF|AMR_AF|EAS_AF|EUR_AF|SAS_AF|AA_AF|EA_AF|gnomAD_AF|gnomAD_AFR_AF|'
+    'gnomAD_AMR_AF|gnomAD_ASJ_AF|gnomAD_EAS_AF|gnomAD_FIN_AF|gnomAD_NFE_AF|gnomAD_OTH_AF|gnomAD_SAS_AF|MAX_AF|MAX_AF_POPS|'
+    'CLIN_SIG|SOMATIC|PHENO|PUBMED|MOTIF_NAME|MOTIF_POS|HIGH_INF_POS|MOTIF_SCORE_CHANGE')
+
+
+def nth_field(annotation, n):
+    '''n-th (0-based) | delimited field of a single annotation, found by scanning for delimiters instead of splitting'''
+    start = 0
+    for _ in range(n):
+        start = annotation.find('|', start) + 1
+        if start == 0:
+            raise IndexError(f'annotation has less than {n + 1} fields')
+    end = annotation.find('|', start)
+
+    return annotation[start:] if end < 0 else annotation[start:end]
+
+
+def csq_format(header):
+    '''CSQ field names from the Format: string of a CSQ header line, description or whole vcf header'''
+    match = re.search(r'Format: ([^"\n>]+)', header)
+    if match is None:
+        print('Cannot find the CSQ Format in the VCF header. Probably NOT VEP annotated.')
+        raise ValueError
+    return match.group(1).strip().split('|')
+
+
+class CSQRecord():
+    '''a single VEP annotation, fields are extracted lazily by name'''
+    __slots__ = ('decoder', 'annotation', '_values')
+
+    def __init__(self, decoder, annotation):
+        self.decoder = decoder
+        self.annotation = annotation
+        self._values = None
+
+    def __repr__(self):
+        return f'CSQRecord({self.annotation})'
+
+    def __str__(self):
+        return self.annotation
+
+    def __getitem__(self, name):
+        index = self.decoder.index[name]
+        if self._values is not None:
+            return self._values[index]
+        return nth_field(self.annotation, index)
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def get(self, name, default=''):
+        '''value of a field, default if the field is not part of the CSQ format'''
+        if name not in self.decoder.index:
+            return default
+        return self[name]
+
+    def values(self):
+        '''all field values, split once and kept for further access'''
+        if self._values is None:
+            self._values = self.annotation.split('|')
+        return self._values
+
+
+class CSQDecoder():
+    '''resolves CSQ field positions once and decodes annotations of that layout'''
+    def __init__(self, fields):
+        self.fields = list(fields)
+        self.index = {name: i for i, name in enumerate(self.fields)}
+
+    def __repr__(self):
+        return f'CSQDecoder({len(self.fields)} fields)'
+
+    @classmethod
+    def from_header(cls, header):
+        '''decoder from a CSQ header line, its description or a whole vcf header'''
+        return cls(csq_format(header))
+
+    @classmethod
+    def from_vcf(cls, vcf_handle):
+        '''decoder from the header of an open cyvcf2.VCF'''
+        return cls.from_header(vcf_handle.raw_header)
+
+    @classmethod
+    def default(cls):
+        return cls(DEFAULT_CSQ_FORMAT.split('|'))
+
+    def select(self, csq_string, name, value):
+        '''first annotation whose field `name` equals value, otherwise the first annotation.
+        Occurrences of |value are located with str.find and the field position is confirmed by counting
+        the delimiters before it, so annotations are never split'''
+        index = self.index.get(name)
+        if index == 0:
+            for annotation in csq_string.split(','):
+                if nth_field(annotation, 0) == value:
+                    return annotation
+        elif index is not None:
+            token = '|' + value
+            i = csq_string.find(token)
+            while i >= 0:
+                end = i + len(token)
+                if end == len(csq_string) or csq_string[end] in '|,':
+                    start = csq_string.rfind(',', 0, i) + 1
+                    if csq_string.count('|', start, i + 1) == index:
+                        stop = csq_string.find(',', end)
+                        return csq_string[start:] if stop < 0 else csq_string[start:stop]
+                i = csq_string.find(token, end)
+
+        comma = csq_string.find(',')
+        return csq_string if comma < 0 else csq_string[:comma]
+
+    def canonical(self, csq_string):
+        '''annotation of the canonical transcript. If there is no canonical transcript,
+        which is usually the case for intergenic, the first annotation'''
+        return self.select(csq_string, 'CANONICAL', 'YES')
+
+    def picked(self, csq_string):
+        '''annotation flagged by --flag_pick_allele, otherwise the first annotation'''
+        return self.select(csq_string, 'PICK', '1')
+
+    def decode(self, annotation):
+        return CSQRecord(self, annotation)
+
+    def decode_all(self, csq_string):
+        return [CSQRecord(self, annotation) for annotation in csq_string.split(',')]
+
+    def field(self, annotation, name):
+        '''a single field of an annotation without decoding the rest'''
+        return nth_field(annotation, self.index[name])
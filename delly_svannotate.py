@@ -4,30 +4,100 @@ import cyvcf2
 import re
 import argparse
 import os
+import sys
+import concurrent.futures
+from regions import has_index, read_regions, region_variants
+from metrics import metrics, file_size, configure as configure_metrics
 
 def argument_parser():
     parser = argparse.ArgumentParser(description='Writes a TSV file with break point annotations and orientations')
-    parser.add_argument('-i', '--input_vcf', help='Input delly vcf to be annotated. Must have CHR2= and END= in the INFO column')
+    parser.add_argument('-i', '--input_vcf', nargs='+', help='Input delly vcfs to be annotated. Must have CHR2= and END= in the INFO column. Breakpoints shared by several vcfs are annotated once')
     parser.add_argument('--header', help='Do not write header if 0', type=int, default=1)
     parser.add_argument('-o', '--output_dir',help='Output directory', default=os.getcwd())
+    parser.add_argument('-e', '--engine', default='vep', choices=['vep', 'native'], help='vep: annotate with VEP, native: annotate from a gene index compiled with gene_index.py. Default=vep')
+    parser.add_argument('-x', '--gene_index', default=None, help='Gene index compiled with gene_index.py, required for --engine native')
+    parser.add_argument('-d', '--cluster_distance', type=int, default=0, help='Breakpoints within this many bp of the first breakpoint of their cluster, across all input vcfs, are annotated once, with the annotation of that first breakpoint. Default=0, only identical breakpoints')
+    parser.add_argument('-r', '--regions', default=None, help='Only annotate SVs whose first breakpoint is in these regions, a BED file or comma separated chr:start-end. Requires a tabix indexed input')
+    parser.add_argument('-s', '--server', default=None, help='Unix socket of a running annotation_server.py, used by --engine vep instead of starting VEP')
+    parser.add_argument('-f', '--reference', default=DEFAULT_REFERENCE, help='Reference fasta')
+    parser.add_argument('-t', '--threads', '--workers', dest='workers', type=int, default=1, help='Number of chunks of unique breakpoints (requests with --server) annotated concurrently, and of input vcfs read concurrently. Default=1')
+    parser.add_argument('-c', '--combined', default=None, help='Write a single table with the input vcf name in the first column to this file in the output directory, instead of one .svanno.txt per input vcf')
+    parser.add_argument('--metrics', default=None, help='Write time per stage, external tool runs, records, bytes and peak memory of the run to this JSON file')
+    parser.add_argument('--profile', action='store_true', help='Sample the hot loops and add their most frequent frames to --metrics')
 
     args = vars(parser.parse_args())
-    return args['input_vcf'], bool(args['header']), args['output_dir']
+    if args['engine'] == 'native' and args['gene_index'] is None:
+        parser.error('--engine native requires --gene_index')
+    return (args['input_vcf'], bool(args['header']), args['output_dir'], args['engine'], args['gene_index'], args['regions'], args['cluster_distance'], args['server'],
+        args['reference'], args['workers'], args['combined'], args['metrics'], args['profile'])
+
+def read_svs(vcfpath, regions=None):
+    '''(bp1, bp2, svtype, orientation) of every SV of a delly vcf'''
+    svs = []
+    for variant in region_variants(cyvcf2.VCF(vcfpath), regions):
+        bp1 = f'{variant.CHROM}:{variant.POS}-{variant.POS + 1}'
+        bp2 = f"{variant.INFO.get('CHR2')}:{variant.INFO.get('END')}-{variant.INFO.get('END')+1}"
+        orientation = variant.INFO.get('CT')
+        svtype = variant.INFO.get('SVTYPE')
+        svs.append((bp1, bp2, svtype, orientation))
+
+    return svs
+
+def sv_lines(svs, annotations):
+    for (bp1, bp2, svtype, orientation), (bp1_annotation, bp2_annotation) in zip(svs, annotations):
+        yield f"{bp1}\t{bp2}\t{svtype}\t{orientation}\t{bp1_annotation}\t{bp2_annotation}\n"
 
 def main():
-    vcfpath, header, output_dir = argument_parser()
-    outputbasename = os.path.basename(vcfpath) + '.svanno.txt' 
-    outputfile = os.path.join(output_dir, outputbasename)
-    
-    with open(outputfile ,'w') as f:
-        for variant in cyvcf2.VCF(vcfpath):
-            bp1 = f'{variant.CHROM}:{variant.POS}-{variant.POS + 1}'
-            bp2 = f"{variant.INFO.get('CHR2')}:{variant.INFO.get('END')}-{variant.INFO.get('END')+1}"
-            orientation = variant.INFO.get('CT')
-            svtype = variant.INFO.get('SVTYPE')
-            bp1_annotation, bp2_annotation = sv_annotation(bp1, bp2, '/home/users/data/01_reference/human_g1k_v37/human_g1k_v37.fasta')
-            f.write(f"{bp1}\t{bp2}\t{svtype}\t{orientation}\t{bp1_annotation}\t{bp2_annotation}\n")
+    vcfpaths, header, output_dir, engine, gene_index, regions, cluster_distance, server, reference, workers, combined, metrics_path, profile = argument_parser()
+    configure_metrics(metrics_path, profile)
+    if regions:
+        for vcfpath in vcfpaths:
+            if not has_index(vcfpath):
+                print(f'{vcfpath} needs a tabix index to use --regions\nExiting...')
+                sys.exit(1)
+        regions = read_regions(regions)
+
+    with metrics().stage('read_svs') as stage, concurrent.futures.ThreadPoolExecutor(max(1, workers)) as executor:
+        cohort = list(executor.map(lambda vcfpath: read_svs(vcfpath, regions), vcfpaths))
+        stage.records += sum(len(svs) for svs in cohort)
+        stage.bytes_read += sum(file_size(vcfpath) for vcfpath in vcfpaths)
+
+    # breakpoints of all vcfs are deduplicated together and each unique breakpoint is annotated once
+    pairs = [(bp1, bp2) for svs in cohort for bp1, bp2, svtype, orientation in svs]
+    print(f'{len(pairs)} SVs in {len(vcfpaths)} vcfs, {len(set(bp for pair in pairs for bp in pair))} unique breakpoints')
+    try:
+        annotations = sv_annotations(pairs, reference, engine, gene_index, cluster_distance, server, workers)
+    except ValueError as error:
+        print(error)
+        print('Exiting...')
+        sys.exit(1)
+
+    # annotations are handed back to the vcfs in the order their SVs were collected
+    sample_annotations = []
+    start = 0
+    for svs in cohort:
+        sample_annotations.append(annotations[start:start + len(svs)])
+        start += len(svs)
+
+    with metrics().stage('write') as stage:
+        if combined:
+            outputfile = os.path.join(output_dir, combined)
+            with open(outputfile, 'w') as f:
+                for vcfpath, svs, annotation in zip(vcfpaths, cohort, sample_annotations):
+                    for line in sv_lines(svs, annotation):
+                        f.write(os.path.basename(vcfpath) + '\t' + line)
+            stage.records += len(pairs)
+            stage.bytes_written += file_size(outputfile)
+            return
+
+        for vcfpath, svs, annotation in zip(vcfpaths, cohort, sample_annotations):
+            outputbasename = os.path.basename(vcfpath) + '.svanno.txt' 
+            outputfile = os.path.join(output_dir, outputbasename)
+            with open(outputfile ,'w') as f:
+                for line in sv_lines(svs, annotation):
+                    f.write(line)
+            stage.records += len(svs)
+            stage.bytes_written += file_size(outputfile)
 
 if __name__=='__main__':
     main()
-
@@ -0,0 +1,206 @@
+'''Filter expressions over VCF records, used by pon_filter.py
+e.g. PON_VAF < 0.02 && PON_DEPTH >= 100 && MAX_AF < 0.001
+
+    expression := term (|| term)*
+    term       := factor (&& factor)*
+    factor     := ! factor | ( expression ) | operand OP operand
+    OP         := < <= > >= == !=
+    operand    := number | 'string' | "string" | field
+    field      := INFO/NAME | FORMAT/NAME[sample index] | CSQ/NAME | NAME
+
+A bare NAME is looked up in INFO first, then in the CSQ format of the canonical VEP annotation.
+Expressions are compiled once against the VCF header into nested closures.
+Comparisons with a missing value are false.
+'''
+import operator
+import re
+import numpy as np
+from csq import CSQDecoder
+
+OPERATORS = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge, '==': operator.eq, '!=': operator.ne}
+TOKEN = re.compile(r'''\s*(?:(\|\||&&|<=|>=|==|!=|<|>|!|\(|\))|('[^']*'|"[^"]*")|([A-Za-z_][\w.]*(?:/[\w.]+)?(?:\[\d+\])?)|([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?))''')
+
+
+def tokenize(expression):
+    '''[(kind, text)] with kind one of op, string, field, number'''
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKEN.match(expression, position)
+        if match is None or match.end() == position:
+            raise ValueError(f'Cannot parse expression at: {expression[position:]}')
+        kind = ['op', 'string', 'field', 'number'][match.lastindex - 1]
+        tokens.append((kind, match.group(match.lastindex)))
+        position = match.end()
+
+    return tokens
+
+
+def number(value):
+    '''float of a VCF value, first value of multiple (tuple or & separated), None if missing'''
+    if isinstance(value, tuple):
+        value = value[0] if value else None
+    if isinstance(value, str):
+        value = value.split('&')[0]
+        if value in ('', '.'):
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return value
+    if value is None:
+        return None
+    if isinstance(value, (float, np.floating)):
+        # htslib keeps Float fields in single precision, 0.3 is read as 0.30000001192092896.
+        # The shortest decimal of the single precision value is what the VCF holds
+        value = float(str(np.float32(value)))
+    value = float(value)
+    return None if value != value else value # nan is missing
+
+
+class RecordContext():
+    '''per record cache of the decoded canonical CSQ annotation, so it is only decoded once per record'''
+    __slots__ = ('variant', '_annotation')
+
+    def __init__(self, variant):
+        self.variant = variant
+        self._annotation = None
+
+    def annotation(self, decoder):
+        if self._annotation is None:
+            csq = self.variant.INFO.get('CSQ')
+            self._annotation = decoder.decode(decoder.canonical(csq)) if csq else False
+        return self._annotation
+
+
+class FilterExpression():
+    '''compiled filter expression, calling it with a cyvcf2 Variant returns True when the record passes'''
+    def __init__(self, expression, vcf_handle):
+        self.expression = expression
+        self.info_ids = set()
+        self.format_ids = set()
+        for record in vcf_handle.header_iter():
+            if record['HeaderType'] == 'INFO':
+                self.info_ids.add(record['ID'])
+            elif record['HeaderType'] == 'FORMAT':
+                self.format_ids.add(record['ID'])
+        try:
+            self.decoder = CSQDecoder.from_vcf(vcf_handle) if 'CSQ' in self.info_ids else None
+        except ValueError:
+            self.decoder = None
+        self.tokens = tokenize(expression)
+        self.position = 0
+        self.predicate = self.parse_or()
+        if self.position != len(self.tokens):
+            raise ValueError(f'Unexpected {self.tokens[self.position][1]} in expression: {expression}')
+
+    def __repr__(self):
+        return f'FilterExpression({self.expression})'
+
+    def __call__(self, variant):
+        return self.predicate(RecordContext(variant))
+
+    def peek(self):
+        return self.tokens[self.position][1] if self.position < len(self.tokens) else None
+
+    def take(self):
+        if self.position >= len(self.tokens):
+            raise ValueError(f'Unexpected end of expression: {self.expression}')
+        self.position += 1
+        return self.tokens[self.position - 1]
+
+    def parse_or(self):
+        terms = [self.parse_and()]
+        while self.peek() == '||':
+            self.take()
+            terms.append(self.parse_and())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda context: any(term(context) for term in terms)
+
+    def parse_and(self):
+        factors = [self.parse_factor()]
+        while self.peek() == '&&':
+            self.take()
+            factors.append(self.parse_factor())
+        if len(factors) == 1:
+            return factors[0]
+        return lambda context: all(factor(context) for factor in factors)
+
+    def parse_factor(self):
+        if self.peek() == '!':
+            self.take()
+            factor = self.parse_factor()
+            return lambda context: not factor(context)
+        if self.peek() == '(':
+            self.take()
+            inner = self.parse_or()
+            if self.take()[1] != ')':
+                raise ValueError(f'Missing ) in expression: {self.expression}')
+            return inner
+        left = self.parse_operand()
+        kind, op = self.take()
+        if op not in OPERATORS:
+            raise ValueError(f'Expected a comparison instead of {op} in expression: {self.expression}')
+        right = self.parse_operand()
+        compare = OPERATORS[op]
+
+        def comparison(context):
+            a, b = left(context), right(context)
+            if a is None or b is None:
+                return False
+            try:
+                return compare(a, b)
+            except TypeError:
+                return False # number compared to text
+        return comparison
+
+    def parse_operand(self):
+        kind, text = self.take()
+        if kind == 'number':
+            value = float(text)
+            return lambda context: value
+        elif kind == 'string':
+            value = text[1:-1]
+            return lambda context: value
+        elif kind == 'field':
+            return self.field_getter(text)
+        raise ValueError(f'Expected a value instead of {text} in expression: {self.expression}')
+
+    def field_getter(self, name):
+        '''function returning the value of a field for a record context'''
+        match = re.fullmatch(r'(?:(INFO|FORMAT|FMT|CSQ)/)?([\w.]+)(?:\[(\d+)\])?', name)
+        if match is None:
+            raise ValueError(f'Cannot parse field {name}')
+        namespace, field, sample = match.group(1), match.group(2), int(match.group(3) or 0)
+
+        if namespace in ('FORMAT', 'FMT'):
+            if field not in self.format_ids:
+                raise ValueError(f'{field} is not a FORMAT field of the VCF')
+            if field == 'GT':
+                def genotype(context):
+                    *alleles, phased = context.variant.genotypes[sample]
+                    return ('|' if phased else '/').join('.' if allele < 0 else str(allele) for allele in alleles)
+                return genotype
+            def format_value(context):
+                values = context.variant.format(field)
+                if values is None:
+                    return None
+                value = values[sample]
+                return number(value if isinstance(value, str) else tuple(value))
+            return format_value
+
+        if namespace == 'INFO' or (namespace is None and field in self.info_ids):
+            if field not in self.info_ids:
+                raise ValueError(f'{field} is not an INFO field of the VCF')
+            return lambda context: number(context.variant.INFO.get(field))
+
+        if self.decoder is not None and field in self.decoder.index:
+            decoder = self.decoder
+            def csq_value(context):
+                annotation = context.annotation(decoder)
+                return number(annotation[field]) if annotation else None
+            return csq_value
+
+        raise ValueError(f'{field} is neither an INFO field nor a CSQ field of the VCF')
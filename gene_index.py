@@ -0,0 +1,281 @@
+'''Local gene/transcript interval index for breakpoint annotation without VEP.
+A GTF or GFF3 is compiled once into per-contig sorted numpy arrays of the canonical transcript
+of every gene, which answer overlap and nearest gene queries for the
+gene|strand|exon|intron|consequence|nearest string used by svAnnotate.
+
+$ python gene_index.py -i Homo_sapiens.GRCh37.87.gtf.gz -o GRCh37.gidx.npz
+'''
+import gzip
+import re
+import argparse
+import numpy as np
+
+FORMAT_VERSION = 1
+UPDOWN_DISTANCE = 5000 # same as VEP default --distance
+CANONICAL_TAGS = {'Ensembl_canonical', 'canonical', 'MANE_Select'}
+SKIPPED_FEATURES = {'CDS', 'start_codon', 'stop_codon', 'UTR', 'five_prime_UTR', 'three_prime_UTR', 'five_prime_utr', 'three_prime_utr', 'Selenocysteine', 'chromosome', 'region', 'biological_region'}
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Compiles a GTF/GFF3 into a gene interval index for svAnnotate --engine native')
+    parser.add_argument('-i', '--input', required=True, help='GTF or GFF3 gene annotation, optionally gzipped')
+    parser.add_argument('-o', '--output', required=True, help='Output index file (.npz)')
+
+    args = vars(parser.parse_args())
+    return args['input'], args['output']
+
+
+def parse_attributes(attribute_string):
+    '''attributes column of a GTF (key "value";) or GFF3 (key=value;) line as a dict of lists'''
+    attributes = dict()
+    if '="' not in attribute_string and re.search(r'^\s*\w+=', attribute_string):
+        for field in attribute_string.strip().strip(';').split(';'):
+            if '=' in field:
+                key, value = field.split('=', 1)
+                attributes.setdefault(key.strip(), []).extend(value.split(','))
+    else:
+        for key, value in re.findall(r'(\S+)\s+"?([^";]*)"?;', attribute_string):
+            attributes.setdefault(key, []).append(value)
+
+    return attributes
+
+
+def strip_prefix(feature_id):
+    '''gene:ENSG... / transcript:ENST... ids of Ensembl GFF3 to plain ids'''
+    return feature_id.split(':', 1)[1] if re.match(r'^(gene|transcript):', feature_id) else feature_id
+
+
+def read_gene_annotation(annotation_file):
+    '''reads genes, transcripts and exons from a GTF or GFF3'''
+    genes = dict()
+    transcripts = dict()
+    opener = gzip.open if annotation_file.endswith('.gz') else open
+    with opener(annotation_file, 'rt') as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 9:
+                continue
+            contig, feature, start, end, strand = fields[0], fields[2], int(fields[3]), int(fields[4]), fields[6]
+            attributes = parse_attributes(fields[8])
+            first = lambda *keys: next((attributes[key][0] for key in keys if key in attributes), None)
+
+            gene_id = first('gene_id')
+            transcript_id = first('transcript_id')
+            if feature in SKIPPED_FEATURES:
+                continue
+            elif feature == 'gene' or feature.endswith('_gene') or feature == 'pseudogene':
+                gene_id = strip_prefix(first('gene_id', 'ID'))
+                genes.setdefault(gene_id, {})
+                genes[gene_id].update({'contig': contig, 'strand': strand,
+                    'name': first('gene_name', 'Name', 'gene') or gene_id,
+                    'biotype': first('gene_biotype', 'gene_type', 'biotype') or ''})
+            elif feature == 'exon':
+                parents = [transcript_id] if transcript_id else [strip_prefix(parent) for parent in attributes.get('Parent', [])]
+                for parent in parents:
+                    transcript = transcripts.setdefault(parent, {'gene_id': None, 'canonical': False, 'exons': []})
+                    transcript['exons'].append((start, end))
+                    if CANONICAL_TAGS.intersection(attributes.get('tag', [])):
+                        transcript['canonical'] = True
+                    if gene_id:
+                        transcript['gene_id'] = gene_id
+                        genes.setdefault(gene_id, {'contig': contig, 'strand': strand,
+                            'name': first('gene_name') or gene_id, 'biotype': first('gene_biotype', 'gene_type') or ''})
+            elif transcript_id or 'Parent' in attributes:
+                # transcript level features (transcript, mRNA, lnc_RNA, ...)
+                if transcript_id is None:
+                    transcript_id = strip_prefix(first('transcript_id', 'ID') or '')
+                    gene_id = strip_prefix(attributes['Parent'][0])
+                transcript = transcripts.setdefault(transcript_id, {'gene_id': None, 'canonical': False, 'exons': []})
+                transcript['gene_id'] = gene_id
+                if CANONICAL_TAGS.intersection(attributes.get('tag', [])) or first('is_canonical') in ('1', 'true'):
+                    transcript['canonical'] = True
+
+    return genes, transcripts
+
+
+def canonical_transcripts(genes, transcripts):
+    '''picks one transcript per gene: tagged as canonical, otherwise the one with the longest exonic length'''
+    picked = dict()
+    for transcript_id, transcript in transcripts.items():
+        gene_id = transcript['gene_id']
+        if gene_id not in genes or not transcript['exons']:
+            continue
+        rank = (transcript['canonical'], sum(end - start + 1 for start, end in transcript['exons']))
+        if gene_id not in picked or rank > picked[gene_id][0]:
+            picked[gene_id] = (rank, transcript)
+
+    return {gene_id: transcript for gene_id, (rank, transcript) in picked.items()}
+
+
+def compile_gene_index(annotation_file, output):
+    '''compiles a GTF/GFF3 into per-contig arrays of canonical transcripts sorted by start'''
+    genes, transcripts = read_gene_annotation(annotation_file)
+    by_contig = dict()
+    for gene_id, transcript in canonical_transcripts(genes, transcripts).items():
+        gene = genes[gene_id]
+        exons = sorted(set(transcript['exons']))
+        by_contig.setdefault(gene['contig'], []).append((exons[0][0], max(end for start, end in exons), gene, exons))
+
+    arrays = {'format_version': np.array(FORMAT_VERSION), 'contigs': np.array(list(by_contig), dtype=str)}
+    for i, (contig, contig_genes) in enumerate(by_contig.items()):
+        contig_genes.sort(key=lambda gene: (gene[0], gene[1]))
+        exon_counts = [len(exons) for start, end, gene, exons in contig_genes]
+        arrays[f'{i}.start'] = np.array([start for start, end, gene, exons in contig_genes], dtype=np.int64)
+        arrays[f'{i}.end'] = np.array([end for start, end, gene, exons in contig_genes], dtype=np.int64)
+        arrays[f'{i}.strand'] = np.array([-1 if gene['strand'] == '-' else 1 for start, end, gene, exons in contig_genes], dtype=np.int8)
+        arrays[f'{i}.name'] = np.array([gene['name'] for start, end, gene, exons in contig_genes], dtype=str)
+        arrays[f'{i}.coding'] = np.array([gene['biotype'] == 'protein_coding' for start, end, gene, exons in contig_genes], dtype=bool)
+        arrays[f'{i}.exon_offset'] = np.concatenate([[0], np.cumsum(exon_counts)]).astype(np.int64)
+        arrays[f'{i}.exon_start'] = np.array([exon[0] for start, end, gene, exons in contig_genes for exon in exons], dtype=np.int64)
+        arrays[f'{i}.exon_end'] = np.array([exon[1] for start, end, gene, exons in contig_genes for exon in exons], dtype=np.int64)
+
+    with open(output, 'wb') as f:
+        np.savez(f, **arrays)
+    print(f'{sum(len(contig_genes) for contig_genes in by_contig.values())} genes on {len(by_contig)} contigs written to {output}')
+
+    return 0
+
+
+class ContigGenes():
+    '''sorted gene arrays of a single contig'''
+    def __init__(self, arrays, prefix):
+        for name in ['start', 'end', 'strand', 'name', 'coding', 'exon_offset', 'exon_start', 'exon_end']:
+            setattr(self, name, arrays[f'{prefix}.{name}'])
+        self.max_end = np.maximum.accumulate(self.end) if len(self.end) else self.end
+        # index of the gene reaching max_end, the closest upstream gene end of any position
+        self.max_end_gene = np.maximum.accumulate(np.where(self.end == self.max_end, np.arange(len(self.end)), 0))
+        exon_gene = np.repeat(np.arange(len(self.start), dtype=np.int64), np.diff(self.exon_offset))
+        self.exon_key = (exon_gene << 32) | self.exon_start
+        # transcription start sites of protein coding genes for nearest gene queries, as VEP --nearest
+        tss_genes = np.nonzero(self.coding)[0] if self.coding.any() else np.arange(len(self.start))
+        tss = np.where(self.strand[tss_genes] == 1, self.start[tss_genes], self.end[tss_genes])
+        order = np.argsort(tss, kind='stable')
+        self.tss = tss[order]
+        self.tss_gene = tss_genes[order]
+
+
+class GeneIndex():
+    '''queries an index written by compile_gene_index'''
+    def __init__(self, index_file):
+        self.arrays = np.load(index_file)
+        if int(self.arrays['format_version']) != FORMAT_VERSION:
+            print(f'{index_file} was compiled with an incompatible gene_index.py version')
+            raise ValueError
+        self.contig_prefix = {contig: str(i) for i, contig in enumerate(self.arrays['contigs'])}
+        self._contigs = dict()
+
+    def contig(self, contig):
+        if contig not in self._contigs:
+            prefix = self.contig_prefix.get(contig)
+            self._contigs[contig] = ContigGenes(self.arrays, prefix) if prefix is not None else None
+
+        return self._contigs[contig]
+
+    @staticmethod
+    def overlapping_genes(genes, pos):
+        '''indices of genes overlapping a 1-based position'''
+        overlapping = []
+        i = np.searchsorted(genes.start, pos, side='right') - 1
+        while i >= 0 and genes.max_end[i] >= pos:
+            if genes.end[i] >= pos:
+                overlapping.append(i)
+            i -= 1
+
+        return overlapping
+
+    def nearest_genes(self, genes, positions):
+        '''names of the genes with the closest transcription start site to each position'''
+        if len(genes.tss) == 0:
+            return np.full(len(positions), '', dtype=str)
+        right = np.minimum(np.searchsorted(genes.tss, positions), len(genes.tss) - 1)
+        left = np.maximum(right - 1, 0)
+        closest = np.where(np.abs(genes.tss[left] - positions) <= np.abs(genes.tss[right] - positions), left, right)
+        return genes.name[genes.tss_gene[closest]]
+
+    @staticmethod
+    def exon_intron_numbers(genes, gene, positions):
+        '''vectorized exon/intron numbers and exon totals of positions inside the canonical transcript of gene'''
+        k = np.searchsorted(genes.exon_key, (gene << 32) | positions, side='right') - 1
+        n = genes.exon_offset[gene + 1] - genes.exon_offset[gene]
+        local = k - genes.exon_offset[gene]
+        in_exon = genes.exon_end[k] >= positions
+        forward = genes.strand[gene] == 1
+        exon = np.where(in_exon, np.where(forward, local + 1, n - local), 0)
+        intron = np.where(in_exon, 0, np.where(forward, local + 1, n - 1 - local))
+        return exon, intron, n
+
+    def annotate_positions(self, contig, positions):
+        '''gene|strand|exon|intron|consequence|nearest string for each 1-based position of a contig'''
+        positions = np.asarray(positions, dtype=np.int64)
+        genes = self.contig(contig)
+        if genes is None or len(genes.start) == 0:
+            return ['|'.join(['', '', '', '', 'intergenic_variant', '']) for pos in positions]
+
+        nearest = self.nearest_genes(genes, positions).tolist()
+        idx = np.searchsorted(genes.start, positions, side='right') - 1
+        left = np.maximum(idx, 0)
+        covered = (idx >= 0) & (genes.max_end[left] >= positions)
+        previous_max_end = np.where(idx > 0, genes.max_end[np.maximum(idx - 1, 0)], -1)
+        single = covered & (genes.end[left] >= positions) & (previous_max_end < positions)
+
+        # positions within exactly one gene
+        gene = np.full(len(positions), -1, dtype=np.int64)
+        gene[single] = idx[single]
+        exon = np.zeros(len(positions), dtype=np.int64)
+        intron = np.zeros(len(positions), dtype=np.int64)
+        n_exons = np.zeros(len(positions), dtype=np.int64)
+        exon[single], intron[single], n_exons[single] = self.exon_intron_numbers(genes, idx[single], positions[single])
+        consequence = np.where(exon > 0, 'exonic_variant', 'intron_variant').astype(object)
+
+        # intergenic positions: the closest gene end upstream or gene start downstream within UPDOWN_DISTANCE
+        intergenic = ~covered
+        upstream_gene = genes.max_end_gene[left]
+        upstream_distance = np.where(idx >= 0, positions - genes.max_end[left], UPDOWN_DISTANCE + 1)
+        downstream_gene = np.minimum(idx + 1, len(genes.start) - 1)
+        downstream_distance = np.where(idx + 1 < len(genes.start), genes.start[downstream_gene] - positions, UPDOWN_DISTANCE + 1)
+        use_upstream = upstream_distance <= downstream_distance
+        flanking_gene = np.where(use_upstream, upstream_gene, downstream_gene)
+        flanking = intergenic & (np.minimum(upstream_distance, downstream_distance) <= UPDOWN_DISTANCE)
+        # a gene ending before the position is downstream of it on the forward strand
+        is_downstream = (genes.strand[flanking_gene] == 1) == use_upstream
+        gene[flanking] = flanking_gene[flanking]
+        consequence[intergenic] = 'intergenic_variant'
+        consequence[flanking & is_downstream] = 'downstream_gene_variant'
+        consequence[flanking & ~is_downstream] = 'upstream_gene_variant'
+
+        # positions within more than one gene
+        for i in np.nonzero(covered & ~single)[0]:
+            pos = int(positions[i])
+            # prefer a gene whose exon is hit, then protein coding genes, then the longest gene
+            hits = [(self.exon_intron_numbers(genes, g, pos), g) for g in self.overlapping_genes(genes, pos)]
+            (exon[i], intron[i], n_exons[i]), gene[i] = max(hits, key=lambda hit: (hit[0][0] > 0, bool(genes.coding[hit[1]]), genes.end[hit[1]] - genes.start[hit[1]]))
+            consequence[i] = 'exonic_variant' if exon[i] > 0 else 'intron_variant'
+
+        names = genes.name[np.maximum(gene, 0)].tolist()
+        strands = genes.strand[np.maximum(gene, 0)].tolist()
+        annotations = []
+        for i, g in enumerate(gene.tolist()):
+            if g < 0:
+                annotations.append('|'.join(['', '', '', '', consequence[i], nearest[i]]))
+            else:
+                exon_string = f'{exon[i]}/{n_exons[i]}' if exon[i] > 0 else ''
+                intron_string = f'{intron[i]}/{n_exons[i] - 1}' if exon[i] == 0 and consequence[i] == 'intron_variant' else ''
+                annotations.append('|'.join([names[i], str(strands[i]), exon_string, intron_string, consequence[i], nearest[i]]))
+
+        return annotations
+
+    def annotate(self, contig, pos):
+        return self.annotate_positions(contig, [pos])[0]
+
+
+def main():
+    annotation_file, output = argument_parser()
+    compile_gene_index(annotation_file, output)
+
+    return 0
+
+
+if __name__ == '__main__':
+    main()
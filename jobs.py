@@ -0,0 +1,209 @@
+'''Scheduler for the external tools run by the scripts (VEP, samtools, bgzip, tabix, nested scripts).
+Jobs are asyncio subprocesses on one event loop running in a background thread, so they can be submitted
+from any thread and independent jobs run at the same time, up to a concurrency limit.
+Each job has an optional timeout, its exit code is checked with stderr captured for the error message,
+and failed jobs are retried. Every run is recorded in the metrics of the process.
+Jobs whose output is read while they run (VEP streaming to its stdout) are started with popen or stream,
+which hold one of the same slots, so they count against the same concurrency limit.
+'''
+import os
+import time
+import shlex
+import asyncio
+import threading
+import subprocess
+from metrics import metrics, TrackedPopen
+
+DEFAULT_CONCURRENCY = os.cpu_count() or 1
+
+_schedulers = dict()
+
+
+class JobError(RuntimeError):
+    def __init__(self, cmd, returncode, stderr):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.stderr = stderr
+        super().__init__(f'{cmd} failed with exit code {returncode}\n{stderr.rstrip()}')
+
+
+class JobResult():
+    __slots__ = ('cmd', 'returncode', 'stdout', 'stderr')
+
+    def __init__(self, cmd, returncode, stdout, stderr):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+
+    def __repr__(self):
+        return f'JobResult({self.cmd!r}, returncode={self.returncode})'
+
+
+class ScheduledPopen(TrackedPopen):
+    '''TrackedPopen holding a slot of its scheduler until it has been waited for, killed after timeout seconds'''
+    def __init__(self, scheduler, args, timeout=None, **kwargs):
+        scheduler.acquire()
+        self.scheduler = scheduler
+        self.released = False
+        self.timed_out = False
+        self.timer = None
+        try:
+            super().__init__(args, **kwargs)
+        except BaseException:
+            self.release()
+            raise
+        if timeout:
+            self.timer = threading.Timer(timeout, self.expire)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def expire(self):
+        self.timed_out = True
+        self.kill()
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.scheduler.release()
+
+    def wait(self, timeout=None):
+        returncode = super().wait(timeout)
+        if self.timer is not None:
+            self.timer.cancel()
+        self.release()
+        return returncode
+
+
+class Scheduler():
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, timeout=None, retries=0):
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.retries = retries
+        self.loop = asyncio.new_event_loop()
+        self.slots = None
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def __repr__(self):
+        return f'Scheduler(concurrency={self.concurrency}, timeout={self.timeout}, retries={self.retries})'
+
+    async def execute(self, cmd, timeout):
+        '''runs cmd once, killing it after timeout seconds. stdout and stderr are captured as text'''
+        start = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(*shlex.split(cmd), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            metrics().subprocess(cmd, time.perf_counter() - start, process.returncode)
+            return JobResult(cmd, process.returncode, '', f'killed after {timeout} seconds')
+        metrics().subprocess(cmd, time.perf_counter() - start, process.returncode)
+
+        return JobResult(cmd, process.returncode, stdout.decode(), stderr.decode())
+
+    async def acquire_slot(self):
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.concurrency)
+        await self.slots.acquire()
+
+    def acquire(self):
+        '''waits for a free slot from a thread outside the event loop'''
+        asyncio.run_coroutine_threadsafe(self.acquire_slot(), self.loop).result()
+
+    def release(self):
+        self.loop.call_soon_threadsafe(self.slots.release)
+
+    async def job(self, cmd, timeout, retries, check):
+        await self.acquire_slot()
+        try:
+            for attempt in range(1 + retries):
+                result = await self.execute(cmd, timeout)
+                if result.returncode == 0:
+                    return result
+                if attempt < retries:
+                    print(f'{cmd} failed with exit code {result.returncode} (attempt {attempt + 1}/{1 + retries})')
+        finally:
+            self.slots.release()
+        if check:
+            raise JobError(cmd, result.returncode, result.stderr)
+
+        return result
+
+    def submit(self, cmd, timeout=None, retries=None, check=True):
+        '''starts cmd as soon as a slot is free
+        returns a concurrent.futures.Future of its JobResult, which raises JobError if it failed and check is set'''
+        timeout = self.timeout if timeout is None else timeout
+        retries = self.retries if retries is None else retries
+        return asyncio.run_coroutine_threadsafe(self.job(cmd, timeout, retries, check), self.loop)
+
+    def run(self, cmd, timeout=None, retries=None, check=True):
+        '''runs cmd and waits for its JobResult'''
+        return self.submit(cmd, timeout, retries, check).result()
+
+    def run_all(self, cmds, timeout=None, retries=None, check=True):
+        '''runs cmds concurrently and waits for all of them
+        returns their JobResults in the same order'''
+        futures = [self.submit(cmd, timeout, retries, check) for cmd in cmds]
+        return [future.result() for future in futures]
+
+    def popen(self, cmd, timeout=None, **kwargs):
+        '''starts cmd as soon as a slot is free, for a job whose output is read while it runs.
+        The slot is given back when the returned ScheduledPopen is waited for'''
+        timeout = self.timeout if timeout is None else timeout
+        return ScheduledPopen(self, shlex.split(cmd), timeout, **kwargs)
+
+    def stream(self, cmd, consume, timeout=None, retries=None, check=True):
+        '''runs cmd with consume(stdout) reading its output as it is written.
+        consume is called again for every retry and has to start its output over
+        returns the exit code, raises JobError if it failed and check is set'''
+        timeout = self.timeout if timeout is None else timeout
+        retries = self.retries if retries is None else retries
+        for attempt in range(1 + retries):
+            process = self.popen(cmd, timeout, stdout=subprocess.PIPE, universal_newlines=True)
+            try:
+                consume(process.stdout)
+            except BaseException:
+                process.kill()
+                raise
+            finally:
+                process.wait()
+                process.stdout.close()
+            if process.returncode == 0:
+                return 0
+            if attempt < retries:
+                print(f'{cmd} failed with exit code {process.returncode} (attempt {attempt + 1}/{1 + retries})')
+        if check:
+            raise JobError(cmd, process.returncode, f'killed after {timeout} seconds' if process.timed_out else '')
+
+        return process.returncode
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+def configure(concurrency=DEFAULT_CONCURRENCY, timeout=None, retries=0):
+    '''sets the limits of the scheduler shared within the current process'''
+    key = os.getpid()
+    if key in _schedulers:
+        _schedulers.pop(key).close()
+    _schedulers[key] = Scheduler(concurrency, timeout, retries)
+
+    return _schedulers[key]
+
+
+def worker_concurrency(workers):
+    '''concurrency of the scheduler of each of workers processes, so that together they stay within the limit of this process'''
+    return max(1, scheduler().concurrency // max(1, workers))
+
+
+def scheduler():
+    '''the Scheduler shared within the current process (each worker of a process pool has its own)'''
+    key = os.getpid()
+    if key not in _schedulers:
+        _schedulers[key] = Scheduler()
+
+    return _schedulers[key]
@@ -0,0 +1,204 @@
+'''Run metrics of the scripts, written as a JSON report with --metrics.
+Stages are timed with Metrics.stage (wall time and process CPU time, which includes all threads of the process)
+and count the records and bytes they process. Stages can be nested, the time of a stage includes the stages run
+within it. Every external tool run through jobs.py or started with metrics.popen is recorded with its wall time
+and exit code. Peak memory of the process and of its children
+is taken when the report is written, at exit.
+With --profile, stages marked as hot loops are sampled: a thread records the innermost Python frame of the
+stage's thread every few milliseconds, and the most frequent frames are added to the report.
+Metrics are kept per process, workers of a process pool are not included.
+'''
+import os
+import sys
+import json
+import time
+import atexit
+import resource
+import threading
+import subprocess
+import collections
+import contextlib
+
+SAMPLE_INTERVAL = 0.005 # seconds between profile samples
+TOP_FRAMES = 20 # frames reported per profiled stage
+MAX_SUBPROCESSES = 1000 # subprocesses listed one by one, all are counted in the per program summary
+
+_metrics = dict()
+
+
+class StageMetrics():
+    __slots__ = ('calls', 'wall', 'cpu', 'records', 'bytes_read', 'bytes_written')
+
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.records = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def __repr__(self):
+        return f'StageMetrics({self.calls} calls, {self.wall:.3f}s, {self.records} records)'
+
+    def as_dict(self):
+        report = {name: getattr(self, name) for name in self.__slots__}
+        report['records_per_sec'] = self.records / self.wall if self.wall > 0 else None
+        return report
+
+
+class Sampler():
+    '''sampling profiler of a single thread'''
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                code = frame.f_code
+                self.samples[f'{os.path.basename(code.co_filename)}:{frame.f_lineno} {code.co_name}'] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self.samples
+
+
+class TrackedPopen(subprocess.Popen):
+    '''Popen that records its wall time and exit code in the metrics once it has been waited for'''
+    def __init__(self, args, **kwargs):
+        self.started = time.perf_counter()
+        self.recorded = False
+        super().__init__(args, **kwargs)
+
+    def wait(self, timeout=None):
+        returncode = super().wait(timeout)
+        if not self.recorded:
+            self.recorded = True
+            metrics().subprocess(' '.join(self.args) if isinstance(self.args, list) else self.args, time.perf_counter() - self.started, returncode)
+        return returncode
+
+
+class Metrics():
+    def __init__(self, path=None, profile=False):
+        self.path = path
+        self.profile = profile
+        self.started = time.time()
+        self.wall_start = time.perf_counter()
+        self.stages = dict()
+        self.subprocesses = []
+        self.programs = dict()
+        self.profiles = dict()
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return f'Metrics({self.path}, {len(self.stages)} stages, {sum(program["runs"] for program in self.programs.values())} subprocesses)'
+
+    def get(self, name):
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = StageMetrics()
+            return self.stages[name]
+
+    @contextlib.contextmanager
+    def stage(self, name, profile=False):
+        '''times the enclosed block as stage name and yields its StageMetrics to count records and bytes.
+        A hot loop marked with profile is sampled when profiling is on'''
+        stage = self.get(name)
+        sampler = Sampler(threading.get_ident()) if profile and self.profile else None
+        start, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield stage
+        finally:
+            wall, cpu = time.perf_counter() - start, time.process_time() - cpu
+            with self.lock:
+                stage.calls += 1
+                stage.wall += wall
+                stage.cpu += cpu
+            if sampler is not None:
+                samples = sampler.stop()
+                with self.lock:
+                    self.profiles.setdefault(name, collections.Counter()).update(samples)
+
+    def add(self, name, wall=0.0, cpu=0.0, records=0, bytes_read=0, bytes_written=0):
+        '''adds to a stage timed by the caller, e.g. work done in many small pieces or in other threads'''
+        stage = self.get(name)
+        with self.lock:
+            stage.wall += wall
+            stage.cpu += cpu
+            stage.records += records
+            stage.bytes_read += bytes_read
+            stage.bytes_written += bytes_written
+
+    def subprocess(self, cmd, wall, returncode):
+        program = os.path.basename(cmd.split()[0]) if cmd.strip() else cmd
+        with self.lock:
+            if len(self.subprocesses) < MAX_SUBPROCESSES:
+                self.subprocesses.append({'cmd': cmd, 'wall': wall, 'returncode': returncode})
+            summary = self.programs.setdefault(program, {'runs': 0, 'wall': 0.0, 'failed': 0})
+            summary['runs'] += 1
+            summary['wall'] += wall
+            summary['failed'] += returncode != 0
+
+    def report(self):
+        usage, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+        with self.lock:
+            report = {
+                'command': sys.argv,
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'wall': time.perf_counter() - self.wall_start,
+                'cpu': usage.ru_utime + usage.ru_stime,
+                'children_cpu': children.ru_utime + children.ru_stime,
+                'peak_rss_mb': usage.ru_maxrss / 1024, # kilobytes on linux
+                'children_peak_rss_mb': children.ru_maxrss / 1024,
+                'stages': {name: stage.as_dict() for name, stage in self.stages.items()},
+                'programs': dict(self.programs),
+                'subprocesses': list(self.subprocesses),
+            }
+            if self.profiles:
+                report['profiles'] = {name: [{'frame': frame, 'samples': count, 'fraction': count / sum(samples.values())}
+                    for frame, count in samples.most_common(TOP_FRAMES)] for name, samples in self.profiles.items()}
+
+        return report
+
+    def write(self):
+        '''writes the report to path, returns the path or None when metrics are not written'''
+        if not self.path:
+            return None
+        with open(self.path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        return self.path
+
+
+def file_size(path):
+    '''size of a file in bytes, 0 when it does not exist'''
+    return os.path.getsize(path) if path and os.path.isfile(path) else 0
+
+
+def configure(path=None, profile=False):
+    '''sets up the metrics of the current process, written to path at exit when given'''
+    key = os.getpid()
+    _metrics[key] = Metrics(path, profile)
+    if path:
+        atexit.register(_metrics[key].write)
+
+    return _metrics[key]
+
+
+def metrics():
+    '''the Metrics of the current process, not written unless configure was given a path'''
+    key = os.getpid()
+    if key not in _metrics:
+        _metrics[key] = Metrics()
+
+    return _metrics[key]
+
+
+def popen(args, **kwargs):
+    '''subprocess.Popen recorded in the metrics when it is waited for'''
+    return TrackedPopen(args, **kwargs)
@@ -0,0 +1,247 @@
+'''Runs annotate_vcf.py, pon_annotate.py, pon_filter.py and tidy_annotated_vcf.py as one stream.
+VEP stdout is parsed by a cyvcf2 VCF as it is written, and its records, reduced to the canonical annotation,
+go through the panel of normal lookup, the filter and tidy row emission as batches of cyvcf2 records,
+without writing intermediate VCFs in between.
+Each stage runs in its own thread and hands batches to the next one through a bounded queue,
+so memory stays flat regardless of the size of the input.
+'''
+import sys
+import os
+import re
+import argparse
+import time
+import queue
+import threading
+import cyvcf2
+from annotate_vcf import cache_version_mapper, setup_vep_environment, vep_process, DEFAULT_DECODER
+from csq import CSQDecoder
+from pon_annotate import count_shard, add_pon_header, set_pon_info, open_pon_db
+from pon_pileup import pon_panel
+from pon_build import PonDB
+from expression import FilterExpression
+from pon_filter import filter_expression, soft_filter_tag
+from tidy_annotated_vcf import project_columns, open_writer, tidy_records, OUTPUT_SUFFIX
+import bgzf
+from bgzf import VcfWriter
+from metrics import metrics, file_size, configure as configure_metrics
+
+BATCH_SIZE = 1000 # records per batch handed between stages
+QUEUE_SIZE = 4 # batches buffered between two stages
+
+def argument_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input_vcf', required=True, help='Input VCF file to be annotated')
+    parser.add_argument('-o', '--output_dir', required=False, default=os.getcwd(), help='Output directory')
+    parser.add_argument('-g', '--genome_assembly', required=False, default='GRCh37', choices=['GRCh37', 'GRCh38'], help='Genome assembly version, either GRCh37 or GRCh38')
+    parser.add_argument('-d', '--pon_db', required=False, default=None, help='Panel of normal store built with pon_build.py')
+    parser.add_argument('-n', '--normal_bams', required=False, default=None, nargs='+', help='Normal Bams counted when no --pon_db is given')
+    parser.add_argument('-r', '--reference', required=False, default='/home/users/cjyoon/reference/GRCh37/human_g1k_v37.fasta', help='Reference fasta, used with --normal_bams')
+    parser.add_argument('-t', '--vaf_threshold', required=False, type=float, default=None, help='Remove variants where VAF in the panel of normal exceeds the threshold')
+    parser.add_argument('-e', '--expression', required=False, default=None, help='Keep variants for which the expression is true, see pon_filter.py')
+    parser.add_argument('--soft_filter', required=False, default=None, help='Instead of removing variants, add this tag to the FILTER column of variants that fail')
+    parser.add_argument('-s', '--sampleName', required=False, default='NA', help='Sample Name in the VCF column to extract VAF info')
+    parser.add_argument('-f', '--format', required=False, default='tsv', choices=['tsv', 'parquet', 'arrow'], help='Format of the tidy output. Default=tsv')
+    parser.add_argument('-c', '--columns', required=False, nargs='+', default=None, help='Only write these CSQ fields to the tidy output. Default=all')
+    parser.add_argument('--write_vcf', required=False, action='store_true', help='Also write the annotated and filtered records as a bgzipped, tabix indexed VCF')
+    parser.add_argument('-@', '--compress_threads', required=False, default=1, type=int, help='Number of threads compressing the --write_vcf output. Default=1')
+    parser.add_argument('--metrics', required=False, default=None, help='Write time per stage, external tool runs, records, bytes and peak memory of the run to this JSON file')
+    parser.add_argument('--profile', required=False, action='store_true', help='Sample the hot loops and add their most frequent frames to --metrics')
+
+    args = vars(parser.parse_args())
+    return (args['input_vcf'], args['output_dir'], args['genome_assembly'], args['pon_db'], args['normal_bams'], args['reference'],
+        args['vaf_threshold'], args['expression'], args['soft_filter'], args['sampleName'], args['format'], args['columns'], args['write_vcf'], args['compress_threads'],
+        args['metrics'], args['profile'])
+
+def output_prefix(input_vcf, output_dir):
+    '''output path without extension, the same rule for every output of the pipeline'''
+    return os.path.join(output_dir, re.sub(r'\.vcf(\.gz)?$', '', os.path.basename(input_vcf)))
+
+def bounded(stage, maxsize=QUEUE_SIZE):
+    '''runs a generator in its own thread and yields its items through a queue of at most maxsize items.
+    An exception raised in the thread is raised again in the consumer'''
+    handoff = queue.Queue(maxsize)
+    done = object()
+
+    def produce():
+        try:
+            for item in stage:
+                handoff.put(item)
+        except BaseException as error:
+            handoff.put(StageError(error))
+        else:
+            handoff.put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = handoff.get()
+        if item is done:
+            return
+        if isinstance(item, StageError):
+            raise item.error
+        yield item
+
+class StageError():
+    def __init__(self, error):
+        self.error = error
+
+def open_record_stream(vep_stdout, pon=None, soft_filter=None, description=''):
+    '''cyvcf2 VCF parsing the VEP output as it is written, with the PON fields and the ##PON_PANEL line pon
+    when given and the soft filter added to its header. It reads a duplicate of the file descriptor of vep_stdout,
+    so that closing one does not close the other'''
+    try:
+        vcf_handle = cyvcf2.VCF(os.dup(vep_stdout.fileno()))
+    except (OSError, IOError):
+        print('No VCF header in VEP output\nExiting...')
+        sys.exit(1)
+    if pon:
+        add_pon_header(vcf_handle, pon)
+    if soft_filter:
+        vcf_handle.add_filter_to_header({'ID': soft_filter, 'Description': f'Failed {description}'})
+
+    return vcf_handle
+
+def parse_stage(vcf_handle, batch_size=BATCH_SIZE):
+    '''batches of cyvcf2 records of the VEP output, with CSQ reduced to the canonical annotation.
+    The time of a batch includes waiting for VEP to write its records'''
+    try:
+        decoder = CSQDecoder.from_vcf(vcf_handle)
+    except ValueError:
+        decoder = DEFAULT_DECODER
+    batch = []
+    start, cpu = time.perf_counter(), time.thread_time()
+    canonical = 0.0
+    for variant in vcf_handle:
+        canonical_start = time.perf_counter()
+        csq = variant.INFO.get('CSQ')
+        if csq:
+            variant.INFO['CSQ'] = decoder.canonical(csq)
+        canonical += time.perf_counter() - canonical_start
+        batch.append(variant)
+        if len(batch) >= batch_size:
+            metrics().add('parse', time.perf_counter() - start, time.thread_time() - cpu, len(batch))
+            metrics().add('canonical_csq', wall=canonical, records=len(batch))
+            yield batch
+            batch = []
+            start, cpu = time.perf_counter(), time.thread_time()
+            canonical = 0.0
+    if batch:
+        metrics().add('parse', time.perf_counter() - start, time.thread_time() - cpu, len(batch))
+        metrics().add('canonical_csq', wall=canonical, records=len(batch))
+        yield batch
+
+def pon_stage(batches, pon_db=None, normal_bams=None, reference=None):
+    '''adds PON_VAF, PON_DEPTH and PON_VC to every record, looked up in pon_db (a store directory or an opened PonDB) or counted in normal_bams'''
+    db = (pon_db if isinstance(pon_db, PonDB) else PonDB(pon_db)) if pon_db else None
+    for batch in batches:
+        start, cpu = time.perf_counter(), time.thread_time()
+        sites = dict()
+        for variant in batch:
+            sites.setdefault(variant.CHROM, []).append(variant.POS)
+        pon_counts = dict()
+        for contig, positions in sites.items():
+            if db is not None:
+                depths, mismatches = db.lookup(contig, positions)
+                for pos, depth, mismatch in zip(positions, depths.tolist(), mismatches.tolist()):
+                    pon_counts[(contig, pos)] = (depth, mismatch)
+            else:
+                for pos, counts in count_shard('pysam', normal_bams, reference, contig, positions).items():
+                    pon_counts[(contig, pos)] = counts
+        for variant in batch:
+            set_pon_info(variant, *pon_counts[(variant.CHROM, variant.POS)])
+        metrics().add('pon', time.perf_counter() - start, time.thread_time() - cpu, len(batch))
+        yield batch
+
+def filter_stage(batches, keep, vcf_writer=None, soft_filter=None):
+    '''records passing keep, or all records with failing ones tagged when soft_filter is given.
+    Records are also written to vcf_writer when given'''
+    for batch in batches:
+        start, cpu = time.perf_counter(), time.thread_time()
+        kept = []
+        for variant in batch:
+            if keep is None or keep(variant):
+                kept.append(variant)
+            elif soft_filter:
+                soft_filter_tag(variant, soft_filter)
+                kept.append(variant)
+        if vcf_writer is not None:
+            for variant in kept:
+                vcf_writer.write(str(variant))
+        metrics().add('filter', time.perf_counter() - start, time.thread_time() - cpu, len(batch))
+        yield kept
+
+def run_pipeline(input_vcf, output_dir, assembly_version='GRCh37', pon_db=None, normal_bams=None, reference=None,
+    vaf_threshold=None, expression=None, soft_filter=None, sampleName='NA', output_format='tsv', fields=None, write_vcf=False):
+    '''VEP -> panel of normal -> filter -> tidy over one record stream
+    returns the path of the tidy output'''
+    cache_version = cache_version_mapper[assembly_version]
+    prefix = output_prefix(input_vcf, output_dir)
+    vcf_out = prefix + '.annotated.vcf.gz' if write_vcf else None
+    expression = filter_expression(vaf_threshold, expression) or None
+    if pon_db:
+        pon_db = open_pon_db(pon_db, reference)
+    pon = pon_db.panel() if pon_db else pon_panel(normal_bams, reference) if normal_bams else None
+
+    vep_cmd = vep_process(input_vcf, assembly_version, cache_version)
+    # VEP is killed when a stage fails or the run exits early, instead of being left blocked on its stdout
+    try:
+        writer = open_record_stream(vep_cmd.stdout, pon, soft_filter, expression)
+        vcf_writer = None
+        if vcf_out:
+            # BGZF compressed and indexed as records are written
+            vcf_writer = VcfWriter(vcf_out)
+            vcf_writer.write(writer.raw_header)
+        try:
+            keep = FilterExpression(expression, writer) if expression else None
+        except ValueError as error:
+            print(error)
+            print('Exiting...')
+            sys.exit(1)
+
+        batches = bounded(parse_stage(writer))
+        if pon:
+            batches = bounded(pon_stage(batches, pon_db, normal_bams, reference))
+        batches = bounded(filter_stage(batches, keep, vcf_writer, soft_filter))
+        records = (variant for batch in batches for variant in batch)
+
+        columns = project_columns(fields)
+        tidy_output = prefix + OUTPUT_SUFFIX[output_format]
+        tidy_writer = open_writer(tidy_output, columns, output_format)
+        # stages run in their own threads, the time of this stage includes waiting for the stages before it
+        with metrics().stage('tidy', profile=True) as stage:
+            for row in tidy_records(writer, records, sampleName, columns):
+                tidy_writer.write(row)
+                stage.records += 1
+            tidy_writer.close()
+            stage.bytes_read += file_size(input_vcf)
+            stage.bytes_written += file_size(tidy_output)
+        writer.close()
+        if vcf_writer is not None:
+            vcf_writer.close()
+
+        vep_cmd.wait()
+    finally:
+        if vep_cmd.poll() is None:
+            vep_cmd.kill()
+            vep_cmd.wait()
+        vep_cmd.stdout.close()
+
+    if vep_cmd.returncode != 0:
+        print(f'VEP failed with exit code {vep_cmd.returncode}\nExiting...')
+        sys.exit(1)
+    print(f'Tidy Variant Annotation File Ready for Analysis: {tidy_output}')
+
+    return tidy_output
+
+def main():
+    (input_vcf, output_dir, genome_assembly, pon_db, normal_bams, reference, vaf_threshold, expression, soft_filter,
+        sampleName, output_format, fields, write_vcf, compress_threads, metrics_path, profile) = argument_parser()
+    configure_metrics(metrics_path, profile)
+    bgzf.configure(compress_threads)
+    setup_vep_environment()
+    run_pipeline(input_vcf, output_dir, genome_assembly, pon_db, normal_bams, reference, vaf_threshold, expression,
+        soft_filter, sampleName, output_format, fields, write_vcf)
+
+    return 0
+
+if __name__ == '__main__':
+    main()
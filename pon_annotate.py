@@ -1,16 +1,29 @@
 #!/home/users/cjyoon/anaconda3/bin/python
 '''Given a vcf and a list of normal bams, will return VAF of that position in panel of normals an will annotate the VCF with normal VAF
-For each position will run mpileup at a single base. 
+By default allele counts are computed in-process with pysam, walking each normal bam once per window of nearby variants.
+With --engine mpileup, will run mpileup at a single base for each position.
 
 2018.07.09 CJY
 '''
 import sys
 import os
-import subprocess
-import shlex
 import re
 import argparse
+import itertools
+import hashlib
+import json
+import concurrent.futures
 import cyvcf2
+from pon_pileup import count_alleles, depth_and_mismatches, mpileup_vaf, pon_vaf, pon_panel
+from pon_build import PonDB
+from checkpoint import Checkpoint, DEFAULT_INTERVAL
+from previous_annotation import PreviousAnnotation
+from regions import has_index, read_regions, region_variants
+from jobs import scheduler, configure, worker_concurrency
+import bgzf
+from bgzf import VcfWriter
+from metrics import metrics, file_size, configure as configure_metrics
+
 def argument_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input', required=True, help='Input vcf to be annotated with panel of normal')
@@ -18,37 +31,156 @@ def argument_parser():
 
     parser.add_argument('-n', '--normal_bams', help='Normal Bams to calculate panel of normal VAFS', nargs='+')
     parser.add_argument('-o', '--output_dir', required=False, default=os.getcwd(), help='Output directory')
+    parser.add_argument('-e', '--engine', required=False, default='pysam', choices=['pysam', 'mpileup'], help='pysam: count all positions in-process with a single pass over each normal bam per window, mpileup: run samtools mpileup for every variant. Default=pysam')
+    parser.add_argument('-t', '--threads', '--workers', dest='workers', required=False, default=1, type=int, help='Number of worker processes. Work is split by contig and by subsets of normal bams. Default=1')
+    parser.add_argument('--bam_shards', required=False, default=1, type=int, help='Number of subsets the normal bams are split into for parallel counting. Default=1')
+    parser.add_argument('-d', '--pon_db', required=False, default=None, help='Panel of normal store built with pon_build.py. Looked up instead of counting normal bams')
+    parser.add_argument('--checkpoint', required=False, default=None, type=int, help='Save a checkpoint every this many records, so that an interrupted run can be continued with --resume')
+    parser.add_argument('--resume', required=False, action='store_true', help='Continue from the last checkpoint of a previous run with --checkpoint')
+
+    parser.add_argument('-p', '--previous', required=False, default=None, help='Previously annotated, tabix indexed vcf.gz with PON fields, annotated with the same normal bams and reference. Values of records with the same CHROM, POS, REF and ALT are reused and only the other positions are counted')
+    parser.add_argument('--regions', required=False, default=None, help='Only annotate and count variants in these regions, a BED file or comma separated chr:start-end. Requires a tabix indexed input')
+    parser.add_argument('-@', '--compress_threads', required=False, default=1, type=int, help='Number of threads compressing the output vcf.gz. Default=1')
+    parser.add_argument('--metrics', required=False, default=None, help='Write time per stage, external tool runs, records, bytes and peak memory of the run to this JSON file')
+    parser.add_argument('--profile', required=False, action='store_true', help='Sample the hot loops and add their most frequent frames to --metrics')
 
     args = vars(parser.parse_args())
+    if args['resume'] and not args['checkpoint']:
+        args['checkpoint'] = DEFAULT_INTERVAL
 
-    return args['input'], args['normal_bams'], args['output_dir'], args['reference']
+    return args['input'], args['normal_bams'], args['output_dir'], args['reference'], args['engine'], args['workers'], args['bam_shards'], args['pon_db'], args['checkpoint'], args['resume'], args['previous'], args['regions'], args['compress_threads'], args['metrics'], args['profile']
+
+def mpileup_command(normal_bam_list, query_position, reference):
+	bamlistString = '\t'.join(normal_bam_list)
+	return f'samtools mpileup -Q 0 -q 0 -f {reference} -r {query_position} {bamlistString}'
 
 def calculate_vaf(normal_bam_list, query_position, reference):
 	'''calculates the VAF in the normal Bams in the list of a given query_position'''
-	bamlistString = '\t'.join(normal_bam_list)
-	cmd = f'samtools mpileup -Q 0 -q 0 -f {reference} -r {query_position} {bamlistString}'
-	mpileup = subprocess.check_output(shlex.split(cmd), stderr=subprocess.DEVNULL)
-	split_mpileup = mpileup.decode("utf-8").split('\t'); #print(split_mpileup)
-	totalDepth = 0 
-	mismatches = 0
-	totalCharacters = 0
-	for i in range(0, int(len(split_mpileup)/3) -1 ):
-		bases = 3*i + 1
-		depths = 3*i + 3
-		totalDepth += int(split_mpileup[depths])
-		baseAStringCount = split_mpileup[bases].upper().count('A')
-		baseTStringCount = split_mpileup[bases].upper().count('T')
-		baseGStringCount = split_mpileup[bases].upper().count('G')
-		baseCStringCount = split_mpileup[bases].upper().count('C')
-		mismatchCount = baseAStringCount + baseTStringCount + baseGStringCount + baseCStringCount
-		mismatches += mismatchCount
-
-	return round(float(mismatches/totalDepth), 3), totalDepth, mismatches
+	mpileup = scheduler().run(mpileup_command(normal_bam_list, query_position, reference)).stdout
+	return mpileup_vaf(mpileup)
 
-def main():
-    vcf, normal_bams, output_dir, reference = argument_parser()
-    
-    vcf_handle = cyvcf2.VCF(vcf)
+def collect_sites(vcf, skip=None, regions=None):
+    '''positions of all variants in the vcf (in regions when given) except those in skip, grouped by contig in order of appearance'''
+    sites = dict()
+    for variant in region_variants(cyvcf2.VCF(vcf), regions):
+        if skip is None or (variant.CHROM, variant.POS) not in skip:
+            sites.setdefault(variant.CHROM, []).append(variant.POS)
+
+    return sites
+
+def count_shard(engine, normal_bams, reference, contig, positions):
+    '''depth and mismatches summed over normal_bams for positions of a single contig
+    returns {POS: (depth, mismatches)}'''
+    shard_counts = dict()
+    if engine == 'pysam':
+        for pos, (refbase, allele_counts, depth) in count_alleles(normal_bams, reference, contig, positions).items():
+            shard_counts[pos] = depth_and_mismatches(refbase, allele_counts, depth)
+    else:
+        # mpileup of every position is submitted at once, the scheduler runs them concurrently
+        unique_positions = sorted(set(positions))
+        results = scheduler().run_all([mpileup_command(normal_bams, f'{contig}:{pos}-{pos}', reference) for pos in unique_positions])
+        for pos, result in zip(unique_positions, results):
+            pon_vafs, total_depths, mismatches = mpileup_vaf(result.stdout)
+            shard_counts[pos] = (total_depths, mismatches)
+
+    return shard_counts
+
+def split_bams(normal_bams, bam_shards):
+    '''splits normal bams into at most bam_shards subsets'''
+    bam_shards = max(1, min(bam_shards, len(normal_bams)))
+    return [normal_bams[i::bam_shards] for i in range(bam_shards)]
+
+def shard_key(shard, fingerprint=None):
+    '''key of a (engine, bams, reference, contig, positions) shard of an input with the given fingerprint in a checkpoint'''
+    engine, bams, reference, contig, positions = shard
+    return hashlib.sha256(json.dumps([fingerprint, engine, list(bams), reference, contig, list(positions)]).encode()).hexdigest()
+
+def calculate_pon_counts(vcf, normal_bams, reference, engine='pysam', workers=1, bam_shards=1, checkpoint=None, skip=None, regions=None):
+    '''counts depth and mismatches of every variant position in vcf.
+    Work is split by contig and by subsets of normal bams, and per bam subset counts are summed per site.
+    With a checkpoint, shards completed by a previous run are not counted again and every shard is saved as it completes.
+    Positions in skip are not counted, and only positions in regions when given
+    returns {(CHROM, POS): (depth, mismatches)}'''
+    shards = [(engine, bams, reference, contig, positions) for contig, positions in collect_sites(vcf, skip, regions).items() for bams in split_bams(normal_bams, bam_shards)]
+    fingerprint = checkpoint.fingerprint() if checkpoint is not None else None
+    keys = [shard_key(shard, fingerprint) for shard in shards]
+
+    shard_results = dict()
+    if checkpoint is not None:
+        completed = checkpoint.completed_shards()
+        for key in keys:
+            if key in completed:
+                shard_results[key] = {pos: (depth, mismatches) for pos, depth, mismatches in completed[key]}
+        if shard_results:
+            print(f'{len(shard_results)} of {len(shards)} shards counted in a previous run')
+    pending = [(key, shard) for key, shard in zip(keys, shards) if key not in shard_results]
+
+    def save(key, shard_counts):
+        shard_results[key] = shard_counts
+        if checkpoint is not None:
+            checkpoint.save_shard(key, [[pos, depth, mismatches] for pos, (depth, mismatches) in shard_counts.items()])
+
+    if workers > 1:
+        # each worker process has its own scheduler, the mpileup runs of all workers share the limit of this one
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=configure, initargs=(worker_concurrency(workers),)) as executor:
+            futures = {executor.submit(count_shard, *shard): key for key, shard in pending}
+            for future in concurrent.futures.as_completed(futures):
+                save(futures[future], future.result())
+    else:
+        for key, shard in pending:
+            save(key, count_shard(*shard))
+
+    pon_counts = dict()
+    for key, shard in zip(keys, shards):
+        contig = shard[3]
+        for pos, (depth, mismatches) in shard_results[key].items():
+            total_depths, total_mismatches = pon_counts.get((contig, pos), (0, 0))
+            pon_counts[(contig, pos)] = (total_depths + depth, total_mismatches + mismatches)
+
+    return pon_counts
+
+def open_pon_db(pon_db, reference):
+    '''PonDB of a store built with pon_build.py, exits when it was built on another reference than reference'''
+    try:
+        db = PonDB(pon_db)
+        db.check_reference(reference)
+    except (ValueError, OSError) as error:
+        print(error)
+        print('Exiting...')
+        sys.exit(1)
+
+    return db
+
+def pon_db_counts(vcf, pon_db, skip=None, regions=None):
+    '''looks up depth and mismatches of every variant position in vcf (in regions when given) except those in skip from a store built with pon_build.py
+    pon_db is the store directory or an opened PonDB
+    returns {(CHROM, POS): (depth, mismatches)}'''
+    db = pon_db if isinstance(pon_db, PonDB) else PonDB(pon_db)
+    print(f'using {db}')
+    pon_counts = dict()
+    for contig, positions in collect_sites(vcf, skip, regions).items():
+        depths, mismatches = db.lookup(contig, positions)
+        for pos, depth, mismatch in zip(positions, depths.tolist(), mismatches.tolist()):
+            pon_counts[(contig, pos)] = (depth, mismatch)
+
+    return pon_counts
+
+def previous_pon_counts(vcf, previous, regions=None):
+    '''depth and mismatches of the variants in vcf (in regions when given) that are annotated in a previous pon_annotate output
+    returns {(CHROM, POS): (depth, mismatches)}'''
+    pon_counts = dict()
+    for variant in region_variants(cyvcf2.VCF(vcf), regions):
+        values = previous.get(variant)
+        if values is not None:
+            pon_counts[(variant.CHROM, variant.POS)] = (int(values[0]), int(values[1]))
+    previous.report()
+
+    return pon_counts
+
+def add_pon_header(vcf_handle, panel=None):
+    '''adds the PON INFO fields and the panel line when given to the header of a cyvcf2 VCF or Writer'''
+    if panel:
+        vcf_handle.add_to_header(panel)
     vcf_handle.add_info_to_header({'ID': 'PON_VAF', 'Description': 'VAF in Panel of Normals',
     'Type':'Float', 'Number': '1'})
     vcf_handle.add_info_to_header({'ID': 'PON_DEPTH', 'Description': 'Total depth in Panel of Normals',
@@ -56,16 +188,108 @@ def main():
     vcf_handle.add_info_to_header({'ID': 'PON_VC', 'Description': 'Total variant read count in Panel of Normals',
     'Type':'Float', 'Number': '1'})
 
-    output_vcf = os.path.join(output_dir, re.sub(r'.vcf$', '.pon.vcf', os.path.basename(vcf)))
+def set_pon_info(variant, total_depths, mismatches):
+    variant.INFO['PON_VAF'] = str(pon_vaf(mismatches, total_depths))
+    variant.INFO['PON_DEPTH'] = str(total_depths)
+    variant.INFO['PON_VC'] = str(mismatches)
+
+def write_checkpointed(vcf_handle, pon_counts, checkpoint, resume=False, regions=None):
+    '''writes the annotated records (in regions when given) BGZF compressed, saving a checkpoint every checkpoint.interval records.
+    When resuming, records before the last checkpoint are skipped and the output is appended to'''
+    writer = checkpoint.open_output(resume)
+    if not resume:
+        writer.write(vcf_handle.raw_header)
+        checkpoint.save(writer)
+    with metrics().stage('write', profile=True) as stage:
+        for variant in itertools.islice(region_variants(vcf_handle, regions), checkpoint.records, None):
+            total_depths, mismatches = pon_counts[(variant.CHROM, variant.POS)]
+            set_pon_info(variant, total_depths, mismatches)
+            writer.write(str(variant))
+            checkpoint.advance(writer)
+            stage.records += 1
+        writer.close()
+    stage.bytes_written += file_size(checkpoint.output)
+    checkpoint.remove()
+
+def main():
+    vcf, normal_bams, output_dir, reference, engine, workers, bam_shards, pon_db, checkpoint_interval, resume, previous_vcf, regions, compress_threads, metrics_path, profile = argument_parser()
+    configure_metrics(metrics_path, profile)
+    bgzf.configure(compress_threads)
+    # a checkpoint is only resumed with the same panel, reference and regions
+    params = {'normal_bams': normal_bams, 'reference': reference, 'engine': engine, 'pon_db': pon_db, 'regions': regions}
+    if regions:
+        if not has_index(vcf):
+            print(f'{vcf} needs a tabix index to use --regions\nExiting...')
+            sys.exit(1)
+        regions = read_regions(regions)
+
+    # output is written BGZF compressed and tabix indexed
+    output_vcf = os.path.join(output_dir, re.sub(r'\.vcf(\.gz)?$', '.pon.vcf.gz', os.path.basename(vcf)))
+    checkpoint = None
+    resumed = False
+    if checkpoint_interval:
+        checkpoint = Checkpoint(output_vcf, vcf, checkpoint_interval, params)
+        if resume:
+            try:
+                resumed = checkpoint.load()
+            except ValueError as error:
+                print(error)
+                print('Exiting...')
+                sys.exit(1)
+            if resumed:
+                print(f'resuming {output_vcf} after {checkpoint.records} records')
+        else:
+            checkpoint.remove()
+
+    if not pon_db and not normal_bams:
+        print('Either --normal_bams or --pon_db is required')
+        sys.exit(1)
+    if pon_db:
+        pon_db = open_pon_db(pon_db, reference)
+    panel = pon_db.panel() if pon_db else pon_panel(normal_bams, reference)
+
+    reused = None
+    if previous_vcf:
+        try:
+            previous = PreviousAnnotation(previous_vcf, ['PON_DEPTH', 'PON_VC'])
+        except ValueError as error:
+            print(error)
+            print('Exiting...')
+            sys.exit(1)
+        if previous.meta_line('PON_PANEL') != panel:
+            print(f'{previous_vcf} was annotated with another panel of normals or reference, annotate without --previous')
+            print('Exiting...')
+            sys.exit(1)
+        with metrics().stage('previous') as stage:
+            reused = previous_pon_counts(vcf, previous, regions)
+            stage.records += len(reused)
+        previous.close()
+
+    # counting in worker processes is timed here as a whole, the workers are not measured one by one
+    with metrics().stage('count') as stage:
+        if pon_db:
+            pon_counts = pon_db_counts(vcf, pon_db, reused, regions)
+        else:
+            pon_counts = calculate_pon_counts(vcf, normal_bams, reference, engine, workers, bam_shards, checkpoint, reused, regions)
+        stage.records += len(pon_counts)
+    if reused:
+        pon_counts.update(reused)
+
+    vcf_handle = cyvcf2.VCF(vcf)
+    add_pon_header(vcf_handle, panel)
+
+    if checkpoint is not None:
+        write_checkpointed(vcf_handle, pon_counts, checkpoint, resumed, regions)
+        return
 
-    output_handle = cyvcf2.Writer(output_vcf, vcf_handle)
-    for variant in vcf_handle:
-        variant_position = f'{variant.CHROM}:{variant.POS}-{variant.POS}'
-        pon_vafs, total_depths, mismatches =  calculate_vaf(normal_bams, variant_position, reference)
-        variant.INFO['PON_VAF'] = str(pon_vafs)
-        variant.INFO['PON_DEPTH'] = str(total_depths)
-        variant.INFO['PON_VC'] = str(mismatches)
-        output_handle.write_record(variant)
+    with metrics().stage('write', profile=True) as stage, VcfWriter(output_vcf) as output_handle:
+        output_handle.write(vcf_handle.raw_header)
+        for variant in region_variants(vcf_handle, regions):
+            total_depths, mismatches = pon_counts[(variant.CHROM, variant.POS)]
+            set_pon_info(variant, total_depths, mismatches)
+            output_handle.write(str(variant))
+            stage.records += 1
+    stage.bytes_written += file_size(output_vcf)
 
 
 if __name__=='__main__':
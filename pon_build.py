@@ -0,0 +1,230 @@
+#!/home/users/cjyoon/anaconda3/bin/python
+'''Scans a panel of normal bams once and writes a per-contig allele count store
+that pon_annotate.py --pon_db can query without touching the bams.
+
+Layout of the store directory
+    manifest.json       reference, normal bams and contigs (with their lengths) the store was built from
+    {i}.runs.npy        0-based start of every run of positions of contig i with the same depth (uint32)
+    {i}.depth.npy       depth of each run as samtools mpileup reports it (uint32)
+    {i}.sites.npy       delta encoded 1-based positions that have any non-reference base
+    {i}.counts.npy      A/C/G/T counts of those positions (n x 4)
+    {i}.ref.npy         reference base of those positions as an index into ACGTN
+'''
+import os
+import sys
+import json
+import argparse
+import concurrent.futures
+import numpy as np
+import pysam
+from pon_pileup import BASES, window_allele_counts, pon_panel
+from reference import open_reference
+
+FORMAT_VERSION = 3
+BUILD_WINDOW = 1000000 # contigs are scanned in windows of this size
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Builds a panel of normal allele count store for pon_annotate.py --pon_db')
+    parser.add_argument('-n', '--normal_bams', required=True, nargs='+', help='Normal Bams that make up the panel of normals')
+    parser.add_argument('-r', '--reference', help='Reference fasta', default='/home/users/cjyoon/reference/GRCh37/human_g1k_v37.fasta')
+    parser.add_argument('-o', '--output', required=True, help='Output directory of the panel of normal store')
+    parser.add_argument('-c', '--contigs', required=False, nargs='+', default=None, help='Only build these contigs. Default=all contigs of the reference')
+    parser.add_argument('-t', '--threads', '--workers', dest='workers', required=False, default=1, type=int, help='Number of contigs built in parallel. Default=1')
+
+    args = vars(parser.parse_args())
+    return args['normal_bams'], args['reference'], args['output'], args['contigs'], args['workers']
+
+
+def contig_files(db_dir, contig_index):
+    '''paths of the arrays stored for a contig'''
+    prefix = os.path.join(db_dir, str(contig_index))
+    return {name: f'{prefix}.{name}.npy' for name in ['runs', 'depth', 'sites', 'counts', 'ref']}
+
+
+def reference_codes(sequence):
+    '''reference sequence as indices into ACGTN'''
+    codes = np.full(len(sequence), len(BASES), dtype=np.uint8)
+    seq = np.frombuffer(sequence.upper().encode(), dtype=np.uint8)
+    for i, base in enumerate(BASES):
+        codes[seq == ord(base)] = i
+
+    return codes
+
+
+def save_raw(raw_path, npy_path, dtype=np.uint32):
+    '''copies the values of a raw binary file into a .npy file block by block and removes the raw file'''
+    raw = np.memmap(raw_path, dtype=dtype, mode='r')
+    array = np.lib.format.open_memmap(npy_path, mode='w+', dtype=dtype, shape=raw.shape)
+    for start in range(0, len(raw), BUILD_WINDOW):
+        array[start:start + BUILD_WINDOW] = raw[start:start + BUILD_WINDOW]
+    array.flush()
+    del array, raw
+    os.remove(raw_path)
+
+
+def build_contig(normal_bams, reference, contig, contig_length, db_dir, contig_index):
+    '''scans every normal bam over a single contig and writes its arrays.
+    Depth is run-length encoded as it is scanned, runs are appended to raw files so that memory stays flat'''
+    files = contig_files(db_dir, contig_index)
+    bam_handles = [pysam.AlignmentFile(bam) for bam in normal_bams]
+    fasta = open_reference(reference)
+    site_chunks, count_chunks, ref_chunks = [], [], []
+
+    previous_depth = None
+    run_count = 0
+    with open(files['runs'] + '.raw', 'wb') as runs, open(files['depth'] + '.raw', 'wb') as run_depths:
+        for start in range(0, contig_length, BUILD_WINDOW):
+            end = min(start + BUILD_WINDOW, contig_length)
+            counts = np.zeros((4, end - start), dtype=np.uint32)
+            window_depth = np.zeros(end - start, dtype=np.uint32)
+            for bam_handle in bam_handles:
+                if contig in bam_handle.references:
+                    acgt, bam_depth = window_allele_counts(bam_handle, contig, start, end)
+                    counts += np.array(acgt, dtype=np.uint32)
+                    window_depth += bam_depth.astype(np.uint32)
+
+            # a run starts wherever the depth differs from the position before, also across windows
+            changes = np.nonzero(np.diff(window_depth, prepend=window_depth[:1]))[0]
+            if previous_depth is None or window_depth[0] != previous_depth:
+                changes = np.concatenate([[0], changes])
+            runs.write((changes + start).astype(np.uint32).tobytes())
+            run_depths.write(window_depth[changes].tobytes())
+            previous_depth = window_depth[-1]
+            run_count += len(changes)
+
+            refcodes = reference_codes(fasta.fetch(contig, start, end))
+            refcounts = np.zeros(end - start, dtype=np.uint32)
+            is_acgt = refcodes < len(BASES)
+            refcounts[is_acgt] = counts[refcodes[is_acgt], np.nonzero(is_acgt)[0]]
+            is_site = counts.sum(axis=0, dtype=np.uint32) > refcounts
+            site_chunks.append(np.nonzero(is_site)[0] + start + 1)
+            count_chunks.append(counts[:, is_site].T)
+            ref_chunks.append(refcodes[is_site])
+
+    for bam_handle in bam_handles:
+        bam_handle.close()
+    save_raw(files['runs'] + '.raw', files['runs'])
+    save_raw(files['depth'] + '.raw', files['depth'])
+
+    sites = np.concatenate(site_chunks).astype(np.uint32)
+    np.save(files['sites'], np.diff(sites, prepend=np.uint32(0)).astype(np.uint32))
+    np.save(files['counts'], np.concatenate(count_chunks).astype(np.uint32).reshape(-1, 4))
+    np.save(files['ref'], np.concatenate(ref_chunks).astype(np.uint8))
+    print(f'{contig}: {len(sites)} sites with non-reference bases, depth in {run_count} runs')
+
+    return contig, {'index': contig_index, 'length': contig_length, 'sites': len(sites), 'runs': run_count}
+
+
+def build_pon_db(normal_bams, reference, db_dir, contigs=None, workers=1):
+    '''builds the panel of normal store for every contig (or the given contigs) of the reference'''
+    os.makedirs(db_dir, exist_ok=True)
+    contig_lengths = open_reference(reference).lengths
+    if contigs is None:
+        contigs = list(contig_lengths)
+
+    missing = [contig for contig in contigs if contig not in contig_lengths]
+    if missing:
+        print(f'{", ".join(missing)} not present in {reference}\nExiting...')
+        sys.exit(1)
+
+    jobs = [(normal_bams, reference, contig, contig_lengths[contig], db_dir, i) for i, contig in enumerate(contigs)]
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            built = [future.result() for future in [executor.submit(build_contig, *job) for job in jobs]]
+    else:
+        built = [build_contig(*job) for job in jobs]
+
+    manifest = {'format_version': FORMAT_VERSION,
+        'reference': os.path.abspath(reference),
+        'reference_contigs': contig_lengths,
+        'normal_bams': [os.path.abspath(bam) for bam in normal_bams],
+        'contigs': dict(built)}
+    with open(os.path.join(db_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    return 0
+
+
+class PonDB():
+    '''read-only, memory-mapped access to a store written by build_pon_db'''
+    def __init__(self, db_dir):
+        self.db_dir = db_dir
+        with open(os.path.join(db_dir, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        if self.manifest['format_version'] != FORMAT_VERSION:
+            raise ValueError(f'{db_dir} was built with an incompatible pon_build.py version, build it again')
+        self.reference = self.manifest['reference']
+        self.normal_bams = self.manifest['normal_bams']
+        self._arrays = dict()
+
+    def __repr__(self):
+        return f'PonDB({self.db_dir}, {len(self.normal_bams)} normal bams, {self.reference})'
+
+    def panel(self):
+        '''##PON_PANEL header line of the normal bams and reference the store was built from'''
+        return pon_panel(self.normal_bams, self.reference)
+
+    def check_reference(self, reference):
+        '''raises ValueError when reference is not the reference the store was built on.
+        Contigs of the store must have the same length in reference, a copy of the same fasta is accepted'''
+        lengths = open_reference(reference).lengths
+        recorded = self.manifest.get('reference_contigs') or {contig: info['length'] for contig, info in self.manifest['contigs'].items()}
+        different = [contig for contig, length in recorded.items() if lengths.get(contig) != length]
+        if different:
+            raise ValueError(f'{self.db_dir} was built on {self.reference}, {reference} differs in {", ".join(different[:5])}')
+        if os.path.realpath(reference) != os.path.realpath(self.reference):
+            print(f'{self.db_dir} was built on {self.reference}, using {reference} with the same contigs')
+
+    def contig_arrays(self, contig):
+        '''(length, runs, run depths, sites, counts, ref) arrays of a contig, None if the contig was not built'''
+        if contig not in self._arrays:
+            contig_info = self.manifest['contigs'].get(contig)
+            if contig_info is None:
+                self._arrays[contig] = None
+            else:
+                files = contig_files(self.db_dir, contig_info['index'])
+                runs = np.load(files['runs'], mmap_mode='r')
+                depth = np.load(files['depth'], mmap_mode='r')
+                sites = np.cumsum(np.load(files['sites']), dtype=np.int64)
+                counts = np.load(files['counts'], mmap_mode='r')
+                ref = np.load(files['ref'], mmap_mode='r')
+                self._arrays[contig] = (contig_info['length'], runs, depth, sites, counts, ref)
+
+        return self._arrays[contig]
+
+    def lookup(self, contig, positions):
+        '''depth and mismatches of 1-based positions of a contig as two numpy arrays'''
+        positions = np.asarray(positions, dtype=np.int64)
+        depths = np.zeros(len(positions), dtype=np.int64)
+        mismatches = np.zeros(len(positions), dtype=np.int64)
+        arrays = self.contig_arrays(contig)
+        if arrays is None:
+            return depths, mismatches
+
+        length, runs, depth, sites, counts, ref = arrays
+        in_contig = (positions >= 1) & (positions <= length)
+        depths[in_contig] = depth[np.searchsorted(runs, positions[in_contig] - 1, side='right') - 1]
+
+        if len(sites):
+            site_index = np.minimum(np.searchsorted(sites, positions), len(sites) - 1)
+            is_site = sites[site_index] == positions
+            site_counts = counts[site_index[is_site]].astype(np.int64)
+            refcodes = ref[site_index[is_site]]
+            refcounts = site_counts[np.arange(len(refcodes)), np.minimum(refcodes, len(BASES) - 1)]
+            refcounts[refcodes >= len(BASES)] = 0
+            mismatches[is_site] = site_counts.sum(axis=1) - refcounts
+
+        return depths, mismatches
+
+
+def main():
+    normal_bams, reference, output, contigs, workers = argument_parser()
+    build_pon_db(normal_bams, reference, output, contigs, workers)
+    print(f'Panel of normal store ready: {output}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    main()
@@ -1,38 +1,102 @@
 #!/home/users/cjyoon/anaconda3/bin/python
 import sys
 import os
-import subprocess
-import shlex
 import re
 import argparse
 import cyvcf2
+from expression import FilterExpression
+from regions import has_index, read_regions, iter_regions
+import bgzf
+from bgzf import VcfWriter
+from metrics import metrics, file_size, configure as configure_metrics
 
 def argument_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input', required=True, help='')
     parser.add_argument('-o', '--output_dir', required=False, default=os.getcwd(), help='Output directory')
-    parser.add_argument('-t', '--vaf_threshold', required=True, type=float,help='Remove variants where VAF in the panel of normal exceeds the threshold')
+    parser.add_argument('-t', '--vaf_threshold', required=False, type=float, default=None, help='Remove variants where VAF in the panel of normal exceeds the threshold. Same as -e "PON_VAF < threshold"')
+    parser.add_argument('-e', '--expression', required=False, default=None, help='Keep variants for which the expression is true, e.g. "PON_VAF < 0.02 && PON_DEPTH >= 100 && MAX_AF < 0.001". Fields are INFO, FORMAT/NAME[sample index] or CSQ fields of the canonical annotation')
+    parser.add_argument('-r', '--regions', required=False, default=None, help='Only filter variants in these regions, a BED file or comma separated chr:start-end. Requires a tabix indexed input')
+    parser.add_argument('-s', '--soft_filter', required=False, default=None, help='Instead of removing variants, add this tag to the FILTER column of variants that fail')
+    parser.add_argument('-@', '--compress_threads', required=False, default=1, type=int, help='Number of threads compressing the output vcf.gz. Default=1')
+    parser.add_argument('--metrics', required=False, default=None, help='Write time per stage, external tool runs, records, bytes and peak memory of the run to this JSON file')
+    parser.add_argument('--profile', required=False, action='store_true', help='Sample the hot loops and add their most frequent frames to --metrics')
 
     args = vars(parser.parse_args())
+    if args['vaf_threshold'] is None and args['expression'] is None:
+        parser.error('either -t/--vaf_threshold or -e/--expression is required')
 
-    return args['input'], args['vaf_threshold'], args['output_dir']
+    return args['input'], args['vaf_threshold'], args['output_dir'], args['expression'], args['regions'], args['soft_filter'], args['compress_threads'], args['metrics'], args['profile']
 
+def filter_expression(vaf_threshold, expression):
+    '''expression string combining --vaf_threshold and --expression'''
+    expressions = []
+    if vaf_threshold is not None:
+        expressions.append(f'PON_VAF < {vaf_threshold}')
+    if expression:
+        expressions.append(f'({expression})')
+
+    return ' && '.join(expressions)
+
+def soft_filter_tag(variant, tag):
+    '''adds tag to the FILTER column of a record'''
+    filters = [name for name in (variant.FILTER or '').split(';') if name and name != 'PASS']
+    variant.FILTER = filters + [tag]
 def main():
-    input, vaf_threshold, output_dir = argument_parser()
-    outputfile = os.path.join(output_dir, re.sub('.vcf$', '.filtered.vcf', os.path.basename(input)))
+    input, vaf_threshold, output_dir, expression, regions, soft_filter, compress_threads, metrics_path, profile = argument_parser()
+    configure_metrics(metrics_path, profile)
+    bgzf.configure(compress_threads)
+    outputfile = os.path.join(output_dir, re.sub(r'\.vcf(\.gz)?$', '.filtered.vcf.gz', os.path.basename(input)))
+    # the input is checked before the output is opened, so that a failed run leaves no partial output
+    if regions:
+        if not has_index(input):
+            print(f'{input} needs a tabix index to use --regions\nExiting...')
+            sys.exit(1)
+        try:
+            regions = read_regions(regions)
+        except (ValueError, IndexError) as error:
+            print(f'cannot read regions {regions}: {error}')
+            print('Exiting...')
+            sys.exit(1)
 
     vcf_handle = cyvcf2.VCF(input)
-    print(vcf_handle)
-    writer = cyvcf2.Writer(outputfile, vcf_handle)
+    try:
+        keep = FilterExpression(filter_expression(vaf_threshold, expression), vcf_handle)
+    except ValueError as error:
+        print(error)
+        print('Exiting...')
+        sys.exit(1)
+    print(keep)
 
-    for variant in cyvcf2.VCF(input):
-        if variant.INFO['PON_VAF'] < vaf_threshold:
-            writer.write_record(variant)
+    if soft_filter:
+        vcf_handle.add_filter_to_header({'ID': soft_filter, 'Description': f'Failed {keep.expression}'})
+    # BGZF compressed output, indexed as it is written
+    writer = VcfWriter(outputfile)
+    writer.write(vcf_handle.raw_header)
 
-    vcf_handle.close()
-    writer.close()
-    
-if __name__=='__main__':
-    main()
+    if regions:
+        variants = iter_regions(vcf_handle, regions)
+    else:
+        variants = vcf_handle
 
+    passed = failed = 0
+    with metrics().stage('filter', profile=True) as stage:
+        for variant in variants:
+            if keep(variant):
+                passed += 1
+                writer.write(str(variant))
+            else:
+                failed += 1
+                if soft_filter:
+                    soft_filter_tag(variant, soft_filter)
+                    writer.write(str(variant))
 
+        vcf_handle.close()
+        writer.close()
+        stage.records += passed + failed
+        stage.bytes_read += file_size(input)
+        stage.bytes_written += file_size(outputfile)
+    print(f'{passed} variants passed, {failed} failed: {outputfile}')
+
+if __name__=='__main__':
+    main()
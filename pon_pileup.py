@@ -0,0 +1,144 @@
+'''In-process panel of normal allele counting with pysam.
+Variant positions are sorted and merged into windows so that every normal bam is
+walked once per window instead of running samtools mpileup once per variant.
+
+Also parses the samtools mpileup lines of pon_annotate.py --engine mpileup. Compared with the original
+parser, the output of that engine changed in three ways:
+    the depth and bases of every bam are read from columns 3i+3 and 3i+4, before the depth of a bam
+    was paired with the bases of the previous one (the POS column for the first bam);
+    ^ with its mapping quality character, $ and the sequence of +N/-N indels are skipped, before they
+    were counted as mismatches whenever they were A, C, G or T;
+    a position without coverage has PON_VAF 0 instead of failing with ZeroDivisionError.
+'''
+import os
+import re
+import numpy as np
+import pysam
+from reference import open_reference
+
+BASES = 'ACGT'
+FLAG_FILTER = 0x4 | 0x100 | 0x200 | 0x400 # unmapped, secondary, qcfail and duplicate reads, samtools mpileup --ff
+WINDOW_GAP = 1000 # positions closer than this are counted within the same window
+WINDOW_SPAN = 100000 # maximum length of a single window
+
+
+def merge_windows(positions, max_gap=WINDOW_GAP, max_span=WINDOW_SPAN):
+    '''groups 1-based positions of a single contig into windows
+    returns a list of (start, end, positions) where start/end are 0-based, half open'''
+    windows = []
+    for pos in sorted(set(positions)):
+        if windows and pos - windows[-1][2][-1] <= max_gap and pos - windows[-1][0] <= max_span:
+            windows[-1][1] = pos
+            windows[-1][2].append(pos)
+        else:
+            windows.append([pos - 1, pos, [pos]])
+
+    return [tuple(window) for window in windows]
+
+
+def mpileup_read(read):
+    '''True for the reads samtools mpileup counts by default: unmapped, secondary, qcfail and duplicate reads
+    and anomalous pairs (paired but not in a proper pair, counted only with mpileup -A) are left out'''
+    if read.flag & FLAG_FILTER:
+        return False
+    return not read.is_paired or read.is_proper_pair
+
+
+def window_allele_counts(bam_handle, contig, start, end):
+    '''A/C/G/T read counts and depth of every position in [start, end) of a single bam,
+    counted like samtools mpileup -Q 0 -q 0. The depth is that of the mpileup depth column: every read
+    spanning the position, including deletions, reference skips and N bases.
+    Unlike mpileup no maximum depth is applied, mpileup keeps at most 8000 reads of a bam (-d) at a position
+    returns ([A, C, G, T] count arrays, depth array)'''
+    acgt = bam_handle.count_coverage(contig, start, end, quality_threshold=0, read_callback=mpileup_read)
+    depth = np.zeros(end - start + 1, dtype=np.int64)
+    for read in bam_handle.fetch(contig, start, end):
+        if mpileup_read(read):
+            depth[max(read.reference_start, start) - start] += 1
+            depth[min(read.reference_end, end) - start] -= 1
+
+    return acgt, np.cumsum(depth[:-1])
+
+
+def count_alleles(normal_bams, reference, contig, positions, max_gap=WINDOW_GAP):
+    '''sums A/C/G/T read counts across normal_bams for 1-based positions of a single contig
+    returns {position: (reference base, [A, C, G, T], depth)}'''
+    windows = merge_windows(positions, max_gap)
+    fasta = open_reference(reference)
+    counts = dict()
+    for start, end, window_positions in windows:
+        refseq = fasta.fetch(contig, start, end).upper()
+        for pos in window_positions:
+            counts[pos] = [refseq[pos - 1 - start], [0, 0, 0, 0], 0]
+
+    for bam in normal_bams:
+        with pysam.AlignmentFile(bam) as bam_handle:
+            if contig not in bam_handle.references:
+                continue
+            for start, end, window_positions in windows:
+                acgt, depth = window_allele_counts(bam_handle, contig, start, end)
+                for pos in window_positions:
+                    offset = pos - 1 - start
+                    site_counts = counts[pos][1]
+                    for i in range(4):
+                        site_counts[i] += acgt[i][offset]
+                    counts[pos][2] += int(depth[offset])
+
+    return {pos: tuple(site) for pos, site in counts.items()}
+
+
+def pileup_mismatches(bases):
+    '''counts non-reference A/C/G/T bases in a samtools mpileup base string
+    read start (^ and its mapping quality), read end ($) and indel sequences are skipped'''
+    mismatches = 0
+    i = 0
+    while i < len(bases):
+        base = bases[i]
+        if base == '^':
+            i += 2
+            continue
+        elif base in '+-':
+            indel_length = re.match(r'\d+', bases[i+1:]).group()
+            i += 1 + len(indel_length) + int(indel_length)
+            continue
+        elif base.upper() in 'ACGT':
+            mismatches += 1
+        i += 1
+
+    return mismatches
+
+
+def pon_vaf(mismatches, totalDepth):
+    '''VAF in the panel of normals, 0 if there is no coverage'''
+    if totalDepth == 0:
+        return 0.0
+    return round(float(mismatches/totalDepth), 3)
+
+
+def mpileup_vaf(mpileup):
+    '''VAF, depth and mismatches summed over the bams of a single samtools mpileup line'''
+    split_mpileup = mpileup.rstrip('\n').split('\t')
+    totalDepth = 0
+    mismatches = 0
+    # CHROM, POS, REF followed by depth, bases, qualities for each bam
+    for i in range(0, int(len(split_mpileup)/3) -1 ):
+        depths = 3*i + 3
+        bases = 3*i + 4
+        totalDepth += int(split_mpileup[depths])
+        mismatches += pileup_mismatches(split_mpileup[bases])
+
+    return pon_vaf(mismatches, totalDepth), totalDepth, mismatches
+
+
+def depth_and_mismatches(refbase, allele_counts, depth):
+    '''total depth and number of non-reference A/C/G/T bases, as mpileup_vaf counts them'''
+    if refbase in BASES:
+        return depth, sum(allele_counts) - allele_counts[BASES.index(refbase)]
+    else:
+        return depth, sum(allele_counts)
+
+def pon_panel(normal_bams, reference):
+    '''##PON_PANEL header line of the normal bams and reference PON values are counted from, checked before they are reused with --previous'''
+    normal_bams = ','.join(sorted(os.path.abspath(bam) for bam in normal_bams))
+    # values are quoted, htslib only accepts unquoted structured values without commas
+    return f'##PON_PANEL=<Reference="{os.path.abspath(reference)}",NormalBams="{normal_bams}">'
@@ -0,0 +1,83 @@
+'''Reuse of INFO values from a previously annotated VCF, used by annotate_vcf.py and pon_annotate.py --previous.
+Records of the new input are merge-joined per contig against the sorted, tabix indexed previous VCF
+by (CHROM, POS, REF, ALT). Records with a match take the INFO values of the previous record,
+only the others have to be annotated again.
+'''
+import cyvcf2
+from regions import has_index
+
+
+class PreviousAnnotation():
+    def __init__(self, path, fields):
+        if not has_index(path):
+            raise ValueError(f'{path} needs a tabix index to be used with --previous')
+        self.path = path
+        self.fields = fields
+        self.vcf_handle = cyvcf2.VCF(path)
+        self.contigs = set(self.vcf_handle.seqnames)
+        self.contig = None
+        self.last_pos = 0
+        self.records = iter(())
+        self.pending = None
+        self.site_pos = None
+        self.site_values = dict()
+        self.reused = 0
+        self.recomputed = 0
+
+    def __repr__(self):
+        return f'PreviousAnnotation({self.path}, {self.reused} reused, {self.recomputed} recomputed)'
+
+    def seek(self, contig):
+        '''restarts the previous records at the start of contig'''
+        self.contig = contig
+        self.last_pos = 0
+        self.records = self.vcf_handle(contig) if contig in self.contigs else iter(())
+        self.pending = next(self.records, None)
+        self.site_pos = None
+        self.site_values = dict()
+
+    def load_site(self, pos):
+        '''advances the previous records to pos and keeps the values of the records at pos by (REF, ALT)'''
+        while self.pending is not None and self.pending.POS < pos:
+            self.pending = next(self.records, None)
+        self.site_pos = pos
+        self.site_values = dict()
+        while self.pending is not None and self.pending.POS == pos:
+            values = [self.pending.INFO.get(field) for field in self.fields]
+            if all(value is not None for value in values):
+                self.site_values[(self.pending.REF, ','.join(self.pending.ALT))] = values
+            self.pending = next(self.records, None)
+
+    def get(self, variant):
+        '''values of fields in the previous record matching variant, None when it has to be computed.
+        Input records are expected in sorted order, a contig is looked up again when a record goes backwards'''
+        if variant.CHROM != self.contig or variant.POS < self.last_pos:
+            self.seek(variant.CHROM)
+        self.last_pos = variant.POS
+        if variant.POS != self.site_pos:
+            self.load_site(variant.POS)
+        values = self.site_values.get((variant.REF, ','.join(variant.ALT)))
+        if values is None:
+            self.recomputed += 1
+        else:
+            self.reused += 1
+
+        return values
+
+    def header_line(self, field):
+        '''the ##INFO=<ID=field,...> line of the previous VCF'''
+        for line in self.vcf_handle.raw_header.split('\n'):
+            if line.startswith(f'##INFO=<ID={field},'):
+                return line
+
+    def meta_line(self, key):
+        '''the ##key=... line of the previous VCF, None when it has none'''
+        for line in self.vcf_handle.raw_header.split('\n'):
+            if line.startswith(f'##{key}='):
+                return line
+
+    def report(self):
+        print(f'previous annotation {self.path}: {self.reused} records reused, {self.recomputed} recomputed')
+
+    def close(self):
+        self.vcf_handle.close()
@@ -0,0 +1,78 @@
+'''Shared access to the reference fasta, used by svAnnotate.py and pon_annotate.py.
+A single pysam.FastaFile is kept open per reference and process (each worker of a process pool opens its own),
+and sequence is read in fixed size blocks that are kept in an LRU cache, so that neighbouring
+positions are served from the same block instead of reading the fasta again.
+'''
+import os
+import collections
+import pysam
+
+BLOCK_SIZE = 65536 # bases read from the fasta at once
+CACHE_BLOCKS = 256 # blocks kept per reference, least recently used are evicted
+
+_references = dict()
+
+
+class Reference():
+    def __init__(self, path, block_size=BLOCK_SIZE, max_blocks=CACHE_BLOCKS):
+        self.path = path
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.fasta = pysam.FastaFile(path)
+        self.lengths = dict(zip(self.fasta.references, self.fasta.lengths))
+        self.blocks = collections.OrderedDict()
+        self.reads = 0
+
+    def __repr__(self):
+        return f'Reference({self.path}, {len(self.blocks)} blocks cached, {self.reads} reads)'
+
+    def block(self, contig, index):
+        '''sequence of the index-th block of contig'''
+        key = (contig, index)
+        sequence = self.blocks.get(key)
+        if sequence is None:
+            start = index * self.block_size
+            sequence = self.fasta.fetch(contig, start, min(start + self.block_size, self.lengths[contig]))
+            self.reads += 1
+            self.blocks[key] = sequence
+            if len(self.blocks) > self.max_blocks:
+                self.blocks.popitem(last=False)
+        else:
+            self.blocks.move_to_end(key)
+
+        return sequence
+
+    def fetch(self, contig, start, end):
+        '''sequence of contig in [start, end), 0-based half open like pysam.FastaFile.fetch'''
+        if contig not in self.lengths:
+            raise KeyError(f'{contig} is not in {self.path}')
+        end = min(end, self.lengths[contig])
+        if start >= end:
+            return ''
+        first, last = start // self.block_size, (end - 1) // self.block_size
+        sequence = ''.join(self.block(contig, index) for index in range(first, last + 1))
+        offset = first * self.block_size
+
+        return sequence[start - offset:end - offset]
+
+    def fetch_many(self, positions):
+        '''bases at many 0-based (contig, position) pairs. Requests are sorted so that each block is read once
+        returns {(contig, position): base}'''
+        bases = dict()
+        for contig, position in sorted(set(positions)):
+            bases[(contig, position)] = self.fetch(contig, position, position + 1)
+
+        return bases
+
+    def close(self):
+        self.fasta.close()
+        self.blocks.clear()
+
+
+def open_reference(path):
+    '''the Reference of path shared within the current process'''
+    key = (os.path.abspath(path), os.getpid())
+    if key not in _references:
+        _references[key] = Reference(path)
+
+    return _references[key]
@@ -0,0 +1,54 @@
+'''Target regions shared by the annotation scripts (--regions).
+Regions are merged per contig and only the overlapping records are read through the tabix/CSI index
+of the VCF with cyvcf2 region queries, instead of iterating the whole file.
+'''
+import os
+
+
+def has_index(vcf):
+    '''whether vcf has a tabix or CSI index next to it'''
+    return os.path.isfile(vcf + '.tbi') or os.path.isfile(vcf + '.csi')
+
+
+def read_regions(regions):
+    '''[(contig, start0, end)] merged and sorted per contig, from a BED file or comma separated chr:start-end'''
+    intervals = dict()
+    if os.path.isfile(regions):
+        with open(regions) as f:
+            for line in f:
+                if line.strip() and not line.startswith(('#', 'track', 'browser')):
+                    fields = line.split('\t')
+                    intervals.setdefault(fields[0], []).append((int(fields[1]), int(fields[2])))
+    else:
+        for region in regions.split(','):
+            contig, _, span = region.strip().rpartition(':')
+            start, end = span.replace(',', '').split('-')
+            intervals.setdefault(contig, []).append((int(start) - 1, int(end)))
+
+    merged = []
+    for contig, spans in intervals.items():
+        spans.sort()
+        current_start, current_end = spans[0]
+        for start, end in spans[1:]:
+            if start > current_end:
+                merged.append((contig, current_start, current_end))
+                current_start = start
+            current_end = max(current_end, end)
+        merged.append((contig, current_start, current_end))
+
+    return merged
+
+
+def iter_regions(vcf_handle, regions):
+    '''records starting in merged regions through the tabix index, each record is yielded once.
+    Regions are visited in the contig order of the VCF header so that records stay sorted'''
+    contig_order = {contig: i for i, contig in enumerate(vcf_handle.seqnames)}
+    for contig, start0, end in sorted(regions, key=lambda region: (contig_order.get(region[0], len(contig_order)), region[1])):
+        for variant in vcf_handle(f'{contig}:{start0 + 1}-{end}'):
+            if variant.start >= start0:
+                yield variant
+
+
+def region_variants(vcf_handle, regions=None):
+    '''records of an open cyvcf2 VCF in regions, all records when regions is None'''
+    return vcf_handle if regions is None else iter_regions(vcf_handle, regions)
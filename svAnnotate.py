@@ -1,17 +1,31 @@
 import gzip 
 import re
-import pysam 
 import os, sys
 import random
-import subprocess, shlex
 import argparse
+import tempfile
+import concurrent.futures
+import numpy as np
+from gene_index import GeneIndex
+from reference import open_reference
+from jobs import scheduler
+from metrics import metrics, configure as configure_metrics
+from csq import CSQDecoder
+from annotation_server import AnnotationClient, SERVER_BATCH_SIZE
 # to allow vep to annotate ALT column cannot be in SV annotation format in vcf. Change it to SNV annotation so that I can still utilize VEP's annotation
 
 
+DEFAULT_DECODER = CSQDecoder.default()
+DEFAULT_REFERENCE = '/home/users/data/01_reference/human_g1k_v37/human_g1k_v37.fasta'
+TEMP_VCF_HEADER = '##fileformat=VCFv4.1\n##reference=file:///path/to/human_g1k_v37.fasta\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+
+
 class Position():
     ''' python class for handling genomic positions
     0-based
     '''
+    __slots__ = ('chromosome', 'start', 'end', 'is_bp', 'clipped_reads')
+
     def __init__(self, chromosome, start, end, is_bp=None, clipped_reads=None):
         self.chromosome = chromosome
         self.start = start
@@ -33,9 +47,8 @@ class Position():
             yield Position(self.chromosome, i, i+1)
 
     def __next__(self):
-        self.start += 1
-        self.end += 1
-        return self
+        '''the position shifted by one base, self is not changed'''
+        return Position(self.chromosome, self.start + 1, self.end + 1)
 
     def __hash__(self):
         return hash((self.chromosome, self.start, self.end))
@@ -87,7 +100,7 @@ class Position():
     def extend(self, direction, basepairs):
         """extends objects in by specified base pairs, either upstream, downstream, or both"""
         if direction=="up":
-            return Position(self.chromosome, max(0, self.start-basepairs), end)
+            return Position(self.chromosome, max(0, self.start-basepairs), self.end)
         elif direction=="down":
             return Position(self.chromosome, self.start, self.end + basepairs)
         elif direction=="both":
@@ -96,55 +109,206 @@ class Position():
             print('direction has to be either up, down, or both')
             raise ValueError
 
-def get_canonical_annotation(long_annotation_string):
+class PositionArray():
+    '''many genomic positions held as numpy arrays of contig codes, starts and ends (0-based, half open)
+    so that overlap, extension and clustering run over all positions at once'''
+    __slots__ = ('contigs', 'codes', 'starts', 'ends')
+
+    def __init__(self, contigs, codes, starts, ends):
+        self.contigs = list(contigs)
+        self.codes = np.asarray(codes, dtype=np.int32)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+
+    @classmethod
+    def from_positions(cls, positions):
+        '''from Position objects or chr:start-end strings'''
+        contig_codes = dict()
+        codes, starts, ends = [], [], []
+        for position in positions:
+            position = Position.fromstring(position)
+            codes.append(contig_codes.setdefault(position.chromosome, len(contig_codes)))
+            starts.append(position.start)
+            ends.append(position.end)
+
+        return cls(contig_codes, codes, starts, ends)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __repr__(self):
+        return f'PositionArray({len(self)} positions on {len(self.contigs)} contigs)'
+
+    def __getitem__(self, index):
+        return Position(self.contigs[self.codes[index]], int(self.starts[index]), int(self.ends[index]))
+
+    def __iter__(self):
+        for code, start, end in zip(self.codes.tolist(), self.starts.tolist(), self.ends.tolist()):
+            yield Position(self.contigs[code], start, end)
+
+    def strings(self):
+        '''chr:start-end string of every position, same as str(Position)'''
+        return [f'{self.contigs[code]}:{start}-{end}' for code, start, end in zip(self.codes.tolist(), self.starts.tolist(), self.ends.tolist())]
+
+    def order(self):
+        '''indices sorting positions by contig code, start and end'''
+        return np.lexsort((self.ends, self.starts, self.codes))
+
+    def take(self, indices):
+        return PositionArray(self.contigs, self.codes[indices], self.starts[indices], self.ends[indices])
+
+    def extend(self, direction, basepairs):
+        '''all positions extended like Position.extend'''
+        if direction not in ('up', 'down', 'both'):
+            print('direction has to be either up, down, or both')
+            raise ValueError
+        starts = np.maximum(0, self.starts - basepairs) if direction in ('up', 'both') else self.starts
+        ends = self.ends + basepairs if direction in ('down', 'both') else self.ends
+
+        return PositionArray(self.contigs, self.codes, starts, ends)
+
+    def overlap(self, other):
+        '''pairs of positions that share more than one base, the same test as Position.overlap.
+        other is sorted once per contig and candidates of each position are found with searchsorted
+        returns (indices into self, indices into other)'''
+        self_indices, other_indices = [], []
+        other_code = {contig: code for code, contig in enumerate(other.contigs)}
+        for code, contig in enumerate(self.contigs):
+            if contig not in other_code:
+                continue
+            queries = np.flatnonzero(self.codes == code)
+            targets = np.flatnonzero(other.codes == other_code[contig])
+            if len(queries) == 0 or len(targets) == 0:
+                continue
+            targets = targets[np.argsort(other.starts[targets], kind='stable')]
+            target_starts = other.starts[targets]
+            longest = int((other.ends[targets] - target_starts).max())
+            # candidates start before the query ends and no earlier than the longest target could still reach it
+            lo = np.searchsorted(target_starts, self.starts[queries] - longest, side='left')
+            hi = np.searchsorted(target_starts, self.ends[queries], side='left')
+            counts = np.maximum(hi - lo, 0)
+            query_rep = np.repeat(queries, counts)
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            candidate = targets[np.repeat(lo, counts) + offsets]
+            hit = np.minimum(self.ends[query_rep], other.ends[candidate]) > np.maximum(self.starts[query_rep], other.starts[candidate])
+            self_indices.append(query_rep[hit])
+            other_indices.append(candidate[hit])
+        if not self_indices:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+        return np.concatenate(self_indices), np.concatenate(other_indices)
+
+    def cluster(self, distance):
+        '''cluster label of every position. A cluster is anchored at its first position in sorted order and holds
+        the following positions of the contig that start within distance bp of the anchor, so runs of nearby
+        positions are not chained into one cluster. Labels are numbered in sorted order'''
+        order = self.order()
+        if len(order) == 0:
+            return np.array([], dtype=np.int64)
+        codes = self.codes[order]
+        starts = self.starts[order]
+        new_cluster = np.zeros(len(order), dtype=bool)
+        boundaries = np.concatenate(([0], np.flatnonzero(codes[1:] != codes[:-1]) + 1, [len(order)]))
+        for contig_start, contig_end in zip(boundaries[:-1].tolist(), boundaries[1:].tolist()):
+            contig_starts = starts[contig_start:contig_end]
+            # the anchor of the cluster after the one anchored at i is the first position further than distance from i
+            next_anchor = np.searchsorted(contig_starts, contig_starts + distance, side='right').tolist()
+            anchor = 0
+            while anchor < len(next_anchor):
+                new_cluster[contig_start + anchor] = True
+                anchor = next_anchor[anchor]
+        labels = np.empty(len(order), dtype=np.int64)
+        labels[order] = np.cumsum(new_cluster) - 1
+
+        return labels
+
+    def collapse(self, distance=0):
+        '''one representative per cluster of positions within distance bp of its anchor, the anchor itself
+        returns (representatives, cluster label of every position)'''
+        labels = self.cluster(distance)
+        order = self.order()
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = labels[order][1:] != labels[order][:-1]
+
+        return self.take(order[first]), labels
+
+
+def get_canonical_annotation(long_annotation_string, decoder=None):
     '''vep output gives multiple annotations for a given loci, one is often only interested in the canonical sites
-    thus looks for |YES| string to find canonical annotation
+    thus looks for the annotation with CANONICAL=YES
     if canonical annotation is not found, just return the very first annotation'''
-    return_status = 0
-    for anno in long_annotation_string.split(','):
-        if re.search(r'|YES|', anno):
-            return_status =1 
-            return anno
+    return (decoder or DEFAULT_DECODER).canonical(long_annotation_string)
 
-    if return_status == 0:
-        return annotation.split(',')[0]
 
 
 
+ANNOTATE_VCF = '/home/users/cjyoon/scripts/annotate_vcf/annotate_vcf.py'
 
-def get_vep_annotation(genomic_position, reference_fasta):
-    '''temporarily create a minimal SNV vcf for a given genomic position
-    and then use this vcf to get variant information by running VEP
-    then parse the VEP output vcf to get the necessary variant annotation info
+def get_vep_annotations(genomic_positions, reference_fasta):
+    '''annotates many genomic positions with a single VEP run.
+    duplicated positions are annotated once. Every unique position becomes a minimal SNV in one temporary vcf
+    with the position string as its ID, which is used to map the canonical annotation back
+    returns {position string: canonical annotation as a csq.CSQRecord}
     '''
-    
-    temp_vcf = write_temp_vcf(genomic_position, reference_fasta)
-    # now run VEP annotation command
-    cmd = f'python /home/users/cjyoon/scripts/annotate_vcf/annotate_vcf.py -i {temp_vcf}'
-    subprocess.call(shlex.split(cmd))
-    
+    unique_positions = sorted(set(Position.fromstring(position) for position in genomic_positions), key=lambda p: (p.chromosome, p.start))
+    temp_dir = tempfile.mkdtemp(prefix='svanno_', dir='.')
+    temp_vcf = write_batch_vcf(unique_positions, reference_fasta, temp_dir)
+    # now run VEP annotation command once for all positions
+    cmd = f'python {ANNOTATE_VCF} -i {temp_vcf} -o {temp_dir}'
+    scheduler().run(cmd)
+
     vep_vcf = re.sub(r'.vcf$', '.vep.vcf.gz', temp_vcf)
+    canonical_annotations = dict()
+    decoder = DEFAULT_DECODER
     with gzip.open(vep_vcf, 'rt') as f:
         for line in f:
-            if not line.startswith('#'):
-                annotation = line.strip().split()[7].split('CSQ=')[1]
+            if line.startswith('##INFO=<ID=CSQ,'):
+                decoder = CSQDecoder.from_header(line)
+            elif not line.startswith('#'):
+                fields = line.strip().split('\t')
+                annotation = fields[7].split('CSQ=')[1].split(';')[0]
                 # multiple annotations per variant, now need to find which one is the canonical
-                canonical_annotation = get_canonical_annotation(annotation)
-    cleanup([vep_vcf, vep_vcf + '.tbi', temp_vcf])
-    return canonical_annotation
+                canonical_annotations[fields[2]] = decoder.decode(get_canonical_annotation(annotation, decoder))
+    cleanup([temp_dir])
+    return canonical_annotations
+
+def get_server_annotations(genomic_positions, reference_fasta, server):
+    '''annotates many genomic positions through a running annotation_server.py, without temporary files or a VEP run
+    returns {position string: canonical annotation as a csq.CSQRecord}'''
+    unique_positions = sorted(set(Position.fromstring(position) for position in genomic_positions), key=lambda p: (p.chromosome, p.start))
+    refbases = open_reference(reference_fasta).fetch_many([(position.chromosome, position.start) for position in unique_positions])
+    variants = []
+    for position in unique_positions:
+        fields = make_temp_variant(str(position), reference_fasta, refbases[(position.chromosome, position.start)]).split('\t')
+        variants.append((fields[0], int(fields[1]), fields[3], fields[4]))
+    with AnnotationClient(server) as client:
+        header, csqs = client.annotate(variants)
+    decoder = CSQDecoder.from_header(header)
+
+    return {str(position): decoder.decode(csq) for position, csq in zip(unique_positions, csqs)}
+
+def get_vep_annotation(genomic_position, reference_fasta, server=None):
+    '''temporarily create a minimal SNV vcf for a given genomic position
+    and then use this vcf to get variant information by running VEP
+    then parse the VEP output vcf to get the necessary variant annotation info
+    with server, the position is annotated by a running annotation server instead
+    '''
+    if server:
+        return get_server_annotations([genomic_position], reference_fasta, server)[str(Position.fromstring(genomic_position))]
+    return get_vep_annotations([genomic_position], reference_fasta)[str(Position.fromstring(genomic_position))]
 
 def cleanup(fileList):
     '''list of files to clean up after done getting the annotation'''
-    for afile in fileList:
-        subprocess.call(shlex.split('rm -rf ' + afile))
+    scheduler().run_all(['rm -rf ' + afile for afile in fileList])
 
     return 0
 
-def make_temp_variant(genomic_position, reference_fasta):
-    '''make a temporary VCF line that will be used as an input for VEP command'''
+def make_temp_variant(genomic_position, reference_fasta, refbase=None):
+    '''make a temporary VCF line that will be used as an input for VEP command
+    refbase is read from the shared reference unless given'''
     gPosition = Position.fromstring(genomic_position)
-    reference = pysam.FastaFile(reference_fasta)
-    refbase = reference.fetch(gPosition.chromosome, gPosition.start, gPosition.start + 1)
+    if refbase is None:
+        refbase = open_reference(reference_fasta).fetch(gPosition.chromosome, gPosition.start, gPosition.start + 1)
     bases = ['A', 'T', 'G', 'C']
 
     if refbase != 'N':
@@ -160,43 +324,124 @@ def write_temp_vcf(genomic_position, reference_fasta, temp_dir='.'):
     '''write a temporary vcf file that will be used as an input for VEP command'''
     temp_vcf = os.path.join(temp_dir, str(genomic_position) + '.vcf')
     with open(temp_vcf, 'w') as f:
-        f.write('##fileformat=VCFv4.1\n##reference=file:///path/to/human_g1k_v37.fasta\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+        f.write(TEMP_VCF_HEADER)
         variantString = make_temp_variant(genomic_position, reference_fasta)
         f.write(variantString)
 
     return temp_vcf
 
+def write_batch_vcf(genomic_positions, reference_fasta, temp_dir='.'):
+    '''write a single temporary vcf for many positions, the position string is written to the ID column'''
+    temp_vcf = os.path.join(temp_dir, 'breakpoints.vcf')
+    positions = [Position.fromstring(genomic_position) for genomic_position in genomic_positions]
+    # reference bases of all breakpoints are read in one sorted pass over the cached reference blocks
+    refbases = open_reference(reference_fasta).fetch_many([(position.chromosome, position.start) for position in positions])
+    with open(temp_vcf, 'w') as f:
+        f.write(TEMP_VCF_HEADER)
+        for genomic_position, position in zip(genomic_positions, positions):
+            fields = make_temp_variant(genomic_position, reference_fasta, refbases[(position.chromosome, position.start)]).split('\t')
+            fields[2] = str(genomic_position)
+            f.write('\t'.join(fields) + '\n')
 
-def sv_annotation(bp1_position, bp2_position, reference_fasta):
-    try:
-        bp1_canonical = get_vep_annotation(bp1_position, reference_fasta)
-        bp2_canonical = get_vep_annotation(bp2_position, reference_fasta)
-
-        bp1_intersect_gene = bp1_canonical.split('|')[3]
-        bp1_nearest_gene =  bp1_canonical.split('|')[35]
-        bp1_exon = bp1_canonical.split('|')[8]
-        bp1_intron =  bp1_canonical.split('|')[9]
-        bp1_consequence = annotation_consequence_adjust(bp1_canonical.split('|')[1])
-        bp1_strand = bp1_canonical.split('|')[20]
-
-        bp2_intersect_gene = bp2_canonical.split('|')[3]
-        bp2_nearest_gene =  bp2_canonical.split('|')[35]
-        bp2_exon = bp2_canonical.split('|')[8]
-        bp2_intron =  bp2_canonical.split('|')[9]
-        bp2_consequence = annotation_consequence_adjust(bp2_canonical.split('|')[1])
-        bp2_strand = bp2_canonical.split('|')[20]
-        return ( '|'.join([bp1_intersect_gene, bp1_strand, bp1_exon, bp1_intron, bp1_consequence, bp1_nearest_gene]), '|'.join([bp2_intersect_gene, bp2_strand, bp2_exon, bp2_intron, bp2_consequence, bp2_nearest_gene]))
-
-    except IndexError:
-        print(bp1_canonical)
-        print(bp1_canonical.split('|'))
-        print(len(bp1_canonical.split('|')))
-        print(bp2_canonical)
-        print(bp2_canonical.split('|'))
-        print(len(bp2_canonical.split('|')))
-        print('exiting...')
-        sys.exit()
+    return temp_vcf
+
+def breakpoint_annotation(canonical_annotation):
+    '''gene|strand|exon|intron|consequence|nearest string of a breakpoint from its canonical VEP annotation (csq.CSQRecord)'''
+    intersect_gene = canonical_annotation.SYMBOL
+    nearest_gene = canonical_annotation.NEAREST
+    exon = canonical_annotation.EXON
+    intron = canonical_annotation.INTRON
+    consequence = annotation_consequence_adjust(canonical_annotation.Consequence)
+    strand = canonical_annotation.STRAND
+    return '|'.join([intersect_gene, strand, exon, intron, consequence, nearest_gene])
+
+def sv_annotation(bp1_position, bp2_position, reference_fasta, engine='vep', gene_index=None, server=None):
+    return sv_annotations([(bp1_position, bp2_position)], reference_fasta, engine, gene_index, server=server)[0]
+
+def sv_annotations(breakpoint_pairs, reference_fasta, engine='vep', gene_index=None, cluster_distance=0, server=None, workers=1):
+    '''annotates a list of (bp1, bp2) pairs, each unique breakpoint is annotated once
+    with cluster_distance > 0, breakpoints within that many bp of the first breakpoint of their cluster are collapsed and annotated once
+    engine vep: a single VEP run over all unique breakpoints, or one request to the annotation server at server.
+    With workers > 1 the unique breakpoints are split into that many chunks annotated concurrently
+    engine native: lookup in a gene index compiled with gene_index.py, VEP is not used
+    returns a list of (bp1 annotation, bp2 annotation) in the same order'''
+    with metrics().stage('collapse') as stage:
+        breakpoint_strings = PositionArray.from_positions([bp for pair in breakpoint_pairs for bp in pair]).strings()
+        genomic_positions, representative = collapse_breakpoints(breakpoint_strings, cluster_distance)
+        stage.records += len(breakpoint_strings)
+
+    with metrics().stage('annotate_breakpoints') as stage:
+        if engine == 'native':
+            annotations = native_breakpoint_annotations(genomic_positions, gene_index)
+        else:
+            annotations = vep_breakpoint_annotations(genomic_positions, reference_fasta, server, workers)
+        stage.records += len(annotations)
+
+    return [(annotations[representative[breakpoint_strings[2 * i]]], annotations[representative[breakpoint_strings[2 * i + 1]]]) for i in range(len(breakpoint_pairs))]
+
+def collapse_breakpoints(breakpoint_strings, cluster_distance=0):
+    '''unique positions to annotate and {breakpoint: the position its annotation is taken from}
+    with cluster_distance > 0, the representatives of the clusters of breakpoints within that many bp'''
+    if cluster_distance <= 0:
+        genomic_positions = sorted(set(breakpoint_strings))
+        return genomic_positions, {position: position for position in genomic_positions}
+
+    representatives, labels = PositionArray.from_positions(breakpoint_strings).collapse(cluster_distance)
+    representative_strings = representatives.strings()
+    representative = {position: representative_strings[label] for position, label in zip(breakpoint_strings, labels.tolist())}
+    genomic_positions = sorted(set(representative.values()))
+    print(f'{len(set(breakpoint_strings))} unique breakpoints collapsed into {len(genomic_positions)} within {cluster_distance}bp')
+
+    return genomic_positions, representative
+
+def vep_breakpoint_annotations(genomic_positions, reference_fasta, server=None, workers=1):
+    '''{position string: gene|strand|exon|intron|consequence|nearest} from VEP runs over chunks of the positions,
+    or from the annotation server in requests of SERVER_BATCH_SIZE positions, workers of them at a time'''
+    unique_positions = sorted(set(genomic_positions))
+    chunk_size = SERVER_BATCH_SIZE if server else max(1, -(-len(unique_positions) // max(1, workers)))
+    chunks = [unique_positions[i:i + chunk_size] for i in range(0, len(unique_positions), chunk_size)]
+
+    def annotate_chunk(chunk):
+        if server:
+            return breakpoint_annotations(get_server_annotations(chunk, reference_fasta, server))
+        return breakpoint_annotations(get_vep_annotations(chunk, reference_fasta))
+
+    annotations = dict()
+    # an exception raised in a worker thread is raised again here when its result is taken
+    with concurrent.futures.ThreadPoolExecutor(max(1, min(len(chunks), workers if server else len(chunks)))) as executor:
+        for result in executor.map(annotate_chunk, chunks):
+            annotations.update(result)
+
+    return annotations
+
+def breakpoint_annotations(canonical_annotations):
+    '''{position string: gene|strand|exon|intron|consequence|nearest} of {position string: canonical annotation as a csq.CSQRecord}
+    raises ValueError for an annotation without the fields of a breakpoint annotation'''
+    annotations = dict()
+    for position, canonical_annotation in canonical_annotations.items():
+        try:
+            annotations[position] = breakpoint_annotation(canonical_annotation)
+        except (IndexError, AttributeError) as error:
+            raise ValueError(f'cannot annotate breakpoint {position} from {canonical_annotation!r}: {error}') from error
+
+    return annotations
 
+def native_breakpoint_annotations(genomic_positions, gene_index):
+    '''{position string: gene|strand|exon|intron|consequence|nearest} from a gene index compiled with gene_index.py
+    the position queried is the POS of the pseudo-SNV that would have been sent to VEP'''
+    if not isinstance(gene_index, GeneIndex):
+        gene_index = GeneIndex(gene_index)
+
+    by_chromosome = dict()
+    for position in set(Position.fromstring(position) for position in genomic_positions):
+        by_chromosome.setdefault(position.chromosome, []).append(position)
+
+    annotations = dict()
+    for chromosome, positions in by_chromosome.items():
+        for position, annotation in zip(positions, gene_index.annotate_positions(chromosome, [position.start for position in positions])):
+            annotations[str(position)] = annotation
+
+    return annotations
 
 
 def annotation_consequence_adjust(consequence):
@@ -218,13 +463,26 @@ def annotation_consequence_adjust(consequence):
 def argument_parser():
     parser = argparse.ArgumentParser(description='finds the gene overlapping/closest to the breakpoints involved in structural variations')
     parser.add_argument('breakpoints', nargs=2, help='two breakpoints separated by a space')
+    parser.add_argument('-e', '--engine', required=False, default='vep', choices=['vep', 'native'], help='vep: annotate with VEP, native: annotate from a gene index compiled with gene_index.py. Default=vep')
+    parser.add_argument('-x', '--gene_index', required=False, default=None, help='Gene index compiled with gene_index.py, required for --engine native')
+    parser.add_argument('-s', '--server', required=False, default=None, help='Unix socket of a running annotation_server.py, used by --engine vep instead of starting VEP')
+    parser.add_argument('--metrics', required=False, default=None, help='Write time per stage, external tool runs, records, bytes and peak memory of the run to this JSON file')
+    parser.add_argument('--profile', required=False, action='store_true', help='Sample the hot loops and add their most frequent frames to --metrics')
     args = vars(parser.parse_args())
-    return args['breakpoints'][0], args['breakpoints'][1]
+    if args['engine'] == 'native' and args['gene_index'] is None:
+        parser.error('--engine native requires --gene_index')
+    return args['breakpoints'][0], args['breakpoints'][1], args['engine'], args['gene_index'], args['server'], args['metrics'], args['profile']
 
 def main():
-    bp1, bp2 = argument_parser()
+    bp1, bp2, engine, gene_index, server, metrics_path, profile = argument_parser()
+    configure_metrics(metrics_path, profile)
     if Position.check_format(bp1) and Position.check_format(bp2):
-        svanno = sv_annotation(bp1, bp2, '/home/users/data/01_reference/human_g1k_v37/human_g1k_v37.fasta')
+        try:
+            svanno = sv_annotation(bp1, bp2, DEFAULT_REFERENCE, engine, gene_index, server)
+        except ValueError as error:
+            print(error)
+            print('Exiting...')
+            sys.exit(1)
         print(svanno)
     else:
         sys.exit()
@@ -0,0 +1,87 @@
+import os
+import sys
+import gzip
+import subprocess
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARK_DIR = os.path.join(REPO_DIR, 'benchmarks')
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+import synthetic
+from annotation_cache import AnnotationCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = AnnotationCache(str(tmp_path / 'cache.sqlite'), max_entries=3)
+    yield cache
+    cache.close()
+
+
+def test_hits_and_misses(cache):
+    cache.put_many('GRCh37', 75, {('1', 100, 'A', 'T'): 'T|intron_variant', ('1', 200, 'G', 'C'): 'C|missense_variant'})
+    hits = cache.get_many('GRCh37', 75, [('1', 100, 'A', 'T'), ('1', 100, 'A', 'G'), ('2', 200, 'G', 'C'), ('1', 200, 'G', 'C')])
+    assert hits == {('1', 100, 'A', 'T'): 'T|intron_variant', ('1', 200, 'G', 'C'): 'C|missense_variant'}
+    # entries of another assembly or VEP cache version are not hits
+    assert cache.get_many('GRCh38', 75, [('1', 100, 'A', 'T')]) == {}
+    assert cache.get_many('GRCh37', 94, [('1', 100, 'A', 'T')]) == {}
+
+
+def test_least_recently_used_are_evicted(cache):
+    keys = [('1', pos, 'A', 'T') for pos in (100, 200, 300)]
+    for key in keys:
+        cache.put_many('GRCh37', 75, {key: f'T|{key[1]}'})
+    cache.get_many('GRCh37', 75, [keys[0]])
+    cache.put_many('GRCh37', 75, {('1', 400, 'A', 'T'): 'T|400'})
+
+    assert len(cache) == 3
+    assert set(cache.get_many('GRCh37', 75, keys + [('1', 400, 'A', 'T')])) == {keys[0], keys[2], ('1', 400, 'A', 'T')}
+
+
+def test_updates_do_not_grow_the_cache(cache):
+    cache.put_many('GRCh37', 75, {('1', 100, 'A', 'T'): 'old'})
+    cache.put_many('GRCh37', 75, {('1', 100, 'A', 'T'): 'new'})
+    assert len(cache) == 1
+    assert cache.get_many('GRCh37', 75, [('1', 100, 'A', 'T')]) == {('1', 100, 'A', 'T'): 'new'}
+
+
+def test_entries_and_header_persist(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    first = AnnotationCache(path)
+    first.put_many('GRCh37', 75, {('1', pos, 'A', 'T'): 'T|x' for pos in range(1, 501)})
+    first.set_csq_header('GRCh37', 75, synthetic.CSQ_HEADER.strip())
+    first.close()
+
+    second = AnnotationCache(path)
+    assert len(second) == 500
+    assert second.csq_header('GRCh37', 75) == synthetic.CSQ_HEADER.strip()
+    assert second.csq_header('GRCh38', 75) is None
+    second.close()
+
+
+def records(path):
+    with gzip.open(path, 'rt') as f:
+        return [line for line in f if not line.startswith('#')]
+
+
+def test_second_run_is_answered_from_the_cache(tmp_path):
+    sequences = synthetic.write_fasta(str(tmp_path / 'reference.fa'), [('1', 30000)], seed=13)
+    synthetic.write_vcf(str(tmp_path / 'tumor.vcf'), 'mutect', sequences, 150, seed=13)
+    cache_path = str(tmp_path / 'cache.sqlite')
+
+    outputs, messages = [], []
+    # the second run has no VEP at all, every record has to come from the cache
+    for run, vep_path in enumerate([os.path.join(BENCHMARK_DIR, 'fake_vep.py'), str(tmp_path / 'no_vep')]):
+        output_dir = tmp_path / f'run{run}'
+        output_dir.mkdir()
+        result = subprocess.run([sys.executable, os.path.join(REPO_DIR, 'annotate_vcf.py'), '-i', str(tmp_path / 'tumor.vcf'), '-o', str(output_dir), '-c', cache_path],
+            capture_output=True, text=True, env=dict(os.environ, VEP_PATH=vep_path))
+        assert result.returncode == 0, result.stdout + result.stderr
+        outputs.append(records(output_dir / 'tumor.vep.vcf.gz'))
+        messages.append(result.stdout)
+
+    assert '0 hits, 150 misses' in messages[0]
+    assert '150 hits, 0 misses' in messages[1]
+    assert outputs[0] == outputs[1]
+    assert all('CSQ=' in line for line in outputs[1])
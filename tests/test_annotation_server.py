@@ -0,0 +1,99 @@
+import os
+import sys
+import json
+import socket
+import threading
+import subprocess
+import pytest
+import cyvcf2
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARK_DIR = os.path.join(REPO_DIR, 'benchmarks')
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+from annotation_server import AnnotationServer, AnnotationClient, worker_command, SERVER_BATCH_SIZE, MAX_REQUEST_VARIANTS
+from csq import CSQDecoder
+import synthetic
+from synthetic import CSQ_HEADER, variant_csq
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    '''an annotation server with one fake VEP worker, serving from a thread'''
+    monkeypatch.setenv('VEP_PATH', os.path.join(BENCHMARK_DIR, 'fake_vep.py'))
+    server = AnnotationServer(str(tmp_path / 'vep.sock'), worker_command('GRCh37', 75), 'GRCh37', 75, workers=1)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def variants(n):
+    return [('1', 1000 + 7 * i, 'ACGT'[i % 4], 'ACGT'[(i + 1) % 4]) for i in range(n)]
+
+
+def expected_csq(variant):
+    return CSQDecoder.from_header(CSQ_HEADER.rstrip('\n')).canonical(variant_csq(*map(str, variant)))
+
+
+def test_client_splits_large_requests(server):
+    requested = variants(2 * SERVER_BATCH_SIZE + 500)
+    with AnnotationClient(server.server_address) as client:
+        assert client.ping()['workers'] == 1
+        header, csqs = client.annotate(requested, 'GRCh37')
+
+    assert header == CSQ_HEADER.rstrip('\n')
+    assert csqs == [expected_csq(variant) for variant in requested]
+
+
+def test_server_refuses_oversized_requests(server):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(server.server_address)
+        stream = connection.makefile('rw')
+        stream.write(json.dumps({'op': 'annotate', 'variants': [list(variant) for variant in variants(MAX_REQUEST_VARIANTS + 1)]}) + '\n')
+        stream.flush()
+        assert 'send at most' in json.loads(stream.readline())['error']
+
+
+def test_dead_worker_is_replaced(server):
+    worker = server.workers[0]
+    dead_pid = worker.process.pid
+    worker.process.kill()
+    worker.process.wait()
+
+    with AnnotationClient(server.server_address) as client:
+        with pytest.raises(RuntimeError, match='exited'):
+            client.annotate(variants(10))
+        header, csqs = client.annotate(variants(10))
+
+    assert worker.process.pid != dead_pid
+    assert csqs == [expected_csq(variant) for variant in variants(10)]
+
+
+def annotated_info(path):
+    return [(variant.CHROM, variant.POS, variant.ALT, variant.INFO.get('CSQ')) for variant in cyvcf2.VCF(str(path))]
+
+
+def test_server_mode_matches_vep(server, tmp_path):
+    sequences = synthetic.write_fasta(str(tmp_path / 'reference.fa'), [('1', 20000)], seed=5)
+    synthetic.write_vcf(str(tmp_path / 'records.vcf'), 'strelka', sequences, 40, seed=5)
+    # every fourth record is a spanning deletion, which VEP leaves without CSQ
+    with open(tmp_path / 'records.vcf') as records, open(tmp_path / 'tumor.vcf', 'w') as f:
+        for i, line in enumerate(records):
+            fields = line.split('\t')
+            if not line.startswith('#') and i % 4 == 0:
+                fields[4] = '*'
+            f.write('\t'.join(fields))
+
+    outputs = dict()
+    for mode, args in [('vep', ['--stream']), ('server', ['--server', server.server_address])]:
+        (tmp_path / mode).mkdir()
+        command = [sys.executable, os.path.join(REPO_DIR, 'annotate_vcf.py'), '-i', str(tmp_path / 'tumor.vcf'), '-o', str(tmp_path / mode)] + args
+        result = subprocess.run(command, capture_output=True, text=True)
+        assert result.returncode == 0, result.stdout + result.stderr
+        outputs[mode] = annotated_info(tmp_path / mode / 'tumor.vep.vcf.gz')
+
+    assert outputs['server'] == outputs['vep']
+    assert any(csq is None for _, _, _, csq in outputs['server'])
+    assert any(csq is not None for _, _, _, csq in outputs['server'])
@@ -0,0 +1,131 @@
+import os
+import sys
+import json
+import subprocess
+import cyvcf2
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARK_DIR = os.path.join(REPO_DIR, 'benchmarks')
+FAKE_VEP = os.path.join(BENCHMARK_DIR, 'fake_vep.py')
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+import synthetic
+from csq import CSQDecoder
+from run_benchmarks import compare
+
+CONTIGS = [('1', 30000), ('2', 20000)]
+
+
+@pytest.fixture(scope='module')
+def sequences(tmp_path_factory):
+    return synthetic.write_fasta(str(tmp_path_factory.mktemp('reference') / 'reference.fa'), CONTIGS, seed=3)
+
+
+@pytest.mark.parametrize('style', synthetic.STYLES)
+def test_same_seed_writes_the_same_vcf(tmp_path, sequences, style):
+    sites = [synthetic.write_vcf(str(tmp_path / f'{seed}_{copy}.vcf'), style, sequences, 60, seed=seed) for seed, copy in ((5, 'a'), (5, 'b'), (6, 'a'))]
+    assert (tmp_path / '5_a.vcf').read_bytes() == (tmp_path / '5_b.vcf').read_bytes()
+    assert (tmp_path / '5_a.vcf').read_bytes() != (tmp_path / '6_a.vcf').read_bytes()
+
+    records = list(cyvcf2.VCF(str(tmp_path / '5_a.vcf')))
+    assert [(variant.CHROM, variant.POS) for variant in records] == sites[0]
+    assert len(records) == 60 and sites[0] == sorted(sites[0], key=lambda site: (site[0], site[1]))
+    if style != 'delly':
+        assert all(variant.REF == sequences[variant.CHROM][variant.POS - 1] for variant in records)
+
+
+def test_variant_csq_depends_only_on_the_variant():
+    decoder = CSQDecoder.default()
+    assert synthetic.variant_csq('1', 100, 'A', 'T') == synthetic.variant_csq('1', '100', 'A', 'T')
+    assert synthetic.variant_csq('1', 100, 'A', 'T') != synthetic.variant_csq('1', 100, 'A', 'G')
+    for pos in range(1000, 1200):
+        csq = synthetic.variant_csq('1', pos, 'A', 'T')
+        annotations = [decoder.decode(annotation) for annotation in csq.split(',')]
+        assert all(annotation['Allele'] == 'T' for annotation in annotations)
+        assert sum(annotation['CANONICAL'] == 'YES' for annotation in annotations) <= 1
+        assert sum(annotation['PICK'] == '1' for annotation in annotations) == 1
+
+
+def run_fake_vep(args, stdin=None, env=None):
+    return subprocess.run([sys.executable, FAKE_VEP] + args, input=stdin, capture_output=True, text=True, env=dict(os.environ, **(env or dict())))
+
+
+def records(text):
+    return [line.split('\t') for line in text.splitlines() if not line.startswith('#')]
+
+
+def test_fake_vep_adds_the_csq_of_every_alt(tmp_path, sequences):
+    path = str(tmp_path / 'input.vcf')
+    synthetic.write_vcf(path, 'freebayes', sequences, 40, seed=2)
+    with open(path) as f:
+        lines = f.readlines()
+    # a multiallelic record and a record left to a spanning deletion
+    fields = lines[-2].rstrip('\n').split('\t')
+    lines[-2] = '\t'.join(fields[:4] + ['C,G'] + fields[5:]) + '\n'
+    fields = lines[-1].rstrip('\n').split('\t')
+    lines[-1] = '\t'.join(fields[:4] + ['*'] + fields[5:]) + '\n'
+    with open(path, 'w') as f:
+        f.writelines(lines)
+
+    result = run_fake_vep(['-i', path, '-o', str(tmp_path / 'output.vcf'), '--vcf', '--offline'])
+    assert result.returncode == 0, result.stderr
+    output = (tmp_path / 'output.vcf').read_text()
+    assert synthetic.CSQ_HEADER in output
+    annotated, original = records(output), records(''.join(lines))
+    assert len(annotated) == len(original) == 40
+    for fields, input_fields in zip(annotated[:-1], original):
+        csq = ','.join(synthetic.variant_csq(fields[0], fields[1], fields[3], alt) for alt in fields[4].split(','))
+        assert fields[7] == f'CSQ={csq}'
+        assert fields[:7] + fields[8:] == input_fields[:7] + input_fields[8:]
+    assert len(annotated[-2][7].split(',')) > 1
+    assert annotated[-1] == original[-1]
+
+
+def test_fake_vep_reads_stdin_only_with_a_format(sequences, tmp_path):
+    path = str(tmp_path / 'input.vcf')
+    synthetic.write_vcf(path, 'mutect', sequences, 10, seed=2)
+    with open(path) as f:
+        text = f.read()
+
+    result = run_fake_vep(['-i', '/dev/stdin', '-o', 'STDOUT'], stdin=text)
+    assert result.returncode == 1 and 'specify format with --format' in result.stderr
+    result = run_fake_vep(['-i', '/dev/stdin', '-o', 'STDOUT', '--format', 'vcf'], stdin=text)
+    assert result.returncode == 0, result.stderr
+    assert len(records(result.stdout)) == 10 and all('CSQ=' in fields[7] for fields in records(result.stdout))
+
+
+def test_fake_vep_exit_after(sequences, tmp_path):
+    path = str(tmp_path / 'input.vcf')
+    synthetic.write_vcf(path, 'mutect', sequences, 30, seed=2)
+    result = run_fake_vep(['-i', path, '-o', 'STDOUT'], env={'FAKE_VEP_EXIT_AFTER': '12'})
+    assert result.returncode == 1
+    assert len(records(result.stdout)) == 12
+
+
+def test_compare():
+    baseline = {'records_per_sec': 1000.0, 'peak_rss_mb': 100.0}
+    assert compare({'records_per_sec': 900.0, 'peak_rss_mb': 105.0}, baseline, 0.2) == []
+    assert compare({'records_per_sec': 700.0, 'peak_rss_mb': 130.0}, baseline, 0.2) == ['records/sec 700 < 1000', 'peak RSS 130.0MB > 100.0MB']
+
+
+def test_baseline_round_trip(tmp_path):
+    baseline = tmp_path / 'baseline.json'
+    command = [sys.executable, os.path.join(BENCHMARK_DIR, 'run_benchmarks.py'), '-s', '50', '--stages', 'canonical_csq', 'vep_stream', 'sv_collapse',
+        '-w', str(tmp_path / 'work'), '-b', str(baseline)]
+    result = subprocess.run(command + ['--save_baseline'], capture_output=True, text=True)
+    assert result.returncode == 0, result.stdout + result.stderr
+
+    saved = json.loads(baseline.read_text())
+    assert sorted(saved) == ['canonical_csq', 'sv_collapse', 'vep_stream']
+    assert all(saved[stage]['50']['records'] == 50 and saved[stage]['50']['records_per_sec'] > 0 for stage in saved)
+
+    # a baseline no run can keep up with
+    saved['canonical_csq']['50']['records_per_sec'] *= 1000
+    baseline.write_text(json.dumps(saved))
+    result = subprocess.run(command + ['--tolerance', '0.95'], capture_output=True, text=True)
+    assert result.returncode == 1
+    lines = {line.split()[0]: line for line in result.stdout.splitlines() if line.split() and line.split()[0] in saved}
+    assert 'REGRESSION records/sec' in lines['canonical_csq']
+    assert lines['sv_collapse'].endswith('x') and lines['vep_stream'].endswith('x')
+    assert '1 regressions beyond 95%' in result.stdout
@@ -0,0 +1,85 @@
+import os
+import sys
+import gzip
+import random
+import shutil
+import pysam
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bgzf import BgzfWriter, VcfWriter, EOF_BLOCK, index_vcf
+
+
+def vcf_text(contig_length=5000000, n=20000, seed=4):
+    '''header and sorted records of two contigs, with deletions of up to 2 kb so that records span bins'''
+    rng = random.Random(seed)
+    lines = ['##fileformat=VCFv4.2\n'] + [f'##contig=<ID={contig},length={contig_length}>\n' for contig in ('1', '2')]
+    lines.append('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+    for contig in ('1', '2'):
+        for pos in sorted(rng.sample(range(1, min(contig_length, 5000000) - 3000), n // 2)):
+            ref = 'A' * rng.choice([1, 1, 1, 5, 40, 2000])
+            lines.append(f'{contig}\t{pos}\t.\t{ref}\tA\t.\tPASS\tDP={rng.randint(1, 500)}\n')
+    return lines
+
+
+def regions(seed=9):
+    rng = random.Random(seed)
+    starts = [rng.randint(1, 4990000) for _ in range(60)]
+    return [(contig, start, start + rng.choice([1, 100, 20000, 300000])) for contig in ('1', '2', '3') for start in starts[:20]] + [('1', 1, 5000000)]
+
+
+def fetch_all(path, index):
+    with pysam.TabixFile(path, index=index) as tabix:
+        return [list(tabix.fetch(contig, start - 1, end)) if contig in tabix.contigs else [] for contig, start, end in regions()]
+
+
+def test_blocks_decompress_to_the_input(tmp_path):
+    data = ''.join(vcf_text(n=4000)).encode()
+    for threads in (1, 4):
+        with BgzfWriter(str(tmp_path / f'{threads}.gz'), threads=threads) as f:
+            for i in range(0, len(data), 7919):
+                f.write(data[i:i + 7919])
+    single, threaded = (open(tmp_path / f'{threads}.gz', 'rb').read() for threads in (1, 4))
+    assert single == threaded
+    assert single.endswith(EOF_BLOCK)
+    assert gzip.decompress(single) == data
+
+
+@pytest.mark.parametrize('contig_length, suffix', [(5000000, '.tbi'), (1 << 30, '.csi')])
+def test_inline_index_answers_like_tabix(tmp_path, contig_length, suffix):
+    lines = vcf_text(contig_length)
+    written = str(tmp_path / 'written.vcf.gz')
+    with VcfWriter(written, threads=2) as f:
+        for i in range(0, len(lines), 1000):
+            f.write(''.join(lines[i:i + 1000]))
+    assert os.path.exists(written + suffix)
+
+    # the same file indexed by htslib
+    reference = str(tmp_path / 'reference.vcf.gz')
+    shutil.copy(written, reference)
+    pysam.tabix_index(reference, preset='vcf', force=True, csi=suffix == '.csi')
+
+    fetched = fetch_all(written, written + suffix)
+    assert fetched == fetch_all(reference, reference + suffix)
+    assert sum(len(records) for records in fetched) > 1000
+
+
+def test_appended_output_is_indexed_on_close(tmp_path):
+    lines = vcf_text(n=6000)
+    path = str(tmp_path / 'appended.vcf.gz')
+    first = VcfWriter(path)
+    first.write(''.join(lines[:2500]))
+    first.flush()
+    offset = first.tell()
+    first.handle.close()
+
+    with VcfWriter(path, offset=offset) as f:
+        f.write(''.join(lines[2500:]))
+
+    with gzip.open(path, 'rt') as f:
+        assert f.readlines() == lines
+    assert index_vcf(path) == path + '.tbi'
+    reference = str(tmp_path / 'reference.vcf.gz')
+    shutil.copy(path, reference)
+    pysam.tabix_index(reference, preset='vcf', force=True)
+    assert fetch_all(path, path + '.tbi') == fetch_all(reference, reference + '.tbi')
@@ -0,0 +1,42 @@
+import os
+import sys
+import gzip
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARK_DIR = os.path.join(REPO_DIR, 'benchmarks')
+sys.path.insert(0, BENCHMARK_DIR)
+import synthetic
+
+
+def annotate(input_vcf, output_dir, *args, exit_after=None):
+    env = dict(os.environ, VEP_PATH=os.path.join(BENCHMARK_DIR, 'fake_vep.py'))
+    if exit_after is not None:
+        env['FAKE_VEP_EXIT_AFTER'] = str(exit_after)
+    command = [sys.executable, os.path.join(REPO_DIR, 'annotate_vcf.py'), '-i', str(input_vcf), '-o', str(output_dir), '--stream'] + [str(arg) for arg in args]
+    return subprocess.run(command, capture_output=True, text=True, env=env)
+
+
+def test_resumed_run_matches_an_uninterrupted_run(tmp_path):
+    sequences = synthetic.write_fasta(str(tmp_path / 'reference.fa'), [('1', 40000)], seed=3)
+    input_vcf = tmp_path / 'tumor.vcf'
+    synthetic.write_vcf(str(input_vcf), 'mutect', sequences, 400, seed=3)
+    with open(input_vcf) as f:
+        assert any(':0.0' in line for line in f if not line.startswith('#'))
+
+    for name in ('whole', 'resumed'):
+        (tmp_path / name).mkdir()
+
+    result = annotate(input_vcf, tmp_path / 'whole', '--checkpoint', 50)
+    assert result.returncode == 0, result.stdout + result.stderr
+
+    killed = annotate(input_vcf, tmp_path / 'resumed', '--checkpoint', 50, exit_after=230)
+    assert killed.returncode != 0
+    resumed = annotate(input_vcf, tmp_path / 'resumed', '--checkpoint', 50, '--resume')
+    assert resumed.returncode == 0, resumed.stdout + resumed.stderr
+    assert 'resuming' in resumed.stdout and 'after 200 records' in resumed.stdout
+
+    with gzip.open(tmp_path / 'whole' / 'tumor.vep.vcf.gz', 'rt') as f:
+        whole = f.read()
+    with gzip.open(tmp_path / 'resumed' / 'tumor.vep.vcf.gz', 'rt') as f:
+        assert f.read() == whole
@@ -0,0 +1,89 @@
+import os
+import sys
+import cyvcf2
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from csq import DEFAULT_CSQ_FORMAT
+from expression import FilterExpression, tokenize
+
+CSQ_FIELDS = DEFAULT_CSQ_FORMAT.split('|')
+HEADER = f'''##fileformat=VCFv4.2
+##contig=<ID=1,length=100000>
+##INFO=<ID=PON_VAF,Number=1,Type=Float,Description="VAF in Panel of Normals">
+##INFO=<ID=PON_DEPTH,Number=1,Type=Float,Description="Total depth in Panel of Normals">
+##INFO=<ID=CSQ,Number=.,Type=String,Description="Consequence annotations from Ensembl VEP. Format: {DEFAULT_CSQ_FORMAT}">
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+##FORMAT=<ID=FA,Number=A,Type=Float,Description="Allele fraction">
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tNORMAL\tTUMOR
+'''
+
+
+def csq(**values):
+    return '|'.join(values.get(field, '') for field in CSQ_FIELDS)
+
+
+# name, INFO, NORMAL:TUMOR as GT:FA
+RECORDS = {
+    'common': (f'PON_VAF=0.3;PON_DEPTH=250;CSQ={csq(SYMBOL="TP53", IMPACT="HIGH", CANONICAL="YES", MAX_AF="0.2")}', '0/0:0.01', '0/1:0.45'),
+    'rare': (f'PON_VAF=0.001;PON_DEPTH=120;CSQ={csq(SYMBOL="OTHER", IMPACT="LOW")},{csq(SYMBOL="KRAS", IMPACT="MODERATE", CANONICAL="YES")}', '0/0:0', '0/1:0.2'),
+    'no_pon': (f'CSQ={csq(SYMBOL="EGFR", IMPACT="MODIFIER", CANONICAL="YES", MAX_AF="0.0001&0.002")}', '0/0:.', '1/1:0.9'),
+    'unannotated': ('PON_VAF=0;PON_DEPTH=40', '0/0:0', '0|1:0.05'),
+}
+
+
+@pytest.fixture(scope='module')
+def vcf_path(tmp_path_factory):
+    path = tmp_path_factory.mktemp('expression') / 'records.vcf'
+    with open(path, 'w') as f:
+        f.write(HEADER)
+        for pos, (name, (info, normal, tumor)) in enumerate(RECORDS.items(), start=1):
+            f.write(f'1\t{pos * 100}\t{name}\tA\tT\t.\tPASS\t{info}\tGT:FA\t{normal}\t{tumor}\n')
+    return str(path)
+
+
+def passing(vcf_path, expression):
+    vcf_handle = cyvcf2.VCF(vcf_path)
+    keep = FilterExpression(expression, vcf_handle)
+    return [variant.ID for variant in vcf_handle if keep(variant)]
+
+
+def test_tokenize():
+    assert tokenize("PON_VAF<0.02 && CSQ/SYMBOL == 'TP53'") == [('field', 'PON_VAF'), ('op', '<'), ('number', '0.02'), ('op', '&&'),
+        ('field', 'CSQ/SYMBOL'), ('op', '=='), ('string', "'TP53'")]
+    assert tokenize('FORMAT/FA[1] >= -1e-3') == [('field', 'FORMAT/FA[1]'), ('op', '>='), ('number', '-1e-3')]
+
+
+@pytest.mark.parametrize('expression, expected', [
+    ('PON_VAF < 0.02', ['rare', 'unannotated']),
+    # a missing value fails every comparison, also !=
+    ('PON_VAF != 0.3', ['rare', 'unannotated']),
+    ('!(PON_VAF >= 0.02)', ['rare', 'no_pon', 'unannotated']),
+    ('PON_DEPTH >= 100 || IMPACT == "MODIFIER" && MAX_AF < 0.001', ['common', 'rare', 'no_pon']),
+    ('(PON_DEPTH >= 100 || IMPACT == "MODIFIER") && MAX_AF < 0.001', ['no_pon']),
+    # the canonical annotation is used, not the first one
+    ("SYMBOL == 'KRAS'", ['rare']),
+    ("CSQ/IMPACT != 'LOW'", ['common', 'rare', 'no_pon']),
+    ('FORMAT/FA[1] > 0.3', ['common', 'no_pon']),
+    ('FMT/FA > 0', ['common']),
+    ("FORMAT/GT[1] == '0|1' || FORMAT/GT[1] == '1/1'", ['no_pon', 'unannotated']),
+    # text compared to a number is false
+    ('SYMBOL > 1', []),
+])
+def test_filter(vcf_path, expression, expected):
+    assert passing(vcf_path, expression) == expected
+
+
+@pytest.mark.parametrize('expression, message', [
+    ('PON_VAF <', 'Unexpected end'),
+    ('(PON_VAF < 1', 'Unexpected end'),
+    ('PON_VAF < 1)', 'Unexpected \\)'),
+    ('PON_VAF 1', 'Expected a comparison'),
+    ('NOT_A_FIELD > 1', 'neither an INFO field nor a CSQ field'),
+    ('INFO/SYMBOL > 1', 'not an INFO field'),
+    ('FORMAT/DP > 1', 'not a FORMAT field'),
+    ('PON_VAF < 1 ; rm', 'Cannot parse expression'),
+])
+def test_errors(vcf_path, expression, message):
+    with pytest.raises(ValueError, match=message):
+        FilterExpression(expression, cyvcf2.VCF(vcf_path))
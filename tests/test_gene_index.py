@@ -0,0 +1,100 @@
+import os
+import sys
+import gzip
+import subprocess
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+from gene_index import GeneIndex, compile_gene_index, parse_attributes
+
+# gene id, name, biotype, strand, transcripts as (transcript id, canonical, exons)
+GENES = [
+    ('GA', 'ALPHA', 'protein_coding', '+', [('TA1', True, [(1000, 1200), (2000, 2200), (4800, 5000)]), ('TA2', False, [(1000, 1500), (2000, 4000), (4500, 5000)])]),
+    ('GC', 'INSIDE', 'lncRNA', '+', [('TC1', False, [(3000, 3500)])]),
+    ('GB', 'BETA', 'protein_coding', '-', [('TB1', False, [(20000, 20500), (29500, 30000)]), ('TB2', False, [(20000, 20100), (29900, 30000)])]),
+]
+
+
+def write_gtf(path):
+    with gzip.open(path, 'wt') as f:
+        f.write('#!genome-build test\n')
+        for gene_id, name, biotype, strand, transcripts in GENES:
+            common = f'gene_id "{gene_id}"; gene_name "{name}"; gene_biotype "{biotype}";'
+            start, end = min(s for t in transcripts for s, e in t[2]), max(e for t in transcripts for s, e in t[2])
+            f.write(f'1\ttest\tgene\t{start}\t{end}\t.\t{strand}\t.\t{common}\n')
+            for transcript_id, canonical, exons in transcripts:
+                tag = ' tag "basic"; tag "Ensembl_canonical";' if canonical else ' tag "basic";'
+                f.write(f'1\ttest\ttranscript\t{exons[0][0]}\t{exons[-1][1]}\t.\t{strand}\t.\t{common} transcript_id "{transcript_id}";{tag}\n')
+                for exon_start, exon_end in exons:
+                    f.write(f'1\ttest\texon\t{exon_start}\t{exon_end}\t.\t{strand}\t.\t{common} transcript_id "{transcript_id}";{tag}\n')
+                    f.write(f'1\ttest\tCDS\t{exon_start}\t{exon_end}\t.\t{strand}\t0\t{common} transcript_id "{transcript_id}";\n')
+
+
+def write_gff3(path):
+    with open(path, 'w') as f:
+        f.write('##gff-version 3\n')
+        for gene_id, name, biotype, strand, transcripts in GENES:
+            start, end = min(s for t in transcripts for s, e in t[2]), max(e for t in transcripts for s, e in t[2])
+            feature = 'gene' if biotype == 'protein_coding' else 'ncRNA_gene'
+            f.write(f'1\ttest\t{feature}\t{start}\t{end}\t.\t{strand}\t.\tID=gene:{gene_id};Name={name};biotype={biotype}\n')
+            for transcript_id, canonical, exons in transcripts:
+                tag = ';tag=basic,Ensembl_canonical' if canonical else ''
+                feature = 'mRNA' if biotype == 'protein_coding' else 'lnc_RNA'
+                f.write(f'1\ttest\t{feature}\t{exons[0][0]}\t{exons[-1][1]}\t.\t{strand}\t.\tID=transcript:{transcript_id};Parent=gene:{gene_id}{tag}\n')
+                for exon_start, exon_end in exons:
+                    f.write(f'1\ttest\texon\t{exon_start}\t{exon_end}\t.\t{strand}\t.\tParent=transcript:{transcript_id}\n')
+
+
+@pytest.fixture(scope='module', params=['gtf', 'gff3'])
+def gene_index(request, tmp_path_factory):
+    directory = tmp_path_factory.mktemp(request.param)
+    if request.param == 'gtf':
+        annotation = str(directory / 'genes.gtf.gz')
+        write_gtf(annotation)
+    else:
+        annotation = str(directory / 'genes.gff3')
+        write_gff3(annotation)
+    compile_gene_index(annotation, str(directory / 'genes.gidx.npz'))
+    return GeneIndex(str(directory / 'genes.gidx.npz'))
+
+
+@pytest.mark.parametrize('pos, expected', [
+    (1100, 'ALPHA|1|1/3||exonic_variant|ALPHA'),
+    # exon 2 of the canonical transcript, not of the longer TA2
+    (2100, 'ALPHA|1|2/3||exonic_variant|ALPHA'),
+    (1500, 'ALPHA|1||1/2|intron_variant|ALPHA'),
+    # in an intron of ALPHA and the exon of INSIDE, the exon wins
+    (3200, 'INSIDE|1|1/1||exonic_variant|ALPHA'),
+    (4000, 'ALPHA|1||2/2|intron_variant|ALPHA'),
+    # exons of a minus strand gene are numbered from its end
+    (29600, 'BETA|-1|1/2||exonic_variant|BETA'),
+    (20200, 'BETA|-1|2/2||exonic_variant|BETA'),
+    (25000, 'BETA|-1||1/1|intron_variant|BETA'),
+    (8000, 'ALPHA|1|||downstream_gene_variant|ALPHA'),
+    (17000, 'BETA|-1|||downstream_gene_variant|BETA'),
+    (32000, 'BETA|-1|||upstream_gene_variant|BETA'),
+    (500, 'ALPHA|1|||upstream_gene_variant|ALPHA'),
+    (12000, '||||intergenic_variant|ALPHA'),
+])
+def test_annotate(gene_index, pos, expected):
+    assert gene_index.annotate('1', pos) == expected
+
+
+def test_annotate_positions_matches_single_queries(gene_index):
+    positions = list(range(1, 40000, 97))
+    assert gene_index.annotate_positions('1', positions) == [gene_index.annotate('1', pos) for pos in positions]
+    assert gene_index.annotate_positions('2', [100, 200]) == ['||||intergenic_variant|'] * 2
+
+
+def test_parse_attributes():
+    assert parse_attributes('gene_id "G1"; tag "basic"; tag "CCDS";') == {'gene_id': ['G1'], 'tag': ['basic', 'CCDS']}
+    assert parse_attributes('ID=transcript:T1;Parent=gene:G1;tag=basic,MANE_Select') == {'ID': ['transcript:T1'], 'Parent': ['gene:G1'], 'tag': ['basic', 'MANE_Select']}
+
+
+def test_command_line(tmp_path):
+    write_gtf(str(tmp_path / 'genes.gtf.gz'))
+    result = subprocess.run([sys.executable, os.path.join(REPO_DIR, 'gene_index.py'), '-i', str(tmp_path / 'genes.gtf.gz'), '-o', str(tmp_path / 'index.npz')], capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert '3 genes on 1 contigs' in result.stdout
+    assert GeneIndex(str(tmp_path / 'index.npz')).annotate('1', 1100) == 'ALPHA|1|1/3||exonic_variant|ALPHA'
@@ -0,0 +1,86 @@
+import os
+import sys
+import time
+import subprocess
+import concurrent.futures
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from jobs import Scheduler, JobError, configure, scheduler, worker_concurrency
+
+PYTHON = sys.executable
+
+
+@pytest.fixture
+def limited():
+    '''a scheduler of its own with two slots'''
+    limited = Scheduler(concurrency=2)
+    yield limited
+    limited.close()
+
+
+def python(code):
+    return f'{PYTHON} -c "{code}"'
+
+
+def test_run_all_keeps_the_order_and_the_limit(limited):
+    start = time.perf_counter()
+    results = limited.run_all([python(f'import time; time.sleep(0.3); print({i})') for i in range(4)])
+    elapsed = time.perf_counter() - start
+    assert [result.stdout.strip() for result in results] == ['0', '1', '2', '3']
+    # two rounds of two jobs
+    assert 0.6 <= elapsed < 1.2
+
+
+def test_failed_jobs(limited, tmp_path):
+    with pytest.raises(JobError) as error:
+        limited.run(python('import sys; sys.stderr.write(\'broken\'); sys.exit(3)'))
+    assert error.value.returncode == 3 and 'broken' in str(error.value)
+    assert limited.run(python('import sys; sys.exit(2)'), check=False).returncode == 2
+
+    # fails on the first attempt only
+    marker = tmp_path / 'attempted'
+    flaky = python(f'import os, sys; attempted = os.path.exists(\'{marker}\'); open(\'{marker}\', \'w\').close(); sys.exit(0 if attempted else 1)')
+    assert limited.run(flaky, retries=1).returncode == 0
+
+
+def test_timeout_kills_the_job(limited):
+    start = time.perf_counter()
+    result = limited.run(python('import time; time.sleep(10)'), timeout=0.3, check=False)
+    assert result.returncode != 0 and 'killed after 0.3 seconds' in result.stderr
+    assert time.perf_counter() - start < 5
+
+
+def test_popen_holds_a_slot(limited):
+    first = limited.popen(python('import time; time.sleep(0.2)'))
+    second = limited.popen(python('import time; time.sleep(0.2)'))
+    queued = limited.submit(python('print(1)'))
+    time.sleep(0.5)
+    # both slots stay taken until the processes are waited for
+    assert not queued.done()
+    first.wait()
+    assert queued.result(timeout=5).stdout.strip() == '1'
+    second.wait()
+
+
+def test_stream_reads_output_as_it_is_written(limited, tmp_path):
+    lines = []
+    assert limited.stream(python('print(1); print(2)'), lambda stdout: lines.extend(line.strip() for line in stdout)) == 0
+    assert lines == ['1', '2']
+
+    with pytest.raises(JobError):
+        limited.stream(python('print(1); import sys; sys.exit(1)'), lambda stdout: lines.extend(stdout), retries=1)
+    # the output is consumed again on the retry
+    assert lines[2:] == ['1\n', '1\n']
+
+
+def scheduler_limit(_):
+    return scheduler().concurrency
+
+
+def test_worker_processes_share_the_limit():
+    configure(8)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=3, initializer=configure, initargs=(worker_concurrency(3),)) as executor:
+        limits = list(executor.map(scheduler_limit, range(6)))
+    assert set(limits) == {2}
+    assert worker_concurrency(16) == 1
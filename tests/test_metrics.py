@@ -0,0 +1,91 @@
+import os
+import sys
+import json
+import time
+import subprocess
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARK_DIR = os.path.join(REPO_DIR, 'benchmarks')
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+import synthetic
+import metrics as metrics_module
+from metrics import Metrics, popen
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    total = 0
+    while time.perf_counter() < end:
+        total += 1
+    return total
+
+
+def test_stages_count_time_records_and_bytes():
+    run = Metrics()
+    with run.stage('outer') as outer:
+        with run.stage('inner') as inner:
+            busy(0.05)
+            inner.records += 10
+        with run.stage('inner') as inner:
+            inner.records += 5
+        outer.bytes_read += 100
+    run.add('threads', wall=2.0, records=4, bytes_written=8)
+
+    stages = run.report()['stages']
+    assert stages['inner']['calls'] == 2 and stages['inner']['records'] == 15
+    # nested stages are included in the stage around them
+    assert stages['outer']['wall'] >= stages['inner']['wall'] >= 0.05
+    assert stages['outer']['bytes_read'] == 100 and stages['outer']['records_per_sec'] == 0
+    assert stages['threads'] == {'calls': 0, 'wall': 2.0, 'cpu': 0.0, 'records': 4, 'bytes_read': 0, 'bytes_written': 8, 'records_per_sec': 2.0}
+
+
+def test_subprocesses_are_summarized_per_program(monkeypatch):
+    monkeypatch.setattr(metrics_module, 'MAX_SUBPROCESSES', 2)
+    run = Metrics()
+    for returncode in (0, 1, 0):
+        run.subprocess('/usr/bin/samtools mpileup -r 1:100-100 a.bam', 0.5, returncode)
+    run.subprocess('vep -i x.vcf', 3.0, 0)
+
+    report = run.report()
+    assert len(report['subprocesses']) == 2
+    assert report['programs'] == {'samtools': {'runs': 3, 'wall': 1.5, 'failed': 1}, 'vep': {'runs': 1, 'wall': 3.0, 'failed': 0}}
+
+
+def test_popen_is_recorded_when_waited_for():
+    process = popen([sys.executable, '-c', 'import sys; sys.exit(4)'])
+    process.wait()
+    process.wait()
+    programs = metrics_module.metrics().report()['programs']
+    assert programs[os.path.basename(sys.executable)]['failed'] >= 1
+
+
+def test_profile_samples_hot_loops_only():
+    run = Metrics(profile=True)
+    with run.stage('hot', profile=True):
+        busy(0.2)
+    with run.stage('cold'):
+        busy(0.1)
+
+    profiles = run.report()['profiles']
+    assert list(profiles) == ['hot']
+    assert profiles['hot'][0]['frame'].startswith('test_metrics.py:') and profiles['hot'][0]['frame'].endswith(' busy')
+    assert abs(sum(frame['fraction'] for frame in profiles['hot']) - 1) < 1e-9
+
+
+def test_report_of_a_run(tmp_path):
+    sequences = synthetic.write_fasta(str(tmp_path / 'reference.fa'), [('1', 20000)], seed=17)
+    synthetic.write_vcf(str(tmp_path / 'tumor.vcf'), 'mutect', sequences, 80, seed=17)
+    report_path = tmp_path / 'report.json'
+    result = subprocess.run([sys.executable, os.path.join(REPO_DIR, 'annotate_vcf.py'), '-i', str(tmp_path / 'tumor.vcf'), '-o', str(tmp_path), '--stream', '--metrics', str(report_path)],
+        capture_output=True, text=True, env=dict(os.environ, VEP_PATH=os.path.join(BENCHMARK_DIR, 'fake_vep.py')))
+    assert result.returncode == 0, result.stdout + result.stderr
+
+    with open(report_path) as f:
+        report = json.load(f)
+    assert report['command'][1:3] == ['-i', str(tmp_path / 'tumor.vcf')]
+    assert report['programs']['fake_vep.py'] == {'runs': 1, 'wall': pytest.approx(report['subprocesses'][0]['wall']), 'failed': 0}
+    assert report['stages']['canonical_csq']['records'] == 80
+    assert report['stages']['bgzf_compress']['bytes_written'] > 0
+    assert report['peak_rss_mb'] > 0
@@ -0,0 +1,66 @@
+import os
+import sys
+import gzip
+import subprocess
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARK_DIR = os.path.join(REPO_DIR, 'benchmarks')
+sys.path.insert(0, BENCHMARK_DIR)
+import synthetic
+
+
+@pytest.fixture(scope='module')
+def workdir(tmp_path_factory):
+    '''a mutect vcf of 300 records, its reference and two normal bams'''
+    workdir = tmp_path_factory.mktemp('pipeline')
+    sequences = synthetic.write_fasta(str(workdir / 'reference.fa'), [('1', 60000), ('2', 40000)], seed=7)
+    synthetic.write_vcf(str(workdir / 'tumor.vcf'), 'mutect', sequences, 300, seed=7)
+    for i in range(2):
+        synthetic.write_bam(str(workdir / f'normal{i}.bam'), sequences, reads_per_contig=2000, seed=10 + i)
+
+    return workdir
+
+
+def run(script, *args, cwd):
+    env = dict(os.environ, VEP_PATH=os.path.join(BENCHMARK_DIR, 'fake_vep.py'))
+    result = subprocess.run([sys.executable, os.path.join(REPO_DIR, script)] + [str(arg) for arg in args], capture_output=True, text=True, cwd=cwd, env=env)
+    assert result.returncode == 0, result.stdout + result.stderr
+    return result
+
+
+def read_table(path):
+    with open(path) as f:
+        return [line.rstrip('\n').split('\t') for line in f]
+
+
+def test_pipeline_matches_the_separate_scripts(workdir):
+    fused = workdir / 'fused'
+    fused.mkdir()
+    run('pipeline.py', '-i', 'tumor.vcf', '-o', fused, '-s', 'TUMOR', cwd=workdir)
+
+    separate = workdir / 'separate'
+    separate.mkdir()
+    run('annotate_vcf.py', '-i', 'tumor.vcf', '-o', separate, '--stream', cwd=workdir)
+    run('tidy_annotated_vcf.py', '-i', separate / 'tumor.vep.vcf.gz', '-o', separate, '-s', 'TUMOR', cwd=workdir)
+
+    fused_rows = read_table(fused / 'tumor.tidy.txt')
+    assert len(fused_rows) == 301
+    assert all(float(row[1]) >= 0 for row in fused_rows[1:])
+    assert fused_rows == read_table(separate / 'tumor.vep.vcf.gz.tidy.txt')
+
+
+def test_pipeline_with_panel_of_normals_and_filter(workdir):
+    output = workdir / 'pon'
+    output.mkdir()
+    run('pipeline.py', '-i', 'tumor.vcf', '-o', output, '-s', 'TUMOR', '-r', 'reference.fa', '-n', 'normal0.bam', 'normal1.bam',
+        '--soft_filter', 'PON', '-t', '0.05', '--write_vcf', cwd=workdir)
+
+    with gzip.open(output / 'tumor.annotated.vcf.gz', 'rt') as f:
+        lines = f.read().split('\n')
+    assert any(line.startswith('##PON_PANEL=') for line in lines)
+    records = [line.split('\t') for line in lines if line and not line.startswith('#')]
+    assert len(records) == 300
+    assert all('PON_VAF=' in record[7] and record[7].count('CSQ=') == 1 and ',' not in record[7].split('CSQ=')[1].split(';')[0] for record in records)
+    assert {record[6] for record in records} <= {'PASS', 'PON', 'PASS;PON'}
+    assert len(read_table(output / 'tumor.tidy.txt')) == 301
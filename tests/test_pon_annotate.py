@@ -0,0 +1,87 @@
+import os
+import sys
+import gzip
+import subprocess
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks'))
+import synthetic
+
+
+@pytest.fixture(scope='module')
+def panel(tmp_path_factory):
+    '''reference, three normal bams and a vcf of sites on it'''
+    workdir = tmp_path_factory.mktemp('panel')
+    reference = str(workdir / 'reference.fa')
+    sequences = synthetic.write_fasta(reference, [('1', 20000), ('2', 10000)], seed=3)
+    bams = [synthetic.write_bam(str(workdir / f'normal{i}.bam'), sequences, reads_per_contig=600, error_rate=0.05, seed=i) for i in range(3)]
+    vcf = str(workdir / 'sample.vcf')
+    with open(vcf, 'w') as f:
+        f.write('##fileformat=VCFv4.2\n##contig=<ID=1,length=20000>\n##contig=<ID=2,length=10000>\n')
+        f.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+        for chrom, pos in [('1', 150), ('1', 5000), ('1', 5001), ('1', 19000), ('2', 300), ('2', 9000)]:
+            ref = sequences[chrom][pos - 1]
+            f.write(f'{chrom}\t{pos}\t.\t{ref}\t{"A" if ref != "A" else "C"}\t.\tPASS\t.\n')
+
+    return workdir, reference, bams, vcf
+
+
+def pon_annotate(*args):
+    return subprocess.run([sys.executable, os.path.join(REPO_DIR, 'pon_annotate.py')] + [str(arg) for arg in args], capture_output=True, text=True)
+
+
+def pon_records(path):
+    with gzip.open(path, 'rt') as f:
+        return [line.split('\t')[:2] + [line.split('\t')[7]] for line in f if not line.startswith('#')]
+
+
+def panel_line(path):
+    with gzip.open(path, 'rt') as f:
+        return [line.strip() for line in f if line.startswith('##PON_PANEL=')]
+
+
+def test_panel_of_several_bams_is_written_and_reused(panel):
+    workdir, reference, bams, vcf = panel
+    first = workdir / 'first'
+    first.mkdir()
+    result = pon_annotate('-i', vcf, '-r', reference, '-n', *bams, '-o', first)
+    assert result.returncode == 0, result.stdout + result.stderr
+    output = str(first / 'sample.pon.vcf.gz')
+    assert len(panel_line(output)) == 1
+    assert all('PON_DEPTH=' in info for chrom, pos, info in pon_records(output))
+
+    # the same panel in another order reuses every record
+    second = workdir / 'second'
+    second.mkdir()
+    result = pon_annotate('-i', vcf, '-r', reference, '-n', *reversed(bams), '-o', second, '-p', output)
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert '6 records reused' in result.stdout
+    assert pon_records(str(second / 'sample.pon.vcf.gz')) == pon_records(output)
+
+
+def test_previous_of_another_panel_is_refused(panel):
+    workdir, reference, bams, vcf = panel
+    first = workdir / 'two_bams'
+    first.mkdir()
+    assert pon_annotate('-i', vcf, '-r', reference, '-n', *bams[:2], '-o', first).returncode == 0
+    other = workdir / 'three_bams'
+    other.mkdir()
+    result = pon_annotate('-i', vcf, '-r', reference, '-n', *bams, '-o', other, '-p', first / 'sample.pon.vcf.gz')
+    assert result.returncode == 1
+    assert 'another panel of normals' in result.stdout
+
+
+def test_pon_db_of_several_bams_matches_counting(panel):
+    workdir, reference, bams, vcf = panel
+    db = workdir / 'pon_db'
+    result = subprocess.run([sys.executable, os.path.join(REPO_DIR, 'pon_build.py'), '-n', *bams, '-r', reference, '-o', str(db)], capture_output=True, text=True)
+    assert result.returncode == 0, result.stdout + result.stderr
+    counted, looked_up = workdir / 'counted', workdir / 'looked_up'
+    counted.mkdir()
+    looked_up.mkdir()
+    assert pon_annotate('-i', vcf, '-r', reference, '-n', *bams, '-o', counted).returncode == 0
+    result = pon_annotate('-i', vcf, '-r', reference, '-d', db, '-o', looked_up)
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert pon_records(str(looked_up / 'sample.pon.vcf.gz')) == pon_records(str(counted / 'sample.pon.vcf.gz'))
+    assert panel_line(str(looked_up / 'sample.pon.vcf.gz')) == panel_line(str(counted / 'sample.pon.vcf.gz'))
@@ -0,0 +1,62 @@
+import os
+import sys
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks'))
+import synthetic
+import pon_build
+from pon_build import PonDB, build_pon_db
+from pon_pileup import count_alleles, depth_and_mismatches, pon_panel
+
+CONTIGS = [('1', 9000), ('2', 4000)]
+
+
+@pytest.fixture(scope='module')
+def store(tmp_path_factory):
+    '''a store of two normal bams, built in windows smaller than the contigs so that depth runs cross windows'''
+    directory = tmp_path_factory.mktemp('pon_build')
+    reference = str(directory / 'reference.fa')
+    sequences = synthetic.write_fasta(reference, CONTIGS, seed=8)
+    bams = [synthetic.write_bam(str(directory / f'normal{i}.bam'), sequences, reads_per_contig=400, error_rate=0.05, seed=40 + i) for i in range(2)]
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(pon_build, 'BUILD_WINDOW', 2500)
+        build_pon_db(bams, reference, str(directory / 'store'))
+
+    return PonDB(str(directory / 'store')), reference, bams
+
+
+@pytest.mark.parametrize('contig, length', CONTIGS)
+def test_lookup_matches_counting_the_bams(store, contig, length):
+    db, reference, bams = store
+    positions = list(range(1, length + 1, 3))
+    depths, mismatches = db.lookup(contig, positions)
+
+    counted = count_alleles(bams, reference, contig, positions)
+    expected = [depth_and_mismatches(refbase, allele_counts, depth) for refbase, allele_counts, depth in (counted[pos] for pos in positions)]
+    assert depths.tolist() == [depth for depth, mismatch in expected]
+    assert mismatches.tolist() == [mismatch for depth, mismatch in expected]
+    assert mismatches.sum() > 0
+
+
+def test_positions_outside_the_store_are_empty(store):
+    db, reference, bams = store
+    depths, mismatches = db.lookup('1', [0, 9001, 20000])
+    assert depths.tolist() == [0, 0, 0] and mismatches.tolist() == [0, 0, 0]
+    depths, mismatches = db.lookup('X', [100])
+    assert depths.tolist() == [0] and mismatches.tolist() == [0]
+
+
+def test_store_records_its_panel(store):
+    db, reference, bams = store
+    assert db.panel() == pon_panel(bams, reference)
+    db.check_reference(reference)
+
+
+def test_other_reference_is_refused(store, tmp_path):
+    db, reference, bams = store
+    other = str(tmp_path / 'other.fa')
+    synthetic.write_fasta(other, [('1', 9000), ('2', 5000)], seed=8)
+    with pytest.raises(ValueError, match='differs in 2'):
+        db.check_reference(other)
@@ -0,0 +1,49 @@
+import os
+import sys
+import subprocess
+import pysam
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks'))
+import synthetic
+
+
+@pytest.fixture(scope='module')
+def calls(tmp_path_factory):
+    '''an annotated strelka vcf, plain and bgzip compressed with a tabix index'''
+    workdir = tmp_path_factory.mktemp('pon_filter')
+    sequences = synthetic.write_fasta(str(workdir / 'reference.fa'), [('1', 30000), ('2', 30000)], seed=11)
+    synthetic.write_vcf(str(workdir / 'calls.vcf'), 'strelka', sequences, 120, seed=11, annotated=True)
+    pysam.tabix_compress(str(workdir / 'calls.vcf'), str(workdir / 'indexed.vcf.gz'))
+    pysam.tabix_index(str(workdir / 'indexed.vcf.gz'), preset='vcf')
+    return workdir
+
+
+def pon_filter(*args):
+    return subprocess.run([sys.executable, os.path.join(REPO_DIR, 'pon_filter.py')] + [str(arg) for arg in args], capture_output=True, text=True)
+
+
+def test_regions_without_index_leave_no_output(calls, tmp_path):
+    result = pon_filter('-i', calls / 'calls.vcf', '-o', tmp_path, '-e', "IMPACT != 'HIGH'", '-r', '1:1-10000')
+    assert result.returncode == 1
+    assert 'needs a tabix index' in result.stdout
+    assert os.listdir(tmp_path) == []
+
+
+def test_bad_regions_leave_no_output(calls, tmp_path):
+    result = pon_filter('-i', calls / 'indexed.vcf.gz', '-o', tmp_path, '-e', "IMPACT != 'HIGH'", '-r', '1:ten-twenty')
+    assert result.returncode == 1
+    assert 'cannot read regions' in result.stdout
+    assert os.listdir(tmp_path) == []
+
+
+def test_regions_select_records(calls, tmp_path):
+    result = pon_filter('-i', calls / 'indexed.vcf.gz', '-o', tmp_path, '-s', 'LowQual', '-e', "IMPACT != 'HIGH'", '-r', '1:1-10000,2:20001-30000')
+    assert result.returncode == 0, result.stdout + result.stderr
+
+    with pysam.VariantFile(str(calls / 'indexed.vcf.gz')) as f:
+        expected = [(record.chrom, record.pos) for record in f if (record.chrom == '1' and record.pos <= 10000) or (record.chrom == '2' and record.pos > 20000)]
+    assert 0 < len(expected) < 120
+    with pysam.VariantFile(str(tmp_path / 'indexed.filtered.vcf.gz')) as f:
+        assert [(record.chrom, record.pos) for record in f] == expected
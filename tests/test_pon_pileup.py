@@ -0,0 +1,104 @@
+import os
+import sys
+import random
+import pysam
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pon_pileup import pileup_mismatches, pon_vaf, mpileup_vaf, count_alleles, depth_and_mismatches, pon_panel
+
+
+def test_pileup_mismatches_skips_markers():
+    # read start with mapping quality 'A', read end, an insertion and a deletion of ACGT bases
+    assert pileup_mismatches('^A.,$') == 0
+    assert pileup_mismatches('.+2AC,-3GTA.') == 0
+    assert pileup_mismatches('.,AcgT*') == 4
+
+
+def test_pon_vaf_without_coverage():
+    assert pon_vaf(0, 0) == 0.0
+    assert pon_vaf(1, 3) == 0.333
+
+
+def test_mpileup_vaf_sums_every_bam():
+    line = '1\t100\tA\t4\t..,G\tIIII\t3\t^Ia.$\tIII\t0\t*\t*\n'
+    assert mpileup_vaf(line) == (0.286, 7, 2)
+
+
+def test_mpileup_vaf_empty_output():
+    assert mpileup_vaf('') == (0.0, 0, 0)
+
+
+def make_bam(path, sequence, seed):
+    '''bam of reads over the middle of sequence with the read types that samtools mpileup treats differently:
+    deletions, reference skips, N bases, mismatches, orphans, improper pairs, duplicates and secondary alignments'''
+    rng = random.Random(seed)
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': '1', 'LN': len(sequence)}]}
+    reads = []
+    for i, start in enumerate(sorted(rng.randrange(800, 1100) for _ in range(200))):
+        kind = rng.randrange(9)
+        cigar = [(0, 100)]
+        if kind == 0:
+            cigar = [(0, 40), (2, 5), (0, 60)]
+        elif kind == 1:
+            cigar = [(0, 30), (3, 20), (0, 70)]
+        elif kind == 2:
+            cigar = [(4, 5), (0, 50), (1, 3), (0, 50)]
+        query = []
+        position = start
+        for op, length in cigar:
+            if op == 0:
+                query += list(sequence[position:position + length])
+                position += length
+            elif op in (2, 3):
+                position += length
+            else:
+                query += ['A'] * length
+        for j in range(len(query)):
+            if rng.random() < 0.05:
+                query[j] = rng.choice('ACGTN')
+        read = pysam.AlignedSegment()
+        read.query_name = f'read{i}'
+        read.reference_id = 0
+        read.reference_start = start
+        read.mapping_quality = rng.choice([0, 60])
+        read.cigartuples = cigar
+        read.query_sequence = ''.join(query)
+        read.query_qualities = pysam.qualitystring_to_array(''.join(rng.choice('#+5I') for _ in query))
+        read.flag = {3: 0x1 | 0x8 | 0x40, 4: 0x1 | 0x40, 5: 0x400, 6: 0x100}.get(kind, 0x1 | 0x2 | 0x40)
+        if read.flag & 0x1:
+            read.next_reference_id = 0
+            read.next_reference_start = start + 100
+            read.template_length = 200
+        reads.append(read)
+    with pysam.AlignmentFile(path, 'wb', header=header) as bam:
+        for read in reads:
+            bam.write(read)
+    pysam.index(path)
+
+    return path
+
+
+def test_pysam_engine_matches_mpileup(tmp_path):
+    rng = random.Random(1)
+    sequence = ''.join(rng.choice('ACGT') for _ in range(2000))
+    reference = str(tmp_path / 'reference.fa')
+    with open(reference, 'w') as f:
+        f.write('>1\n' + sequence + '\n')
+    pysam.faidx(reference)
+    bams = [make_bam(str(tmp_path / f'normal{i}.bam'), sequence, i) for i in range(2)]
+
+    mpileup = dict()
+    for line in pysam.mpileup('-Q', '0', '-q', '0', '-f', reference, '-r', '1:801-1300', *bams).splitlines():
+        vaf, depth, mismatches = mpileup_vaf(line)
+        mpileup[int(line.split('\t')[1])] = (depth, mismatches)
+
+    positions = list(range(801, 1301))
+    counts = count_alleles(bams, reference, '1', positions)
+    pysam_counts = {pos: depth_and_mismatches(*counts[pos]) for pos in positions}
+    assert any(mismatches for depth, mismatches in mpileup.values())
+    assert pysam_counts == {pos: mpileup.get(pos, (0, 0)) for pos in positions}
+
+
+def test_pon_panel_ignores_bam_order():
+    assert pon_panel(['b.bam', 'a.bam'], 'ref.fa') == pon_panel(['a.bam', 'b.bam'], 'ref.fa')
+    assert pon_panel(['a.bam'], 'ref.fa') != pon_panel(['a.bam', 'b.bam'], 'ref.fa')
@@ -0,0 +1,45 @@
+import os
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks'))
+import synthetic
+from pon_annotate import calculate_pon_counts, collect_sites, split_bams
+
+
+def write_inputs(directory, bams=4):
+    reference = str(directory / 'reference.fa')
+    sequences = synthetic.write_fasta(reference, [('1', 15000), ('2', 12000), ('3', 8000)], seed=21)
+    vcf = str(directory / 'calls.vcf')
+    synthetic.write_vcf(vcf, 'freebayes', sequences, 90, seed=21)
+    normal_bams = [synthetic.write_bam(str(directory / f'normal{i}.bam'), sequences, reads_per_contig=500, error_rate=0.03, seed=30 + i) for i in range(bams)]
+    return vcf, reference, normal_bams
+
+
+def test_split_bams():
+    bams = ['a.bam', 'b.bam', 'c.bam', 'd.bam', 'e.bam']
+    assert split_bams(bams, 2) == [['a.bam', 'c.bam', 'e.bam'], ['b.bam', 'd.bam']]
+    assert split_bams(bams, 1) == [bams]
+    # never more subsets than bams
+    assert split_bams(bams[:2], 8) == [['a.bam'], ['b.bam']]
+
+
+def test_sharded_counts_match_a_serial_run(tmp_path):
+    vcf, reference, normal_bams = write_inputs(tmp_path)
+    serial = calculate_pon_counts(vcf, normal_bams, reference)
+    sites = collect_sites(vcf)
+    assert sorted(serial) == sorted((contig, pos) for contig, positions in sites.items() for pos in positions)
+    assert sum(depth for depth, mismatches in serial.values()) > 0
+
+    assert calculate_pon_counts(vcf, normal_bams, reference, bam_shards=3) == serial
+    assert calculate_pon_counts(vcf, normal_bams, reference, workers=3, bam_shards=2) == serial
+
+
+def test_skipped_sites_are_not_counted(tmp_path):
+    vcf, reference, normal_bams = write_inputs(tmp_path, bams=2)
+    sites = collect_sites(vcf)
+    skip = {('1', pos) for pos in sites['1']}
+    counts = calculate_pon_counts(vcf, normal_bams, reference, workers=2, skip=skip)
+    assert not skip & set(counts)
+    assert {contig for contig, pos in counts} == set(sites) - {'1'}
@@ -0,0 +1,73 @@
+import os
+import sys
+import cyvcf2
+import pysam
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from previous_annotation import PreviousAnnotation
+
+HEADER = '''##fileformat=VCFv4.2
+##contig=<ID=1,length=100000>
+##contig=<ID=2,length=100000>
+##contig=<ID=3,length=100000>
+##PON_PANEL=<Reference="ref.fa",NormalBams="a.bam">
+##INFO=<ID=PON_DEPTH,Number=1,Type=Float,Description="Total depth in Panel of Normals">
+##INFO=<ID=PON_VC,Number=1,Type=Float,Description="Total variant read count in Panel of Normals">
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO
+'''
+PREVIOUS = [
+    ('1', 100, 'A', 'T', 'PON_DEPTH=50;PON_VC=1'),
+    ('1', 100, 'A', 'G', 'PON_DEPTH=50;PON_VC=7'),
+    ('1', 250, 'C', 'G,T', 'PON_DEPTH=80;PON_VC=3'),
+    ('1', 400, 'G', 'A', 'PON_DEPTH=10'),
+    ('2', 50, 'T', 'C', 'PON_DEPTH=30;PON_VC=0'),
+]
+
+
+def write_vcf(path, records, index=False):
+    with open(path, 'w') as f:
+        f.write(HEADER)
+        for chrom, pos, ref, alt, info in records:
+            f.write(f'{chrom}\t{pos}\t.\t{ref}\t{alt}\t.\tPASS\t{info}\n')
+    if index:
+        return pysam.tabix_index(str(path), preset='vcf', force=True)
+    return str(path)
+
+
+def test_records_are_matched_by_position_and_alleles(tmp_path):
+    previous = PreviousAnnotation(write_vcf(tmp_path / 'previous.vcf', PREVIOUS, index=True), ['PON_DEPTH', 'PON_VC'])
+    current = write_vcf(tmp_path / 'current.vcf', [
+        ('1', 100, 'A', 'G', '.'), # second record of a site
+        ('1', 100, 'A', 'C', '.'), # allele not in the previous vcf
+        ('1', 250, 'C', 'G,T', '.'),
+        ('1', 250, 'C', 'G', '.'), # only part of a multiallelic record
+        ('1', 400, 'G', 'A', '.'), # previous record without PON_VC
+        ('2', 50, 'T', 'C', '.'),
+        ('3', 10, 'A', 'T', '.'), # contig without records in the previous vcf
+    ])
+    values = [previous.get(variant) for variant in cyvcf2.VCF(current)]
+
+    assert values == [[50, 7], None, [80, 3], None, None, [30, 0], None]
+    assert (previous.reused, previous.recomputed) == (3, 4)
+    previous.close()
+
+
+def test_input_going_backwards_is_looked_up_again(tmp_path):
+    previous = PreviousAnnotation(write_vcf(tmp_path / 'previous.vcf', PREVIOUS, index=True), ['PON_DEPTH', 'PON_VC'])
+    current = write_vcf(tmp_path / 'current.vcf', [('2', 50, 'T', 'C', '.'), ('1', 250, 'C', 'G,T', '.'), ('1', 100, 'A', 'T', '.'), ('2', 50, 'T', 'C', '.')])
+    assert [previous.get(variant) for variant in cyvcf2.VCF(current)] == [[30, 0], [80, 3], [50, 1], [30, 0]]
+    previous.close()
+
+
+def test_header_lines(tmp_path):
+    previous = PreviousAnnotation(write_vcf(tmp_path / 'previous.vcf', PREVIOUS, index=True), ['PON_DEPTH'])
+    assert previous.meta_line('PON_PANEL') == '##PON_PANEL=<Reference="ref.fa",NormalBams="a.bam">'
+    assert previous.meta_line('PON_DB') is None
+    assert previous.header_line('PON_VC').startswith('##INFO=<ID=PON_VC,Number=1,Type=Float')
+    previous.close()
+
+
+def test_previous_needs_an_index(tmp_path):
+    with pytest.raises(ValueError, match='needs a tabix index'):
+        PreviousAnnotation(write_vcf(tmp_path / 'previous.vcf', PREVIOUS), ['PON_DEPTH'])
@@ -0,0 +1,61 @@
+import os
+import sys
+import subprocess
+import cyvcf2
+import pysam
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+from regions import has_index, read_regions, iter_regions, region_variants
+
+# contigs are declared in the order 2, 1, so records of 2 come first
+HEADER = '##fileformat=VCFv4.2\n##contig=<ID=2,length=50000>\n##contig=<ID=1,length=50000>\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+SITES = [('2', 500, 'A'), ('2', 5000, 'C'), ('1', 95, 'ACGTACGTACG'), ('1', 100, 'A'), ('1', 150, 'G'), ('1', 200, 'T'), ('1', 201, 'T'), ('1', 1000, 'C'), ('1', 30000, 'G')]
+
+
+@pytest.fixture(scope='module')
+def indexed_vcf(tmp_path_factory):
+    path = tmp_path_factory.mktemp('regions') / 'sites.vcf'
+    with open(path, 'w') as f:
+        f.write(HEADER)
+        for chrom, pos, ref in SITES:
+            f.write(f'{chrom}\t{pos}\t{chrom}_{pos}\t{ref}\t{"A" if ref[0] != "A" else "C"}\t.\tPASS\t.\n')
+    return pysam.tabix_index(str(path), preset='vcf')
+
+
+def ids(variants):
+    return [variant.ID for variant in variants]
+
+
+def test_read_regions_merges_and_converts_to_0_based(tmp_path):
+    assert read_regions('1:100-200, 1:150-300,2:10-20,1:301-400') == [('1', 99, 400), ('2', 9, 20)]
+
+    bed = tmp_path / 'targets.bed'
+    bed.write_text('track name=targets\n# comment\n1\t99\t200\tfirst\n\n1\t500\t600\n1\t150\t250\n')
+    assert read_regions(str(bed)) == [('1', 99, 250), ('1', 500, 600)]
+
+
+def test_records_starting_in_regions_are_read_once(indexed_vcf):
+    regions = read_regions('1:100-200,1:150-1000,2:1-1000')
+    # the deletion at 95 overlaps 1:100 but starts before it, and contig 2 is visited first
+    assert ids(iter_regions(cyvcf2.VCF(indexed_vcf), regions)) == ['2_500', '1_100', '1_150', '1_200', '1_201', '1_1000']
+
+
+def test_regions_without_records(indexed_vcf):
+    assert ids(iter_regions(cyvcf2.VCF(indexed_vcf), read_regions('1:2000-3000'))) == []
+    assert ids(region_variants(cyvcf2.VCF(indexed_vcf))) == [f'{chrom}_{pos}' for chrom, pos, ref in SITES]
+
+
+def test_has_index(indexed_vcf, tmp_path):
+    assert has_index(indexed_vcf)
+    assert not has_index(str(tmp_path / 'sites.vcf.gz'))
+
+
+def test_annotate_vcf_annotates_only_the_regions(indexed_vcf, tmp_path):
+    env = dict(os.environ, VEP_PATH=os.path.join(REPO_DIR, 'benchmarks', 'fake_vep.py'))
+    result = subprocess.run([sys.executable, os.path.join(REPO_DIR, 'annotate_vcf.py'), '-i', indexed_vcf, '-o', str(tmp_path), '-r', '1:150-1000'],
+        capture_output=True, text=True, env=env)
+    assert result.returncode == 0, result.stdout + result.stderr
+    annotated = cyvcf2.VCF(str(tmp_path / 'sites.vep.vcf.gz'))
+    assert [(variant.ID, variant.INFO.get('CSQ') is not None) for variant in annotated] == [('1_150', True), ('1_200', True), ('1_201', True), ('1_1000', True)]
@@ -0,0 +1,51 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import svAnnotate
+from svAnnotate import PositionArray
+from csq import CSQDecoder
+
+
+def test_cluster_does_not_chain_nearby_positions():
+    # every position is within 10bp of the previous one, but the run spans 40bp
+    positions = PositionArray.from_positions(['1:100-101', '1:108-109', '1:116-117', '1:124-125', '1:132-133', '1:140-141'])
+    assert positions.cluster(10).tolist() == [0, 0, 1, 1, 2, 2]
+    representatives, labels = positions.collapse(10)
+    assert representatives.strings() == ['1:100-101', '1:116-117', '1:132-133']
+
+
+def test_cluster_splits_contigs_and_keeps_input_order():
+    # contigs are numbered in order of appearance, so positions on 2 sort first
+    positions = PositionArray.from_positions(['2:105-106', '1:100-101', '2:100-101', '1:150-151', '1:105-106'])
+    assert positions.cluster(10).tolist() == [0, 1, 0, 2, 1]
+    assert positions.cluster(0).tolist() == [1, 2, 0, 4, 3]
+
+
+def test_cluster_empty():
+    assert len(PositionArray.from_positions([]).cluster(10)) == 0
+
+
+def test_collapse_reports_the_representatives(capsys):
+    breakpoints = ['1:100-101', '1:120-121', '1:100-101', '1:400-401', '2:100-101', '2:140-141', '1:130-131']
+    genomic_positions, representative = svAnnotate.collapse_breakpoints(breakpoints, 50)
+    assert genomic_positions == ['1:100-101', '1:400-401', '2:100-101']
+    assert [representative[bp] for bp in breakpoints] == ['1:100-101', '1:100-101', '1:100-101', '1:400-401', '2:100-101', '2:100-101', '1:100-101']
+    assert '6 unique breakpoints collapsed into 3 within 50bp' in capsys.readouterr().out
+
+    genomic_positions, representative = svAnnotate.collapse_breakpoints(breakpoints)
+    assert len(genomic_positions) == 6 and representative['1:120-121'] == '1:120-121'
+
+
+def test_worker_errors_are_raised_in_the_caller(monkeypatch):
+    # the server answers with a truncated annotation for one of the breakpoints
+    decoder = CSQDecoder.default()
+    def get_server_annotations(genomic_positions, reference_fasta, server):
+        return {position: decoder.decode('A|intron_variant' if position == '1:500-501' else 'A|intron_variant' + '|' * (len(decoder.index) - 2)) for position in genomic_positions}
+    monkeypatch.setattr(svAnnotate, 'get_server_annotations', get_server_annotations)
+    monkeypatch.setattr(svAnnotate, 'SERVER_BATCH_SIZE', 2)
+
+    positions = [f'1:{pos}-{pos + 1}' for pos in range(100, 1000, 100)]
+    with pytest.raises(ValueError, match='1:500-501'):
+        svAnnotate.vep_breakpoint_annotations(positions, 'reference.fa', server='vep.sock', workers=3)
@@ -6,139 +6,277 @@ import cyvcf2
 import re
 import argparse
 import os, sys
-import subprocess
-import shlex
+import concurrent.futures
+import multiprocessing
+from csq import CSQDecoder
+from jobs import scheduler
+from metrics import metrics, file_size, configure as configure_metrics
+from vaf import identify_caller, tumor_column, iter_vaf_blocks
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None # only needed for --format parquet/arrow
+
+DEFAULT_DECODER = CSQDecoder.default()
+# CSQ fields written to the tidy output, fields joined with : are written as one column named after the last field
+CSQ_COLUMNS = ['Consequence', 'IMPACT', 'SYMBOL', 'Gene', 'Feature_type:Feature', 'BIOTYPE', 'EXON', 'INTRON', 'HGVSc', 'HGVSp',
+    'cDNA_position', 'CDS_position', 'Protein_position', 'Amino_acids', 'Codons', 'Existing_variation', 'ALLELE_NUM', 'DISTANCE',
+    'STRAND', 'FLAGS', 'PICK', 'VARIANT_CLASS', 'SYMBOL_SOURCE:HGNC_ID', 'CANONICAL', 'TSL', 'CCDS', 'ENSP', 'SWISSPROT', 'TREMBL',
+    'UNIPARC', 'RefSeq', 'GENE_PHENO', 'SIFT', 'PolyPhen', 'DOMAINS', 'HGVS_OFFSET', 'AF', 'AFR_AF', 'AMR_AF', 'EAS_AF', 'EUR_AF',
+    'SAS_AF', 'AA_AF', 'EA_AF', 'gnomAD_AF', 'gnomAD_AFR_AF', 'gnomAD_AMR_AF', 'gnomAD_ASJ_AF', 'gnomAD_EAS_AF', 'gnomAD_FIN_AF',
+    'gnomAD_NFE_AF', 'gnomAD_OTH_AF', 'gnomAD_SAS_AF', 'MAX_AF', 'MAX_AF_POPS', 'CLIN_SIG', 'SOMATIC', 'PHENO', 'PUBMED',
+    'MOTIF_NAME', 'MOTIF_POS', 'HIGH_INF_POS', 'MOTIF_SCORE_CHANGE']
+INTEGER_FIELDS = {'ALLELE_NUM', 'DISTANCE', 'STRAND', 'HGVS_OFFSET'}
+FLOAT_FIELDS = {'AF', 'MAX_AF'} | {field for field in CSQ_COLUMNS if field.endswith('_AF')}
+OUTPUT_SUFFIX = {'tsv': '.tidy.txt', 'parquet': '.tidy.parquet', 'arrow': '.tidy.arrow'}
+BATCH_SIZE = 65536 # rows per parquet row group / arrow record batch
+COHORT_BATCH = 10000 # rows a cohort worker hands to the writer at once
+LAZY_COLUMNS = 8 # up to this many projected columns are extracted field by field instead of splitting the annotation
 
 def argument_parser():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-i', '--input_vcf', required=True, help='Input VCF with VEP annotation that will be tidied')
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('-i', '--input_vcf', help='Input VCF with VEP annotation that will be tidied')
+    inputs.add_argument('-m', '--manifest', help='Cohort mode. Tab separated file of sampleName and VEP annotated VCF per line, tidied into one combined table')
     parser.add_argument('-o', '--output_dir', required=False, default=os.getcwd(), help='Output directory')
     parser.add_argument('-s', '--sampleName', required=False, default='NA', help='Sample Name in the VCF column to extract VAF info')
+    parser.add_argument('-f', '--format', required=False, default='tsv', choices=['tsv', 'parquet', 'arrow'], help='Output format. parquet and arrow require pyarrow. Default=tsv')
+    parser.add_argument('-c', '--columns', required=False, nargs='+', default=None, help='Only write these CSQ fields, e.g. SYMBOL Consequence gnomAD_AF. Default=all')
+    parser.add_argument('-t', '--threads', required=False, type=int, default=1, help='Number of VCFs tidied in parallel in cohort mode. Default=1')
+    parser.add_argument('--metrics', required=False, default=None, help='Write time per stage, external tool runs, records, bytes and peak memory of the run to this JSON file')
+    parser.add_argument('--profile', required=False, action='store_true', help='Sample the hot loops and add their most frequent frames to --metrics')
 
     args = vars(parser.parse_args())
-    return args['input_vcf'], args['output_dir'], args['sampleName']
+    return args['input_vcf'], args['manifest'], args['output_dir'], args['sampleName'], args['format'], args['columns'], args['threads'], args['metrics'], args['profile']
 
-def find_canonical_annotation(vep_annotation_string):
+def find_canonical_annotation(vep_annotation_string, decoder=DEFAULT_DECODER):
     """VEP annotates with many alternative transcripts as well as canonical transcript
     this function finds the canonical transcript within vep_annotation_string. 
     If there is no canonical transcript, which is usually the case fore intergenic, 
     will just report the first annotation. 
     """
-    annotations = vep_annotation_string.split(',')
-    return_status = 0
-    for annotation in annotations:
-        CANONICAL = annotation.split('|')[26] # CANONICAL
-        if CANONICAL == 'YES':
-            return_status = 1
-            return annotation
-    
-    if return_status == 0:
-        return vep_annotation_string.split(',')[0]
-
-def identify_tumor_column(mutect_vcf, sampleName):
-    """given a tumor sample name, and a mutect_VCF output, finds the index of column that is
-    used as tumor to calculate VAF"""
-    vcfHandle = cyvcf2.VCF(mutect_vcf)
+    return decoder.canonical(vep_annotation_string)
+
+def csq_columns(annotation, columns=CSQ_COLUMNS):
+    """values of columns for a decoded annotation, fields joined with : are concatenated"""
+    if len(columns) > LAZY_COLUMNS:
+        annotation.values() # most fields are written, split the annotation once
+    return [':'.join(annotation.get(name) for name in column.split(':')) for column in columns]
+
+def project_columns(fields):
+    """CSQ_COLUMNS holding the requested CSQ fields, in the requested order"""
+    if not fields:
+        return CSQ_COLUMNS
+    columns = []
+    for field in fields:
+        matches = [column for column in CSQ_COLUMNS if field in column.split(':')]
+        if not matches:
+            print(f'{field} is not a CSQ column. Choose from {", ".join(column.split(":")[-1] for column in CSQ_COLUMNS)}')
+            print('Exiting...')
+            sys.exit()
+        if matches[0] not in columns:
+            columns.append(matches[0])
+
+    return columns
+
+def column_type(column):
+    """arrow type of a tidy CSQ column"""
+    name = column.split(':')[-1]
+    if name in INTEGER_FIELDS:
+        return pyarrow.int64()
+    elif name in FLOAT_FIELDS:
+        return pyarrow.float64()
+    return pyarrow.string()
+
+def typed_value(value, arrow_type):
+    """CSQ field value converted to arrow_type, None for empty fields.
+    Numbers of multiple co-located variants (0.01&0.02) take the first value"""
+    if arrow_type == pyarrow.string():
+        return value
+    value = value.split('&')[0]
+    if value == '':
+        return None
     try:
-        tumorIndex = vcfHandle.samples.index(sampleName)
-        if tumorIndex == 0:
-            return 0
-        else:
-            return 1
+        return int(value) if arrow_type == pyarrow.int64() else float(value)
     except ValueError:
-        print(f'{sampleName} is not present in {mutect_vcf}\nExiting...')
-        sys.exit()
+        return None
 
 
-def prepare_outputfile(input_vcf, output_dir):
-    """Prepares outputfile path. If an outputfile already exists, overwrite by removing original file"""
-    output_file = os.path.join(output_dir, os.path.basename(input_vcf) + '.tidy.txt')
-    if os.path.isfile(output_file):
-        subprocess.call(shlex.split('rm -rf ' + output_file))
+class TsvWriter():
+    """tab separated tidy output"""
+    def __init__(self, path, columns):
+        self.handle = open(path, 'w')
+        self.handle.write('\t'.join(['sampleName', 'VAF', 'chromosome', 'position', 'ref', 'alt'] + [column.split(':')[-1] for column in columns]))
 
-    return output_file
+    def write(self, row):
+        sampleName, vaf, chrom, pos, ref, alt = row[:6]
+        self.handle.write('\n' + '\t'.join([sampleName, f'{vaf:.4f}', chrom, str(pos), ref, alt] + row[6:]))
 
+    def close(self):
+        self.handle.close()
 
-def strelka_vaf(variant):
-    """takes cyvcf2 variant class info for strelka vcf and calculates VAF"""
-    ref_base = variant.REF
-    alt_base = variant.ALT
-    ref_cnt = variant.format(ref_base + 'U')[1][0] # NORMAL allele count in tumor. [1] is tumor for strelka output
 
-    alt_cnt = variant.format(str(alt_base[0]) + 'U')[1][0] # TUMOR allele count
-    total_cnt = variant.format('AU')[1][0] + variant.format('CU')[1][0] + variant.format('GU')[1][0] + variant.format('TU')[1][0] # only use tier1 allele counts for calculating VAFs
-    print(total_cnt)
-    if total_cnt > 0:
-        return float(alt_cnt/total_cnt)
-    else:
-        return 0 # if coverage is 0 then, this is meaningless
+class ColumnarWriter():
+    """typed parquet or arrow IPC tidy output. Rows are accumulated in column batches of batch_size rows
+    and every batch is written as one parquet row group or arrow record batch"""
+    def __init__(self, path, columns, output_format, batch_size=BATCH_SIZE):
+        fields = [('sampleName', pyarrow.string()), ('VAF', pyarrow.float64()), ('chromosome', pyarrow.string()),
+            ('position', pyarrow.int64()), ('ref', pyarrow.string()), ('alt', pyarrow.string())]
+        fields += [(column.split(':')[-1], column_type(column)) for column in columns]
+        self.schema = pyarrow.schema(fields)
+        self.csq_types = [arrow_type for _, arrow_type in fields[6:]]
+        self.batch_size = batch_size
+        self.batch = [[] for _ in fields]
+        if output_format == 'parquet':
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            self.writer = pyarrow.ipc.new_file(path, self.schema)
+
+    def write(self, row):
+        for values, value in zip(self.batch, row[:6]):
+            values.append(value)
+        for values, value, arrow_type in zip(self.batch[6:], row[6:], self.csq_types):
+            values.append(typed_value(value, arrow_type))
+        if len(self.batch[0]) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.batch[0]:
+            self.writer.write_batch(pyarrow.record_batch(self.batch, schema=self.schema))
+            self.batch = [[] for _ in self.batch]
 
-def freebayes_germline_vaf(variant):
-    """takes cyvcf2 variant class info for freebayes vcf and calculates VAF
-    NOT designed for somatic"""
-    ref_cnt = (variant.format('RO')[0][0])
-    alt_cnt = (variant.format('AO')[0][0])
-    total_cnt = ref_cnt + alt_cnt
+    def close(self):
+        self.flush()
+        self.writer.close()
 
-    return alt_cnt / total_cnt
+
+def prepare_outputfile(input_vcf, output_dir, output_format='tsv'):
+    """Prepares outputfile path. If an outputfile already exists, overwrite by removing original file"""
+    output_file = os.path.join(output_dir, os.path.basename(input_vcf) + OUTPUT_SUFFIX[output_format])
+    if os.path.isfile(output_file):
+        scheduler().run('rm -rf ' + output_file)
+
+    return output_file
 
 
-def tidy_annotation(input_vcf, output_dir, sampleName):
+def tidy_rows(input_vcf, sampleName, columns):
+    """tidy rows of a VEP annotated VCF. Caller and tumor column are resolved once when the VCF is opened"""
     vcfHandle = cyvcf2.VCF(input_vcf)
-    outputfile = prepare_outputfile(input_vcf, output_dir)
-    with open(outputfile, 'w') as f:
-        # write header
-        f.write('sampleName\tVAF\tchromosome\tposition\tref\talt\tConsequence\tIMPACT\tSYMBOL\tGene\tFeature\tBIOTYPE\tEXON\tINTRON\tHGVSc\tHGVSp\tcDNA_position\tCDS_position\tProtein_position\tAmino_acids\tCodons\tExisting_variation\tALLELE_NUM\tDISTANCE\tSTRAND\tFLAGS\tPICK\tVARIANT_CLASS\tHGNC_ID\tCANONICAL\tTSL\tCCDS\tENSP\tSWISSPROT\tTREMBL\tUNIPARC\tRefSeq\tGENE_PHENO\tSIFT\tPolyPhen\tDOMAINS\tHGVS_OFFSET\tAF\tAFR_AF\tAMR_AF\tEAS_AF\tEUR_AF\tSAS_AF\tAA_AF\tEA_AF\tgnomAD_AF\tgnomAD_AFR_AF\tgnomAD_AMR_AF\tgnomAD_ASJ_AF\tgnomAD_EAS_AF\tgnomAD_FIN_AF\tgnomAD_NFE_AF\tgnomAD_OTH_AF\tgnomAD_SAS_AF\tMAX_AF\tMAX_AF_POPS\tCLIN_SIG\tSOMATIC\tPHENO\tPUBMED\tMOTIF_NAME\tMOTIF_POS\tHIGH_INF_POS\tMOTIF_SCORE_CHANGE')
-
-        for variant in vcfHandle:
-            # ger VAF
-            if 'FA' in variant.FORMAT: 
-                tumor_column = identify_tumor_column(input_vcf, sampleName)
-                vaf = variant.format('FA')[tumor_column][0] # this works when VCF is from Mutect
-            elif 'AU' in variant.FORMAT: 
-                vaf = strelka_vaf(variant)
-            elif 'TIR' in variant.FORMAT:
-                # Strelka Indel
-                vaf = variant.format('TIR')[1][0] / variant.format('DP')[1][0]
-            elif 'RO' in variant.FORMAT:
-                # Freebayes germline
-                vaf = freebayes_germline_vaf(variant)
-            else:
-                print('This form of VCF is not yet supported. Use either Strelka2 or Mutect VCF')
-                print('Exiting...')
-                sys.exit()
+    return tidy_records(vcfHandle, vcfHandle, sampleName, columns)
 
+def tidy_records(vcfHandle, records, sampleName, columns):
+    """tidy rows of cyvcf2 records, vcfHandle is the cyvcf2 VCF or Writer holding their header"""
+    try:
+        decoder = CSQDecoder.from_vcf(vcfHandle)
+    except ValueError:
+        print('Please run VEP before tidying your VCF file.')
+        print('Exiting...')
+        sys.exit()
+    caller = identify_caller(vcfHandle)
+    column = tumor_column(vcfHandle, caller, sampleName)
 
-            is_canonical_present=False
+    for variants, vafs in iter_vaf_blocks(records, caller, column):
+        for variant, vaf in zip(variants, vafs.tolist()):
             try:
                 # nearest added 2018.07.15
-                annotation = find_canonical_annotation(variant.INFO['CSQ'])
-                Allele, Consequence, IMPACT, SYMBOL, Gene, Feature_type, Feature, BIOTYPE, \
-                EXON, INTRON, HGVSc, HGVSp, cDNA_position, CDS_position, Protein_position, \
-                Amino_acids, Codons, Existing_variation, ALLELE_NUM, DISTANCE, STRAND, FLAGS, \
-                PICK, VARIANT_CLASS, SYMBOL_SOURCE, HGNC_ID, CANONICAL, TSL, CCDS, ENSP, \
-                SWISSPROT, TREMBL, UNIPARC, RefSeq, GENE_PHENO, NEAREST, SIFT, PolyPhen, DOMAINS, \
-                HGVS_OFFSET, AF, AFR_AF, AMR_AF, EAS_AF, EUR_AF, SAS_AF, AA_AF, EA_AF, \
-                gnomAD_AF, gnomAD_AFR_AF, gnomAD_AMR_AF, gnomAD_ASJ_AF, gnomAD_EAS_AF, \
-                gnomAD_FIN_AF, gnomAD_NFE_AF, gnomAD_OTH_AF, gnomAD_SAS_AF, MAX_AF, \
-                MAX_AF_POPS, CLIN_SIG, SOMATIC, PHENO, PUBMED, MOTIF_NAME, MOTIF_POS, \
-                HIGH_INF_POS, MOTIF_SCORE_CHANGE = annotation.split('|')
-            # write either the canonical variant, or if not available, first annotated info
-                f.write(f'\n{sampleName}\t{vaf:.4f}\t{variant.CHROM}\t{variant.POS}\t{variant.REF}\t{variant.ALT[0]}\t{Consequence}\t{IMPACT}\t{SYMBOL}\t{Gene}\t{Feature_type}:{Feature}\t{BIOTYPE}\t{EXON}\t{INTRON}\t{HGVSc}\t{HGVSp}\t{cDNA_position}\t{CDS_position}\t{Protein_position}\t{Amino_acids}\t{Codons}\t{Existing_variation}\t{ALLELE_NUM}\t{DISTANCE}\t{STRAND}\t{FLAGS}\t{PICK}\t{VARIANT_CLASS}\t{SYMBOL_SOURCE}:{HGNC_ID}\t{CANONICAL}\t{TSL}\t{CCDS}\t{ENSP}\t{SWISSPROT}\t{TREMBL}\t{UNIPARC}\t{RefSeq}\t{GENE_PHENO}\t{SIFT}\t{PolyPhen}\t{DOMAINS}\t{HGVS_OFFSET}\t{AF}\t{AFR_AF}\t{AMR_AF}\t{EAS_AF}\t{EUR_AF}\t{SAS_AF}\t{AA_AF}\t{EA_AF}\t{gnomAD_AF}\t{gnomAD_AFR_AF}\t{gnomAD_AMR_AF}\t{gnomAD_ASJ_AF}\t{gnomAD_EAS_AF}\t{gnomAD_FIN_AF}\t{gnomAD_NFE_AF}\t{gnomAD_OTH_AF}\t{gnomAD_SAS_AF}\t{MAX_AF}\t{MAX_AF_POPS}\t{CLIN_SIG}\t{SOMATIC}\t{PHENO}\t{PUBMED}\t{MOTIF_NAME}\t{MOTIF_POS}\t{HIGH_INF_POS}\t{MOTIF_SCORE_CHANGE}')
-
+                annotation = decoder.decode(find_canonical_annotation(variant.INFO['CSQ'], decoder))
             except KeyError:
                 print('Cannot find CSQ in the VCF. Probably NOT VEP annotated. Please run VEP before tidying your VCF file.')
                 print('Exiting...')
                 sys.exit()
+            # write either the canonical variant, or if not available, first annotated info
+            yield [sampleName, vaf, variant.CHROM, variant.POS, variant.REF, variant.ALT[0]] + csq_columns(annotation, columns)
+
+def open_writer(outputfile, columns, output_format):
+    if output_format == 'tsv':
+        return TsvWriter(outputfile, columns)
+    elif pyarrow is None:
+        print(f'pyarrow is required for --format {output_format}. Install pyarrow or use --format tsv')
+        print('Exiting...')
+        sys.exit()
+    return ColumnarWriter(outputfile, columns, output_format)
 
+def tidy_annotation(input_vcf, output_dir, sampleName, output_format='tsv', fields=None):
+    columns = project_columns(fields)
+    outputfile = prepare_outputfile(input_vcf, output_dir, output_format)
+    writer = open_writer(outputfile, columns, output_format)
+    with metrics().stage('tidy', profile=True) as stage:
+        for row in tidy_rows(input_vcf, sampleName, columns):
+            writer.write(row)
+            stage.records += 1
+        writer.close()
+        stage.bytes_read += file_size(input_vcf)
+        stage.bytes_written += file_size(outputfile)
 
     print(f'Tidy Variant Annotation File Ready for Analysis: {outputfile}')
     return 0
+
+def read_manifest(manifest):
+    """[(sampleName, vcf)] from a tab separated manifest, blank and # lines are skipped"""
+    samples = []
+    with open(manifest) as f:
+        for line in f:
+            if line.strip() and not line.startswith('#'):
+                sampleName, vcf = line.strip().split('\t')[:2]
+                samples.append((sampleName, vcf))
+
+    return samples
+
+def tidy_worker(input_vcf, sampleName, columns, queue):
+    """tidies one VCF of a cohort, handing rows to the writer process in batches of COHORT_BATCH.
+    None marks the end of this VCF, also when tidying failed"""
+    try:
+        batch = []
+        for row in tidy_rows(input_vcf, sampleName, columns):
+            batch.append(row)
+            if len(batch) >= COHORT_BATCH:
+                queue.put(batch)
+                batch = []
+        queue.put(batch)
+    finally:
+        queue.put(None)
+
+    return 0
+
+def tidy_cohort(manifest, output_dir, output_format='tsv', fields=None, threads=1):
+    """tidies every (sampleName, vcf) of a manifest on a process pool into one combined table
+    rows of different samples are interleaved as the workers produce them"""
+    samples = read_manifest(manifest)
+    columns = project_columns(fields)
+    outputfile = prepare_outputfile(manifest, output_dir, output_format)
+    writer = open_writer(outputfile, columns, output_format)
+    # rows are tidied in worker processes, only the writer side is measured here
+    with metrics().stage('tidy_cohort') as stage, multiprocessing.Manager() as manager, concurrent.futures.ProcessPoolExecutor(max_workers=threads) as executor:
+        queue = manager.Queue(maxsize=threads * 4) # bounded so that workers can not run far ahead of the writer
+        futures = [executor.submit(tidy_worker, vcf, sampleName, columns, queue) for sampleName, vcf in samples]
+        remaining = len(futures)
+        while remaining:
+            batch = queue.get()
+            if batch is None:
+                remaining -= 1
+                continue
+            for row in batch:
+                writer.write(row)
+            stage.records += len(batch)
+        for future in futures:
+            future.result()
+        writer.close()
+        stage.bytes_read += sum(file_size(vcf) for sampleName, vcf in samples)
+        stage.bytes_written += file_size(outputfile)
+
+    print(f'Tidy Variant Annotation File Ready for Analysis: {outputfile} ({len(samples)} samples)')
+    return 0
  
 
 def main():
-    input_vcf, output_dir, sampleName = argument_parser()
-    tidy_annotation(input_vcf, output_dir, sampleName)
+    input_vcf, manifest, output_dir, sampleName, output_format, fields, threads, metrics_path, profile = argument_parser()
+    configure_metrics(metrics_path, profile)
+    if manifest:
+        tidy_cohort(manifest, output_dir, output_format, fields, threads)
+    else:
+        tidy_annotation(input_vcf, output_dir, sampleName, output_format, fields)
 
     return 0
 
@@ -0,0 +1,123 @@
+'''Caller specific VAF extraction for tidy_annotated_vcf.py.
+The caller is identified once from the FORMAT fields declared in the VCF header. The FORMAT values of a block
+of records are read record by record with variant.format() into arrays, and the VAFs of the block are computed
+from those arrays with numpy.
+A header declaring both Strelka SNV (AU) and indel (TIR) fields, as concatenated Strelka outputs do,
+is identified as strelka and the SNV or indel VAF is chosen per record from its FORMAT.
+Records without depth get a VAF of 0.
+'''
+import sys
+import cyvcf2
+import numpy as np
+
+BLOCK_SIZE = 10000 # records per block
+BASE_INDEX = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+# FORMAT field that identifies a caller, checked in this order
+CALLER_FORMATS = [('FA', 'mutect'), ('AU', 'strelka_snv'), ('TIR', 'strelka_indel'), ('RO', 'freebayes')]
+
+
+def identify_caller(vcf_handle):
+    '''variant caller of a VCF from the FORMAT fields declared in its header'''
+    format_ids = {record['ID'] for record in vcf_handle.header_iter() if record['HeaderType'] == 'FORMAT'}
+    if 'FA' not in format_ids and {'AU', 'TIR'} <= format_ids:
+        return 'strelka'
+    for format_id, caller in CALLER_FORMATS:
+        if format_id in format_ids:
+            return caller
+    print('This form of VCF is not yet supported. Use either Strelka2 or Mutect VCF')
+    print('Exiting...')
+    sys.exit()
+
+
+def tumor_column(vcf_handle, caller, sampleName):
+    '''sample column VAFs are taken from. Strelka writes NORMAL, TUMOR and freebayes is single sample.
+    For Mutect the column of sampleName is used'''
+    if caller == 'freebayes':
+        return 0
+    elif caller != 'mutect':
+        return 1
+    try:
+        tumorIndex = vcf_handle.samples.index(sampleName)
+        if tumorIndex == 0:
+            return 0
+        else:
+            return 1
+    except ValueError:
+        print(f'{sampleName} is not present in the VCF\nExiting...')
+        sys.exit()
+
+
+def format_values(variants, field, column):
+    '''first value of a FORMAT field in a sample column of every record, as an array. Missing values are 0.
+    cyvcf2 has no FORMAT access across records, the field is read with one variant.format() call per record'''
+    values = np.array([variant.format(field)[column][0] for variant in variants], dtype=np.float64)
+    values[np.isnan(values) | (values < 0)] = 0 # cyvcf2 fills missing integers with a large negative number
+
+    return values
+
+
+def ratio(numerator, denominator):
+    '''numerator / denominator, 0 where the denominator is 0'''
+    vafs = np.zeros(len(numerator), dtype=np.float64)
+    np.divide(numerator, denominator, out=vafs, where=denominator > 0)
+
+    return vafs
+
+
+def block_vafs(variants, caller, column):
+    '''VAFs of a block of records as a numpy array'''
+    if not variants:
+        return np.zeros(0, dtype=np.float64)
+    if caller == 'mutect':
+        return format_values(variants, 'FA', column)
+    elif caller == 'strelka_snv':
+        # only use tier1 allele counts for calculating VAFs
+        counts = np.stack([format_values(variants, base + 'U', column) for base in 'ACGT'], axis=1)
+        alt_index = np.array([BASE_INDEX.get(str(variant.ALT[0]), 0) for variant in variants])
+        return ratio(counts[np.arange(len(variants)), alt_index], counts.sum(axis=1))
+    elif caller == 'strelka_indel':
+        return ratio(format_values(variants, 'TIR', column), format_values(variants, 'DP', column))
+    elif caller == 'strelka':
+        is_snv = np.array(['AU' in variant.FORMAT for variant in variants])
+        vafs = np.zeros(len(variants), dtype=np.float64)
+        vafs[is_snv] = block_vafs([variant for variant, snv in zip(variants, is_snv) if snv], 'strelka_snv', column)
+        vafs[~is_snv] = block_vafs([variant for variant, snv in zip(variants, is_snv) if not snv], 'strelka_indel', column)
+        return vafs
+    else:
+        # Freebayes germline, NOT designed for somatic
+        ref_counts = format_values(variants, 'RO', column)
+        alt_counts = format_values(variants, 'AO', column)
+        return ratio(alt_counts, ref_counts + alt_counts)
+
+
+def iter_vaf_blocks(records, caller, column, block_size=BLOCK_SIZE):
+    '''yields (records, VAF array) for consecutive blocks of block_size records'''
+    variants = []
+    for variant in records:
+        variants.append(variant)
+        if len(variants) >= block_size:
+            yield variants, block_vafs(variants, caller, column)
+            variants = []
+    if variants:
+        yield variants, block_vafs(variants, caller, column)
+
+
+def vaf_table(vcf, sampleName='NA'):
+    '''VAFs of every record of a VCF as arrays
+    returns {'chromosome', 'position', 'ref', 'alt', 'VAF'}'''
+    vcf_handle = cyvcf2.VCF(vcf)
+    caller = identify_caller(vcf_handle)
+    column = tumor_column(vcf_handle, caller, sampleName)
+    chroms, positions, refs, alts, vafs = [], [], [], [], []
+    for variants, block in iter_vaf_blocks(vcf_handle, caller, column):
+        for variant in variants:
+            chroms.append(variant.CHROM)
+            positions.append(variant.POS)
+            refs.append(variant.REF)
+            alts.append(variant.ALT[0] if variant.ALT else '.')
+        vafs.append(block)
+    vcf_handle.close()
+
+    return {'chromosome': np.array(chroms, dtype=object), 'position': np.array(positions, dtype=np.int64),
+        'ref': np.array(refs, dtype=object), 'alt': np.array(alts, dtype=object),
+        'VAF': np.concatenate(vafs) if vafs else np.zeros(0, dtype=np.float64)}
@@ -0,0 +1,175 @@
+'''Tabix (.tbi) and CSI index of a BGZF compressed VCF, built from the records as they are written.
+Records are placed in the UCSC binning scheme used by htslib, consecutive records of a bin are merged
+into chunks of virtual offsets and every 16 kb window keeps the offset of the first record overlapping it.
+Offsets are kept as (block number, offset within block) addresses while writing because compressed
+block offsets are only known once the block is written, and resolved when the index is written.
+A .csi index is written instead of .tbi when the ##contig lengths of the header exceed 2^29.
+'''
+import re
+import struct
+
+MIN_SHIFT = 14 # 16 kb windows
+TBI_DEPTH = 5
+# tabix header of a VCF: format, sequence, begin and end columns, comment character, skipped lines
+VCF_FORMAT = (2, 1, 2, 0, ord('#'), 0)
+
+
+def reg2bin(beg, end, min_shift=MIN_SHIFT, depth=TBI_DEPTH):
+    '''smallest bin containing [beg, end), same as hts_reg2bin'''
+    end -= 1
+    level, shift = depth, min_shift
+    first = bin_first(depth + 1)
+    while level > 0:
+        first -= 1 << (3 * level)
+        if beg >> shift == end >> shift:
+            return first + (beg >> shift)
+        level -= 1
+        shift += 3
+
+    return 0
+
+
+def bin_first(level):
+    '''number of the first bin of a level'''
+    return ((1 << (3 * level)) - 1) // 7
+
+
+def bin_start(bin_number, min_shift=MIN_SHIFT, depth=TBI_DEPTH):
+    '''first position covered by a bin'''
+    level = 0
+    while level < depth and bin_first(level + 1) <= bin_number:
+        level += 1
+    return (bin_number - bin_first(level)) << (min_shift + 3 * (depth - level))
+
+
+def depth_for(length, min_shift=MIN_SHIFT):
+    '''binning depth needed for positions up to length, at least the .tbi depth'''
+    depth = TBI_DEPTH
+    while length > (1 << (min_shift + 3 * depth)):
+        depth += 1
+    return depth
+
+
+def record_span(line):
+    '''(CHROM, 0-based begin, end) of a VCF line, the end is taken from INFO END= when present like tabix does'''
+    fields = line.split('\t', 8)
+    beg = int(fields[1]) - 1
+    end = beg + len(fields[3])
+    if len(fields) > 7 and 'END=' in fields[7]:
+        for entry in fields[7].split(';'):
+            if entry.startswith('END='):
+                try:
+                    end = max(end, int(entry[4:]))
+                except ValueError:
+                    pass
+                break
+
+    return fields[0], beg, max(end, beg + 1)
+
+
+def merge_chunks(chunks):
+    '''merges consecutive chunks that meet within the same compressed block, as htslib does'''
+    merged = [list(chunks[0])]
+    for start, end in chunks[1:]:
+        if start >> 16 <= merged[-1][1] >> 16:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+
+    return merged
+
+
+class ContigIndex():
+    __slots__ = ('bins', 'linear', 'first', 'last', 'records')
+
+    def __init__(self):
+        self.bins = dict() # bin: [[start address, end address]]
+        self.linear = dict() # window: start address of the first record overlapping it
+        self.first = None
+        self.last = None
+        self.records = 0
+
+
+class VcfIndexer():
+    def __init__(self, max_length=0):
+        self.depth = depth_for(max_length)
+        self.csi = self.depth > TBI_DEPTH
+        self.contigs = dict()
+        self.overflow = False # a record beyond the positions the depth can hold, the index cannot be built on the fly
+
+    def header(self, line):
+        '''picks the binning depth from the ##contig lengths, before any record is added'''
+        match = re.match(r'##contig=<.*length=(\d+)', line)
+        if match and not self.contigs:
+            self.depth = max(self.depth, depth_for(int(match.group(1))))
+            self.csi = self.depth > TBI_DEPTH
+
+    def add(self, line, start, end):
+        '''adds a record written between addresses start and end'''
+        contig, beg, stop = record_span(line)
+        if stop > (1 << (MIN_SHIFT + 3 * self.depth)):
+            self.overflow = True
+            return
+        index = self.contigs.get(contig)
+        if index is None:
+            index = self.contigs[contig] = ContigIndex()
+        chunks = index.bins.setdefault(reg2bin(beg, stop, MIN_SHIFT, self.depth), [])
+        if chunks and chunks[-1][1] == start:
+            chunks[-1][1] = end
+        else:
+            chunks.append([start, end])
+        for window in range(beg >> MIN_SHIFT, ((stop - 1) >> MIN_SHIFT) + 1):
+            if window not in index.linear:
+                index.linear[window] = start
+        if index.first is None:
+            index.first = start
+        index.last = end
+        index.records += 1
+
+    def suffix(self):
+        return '.csi' if self.csi else '.tbi'
+
+    def serialize(self, virtual_offset):
+        '''uncompressed .tbi or .csi index with addresses resolved to virtual offsets by virtual_offset'''
+        names = b''.join(contig.encode() + b'\0' for contig in self.contigs)
+        header = struct.pack('<7i', *VCF_FORMAT, len(names)) + names
+        if self.csi:
+            data = [b'CSI\1', struct.pack('<3i', MIN_SHIFT, self.depth, len(header)), header, struct.pack('<i', len(self.contigs))]
+        else:
+            data = [b'TBI\1', struct.pack('<i', len(self.contigs)), header]
+        meta_bin = bin_first(self.depth + 1) + 1
+        for index in self.contigs.values():
+            linear = self.linear_offsets(index, virtual_offset)
+            data.append(struct.pack('<i', len(index.bins) + 1))
+            for bin_number in sorted(index.bins):
+                chunks = index.bins[bin_number]
+                data.append(struct.pack('<I', bin_number))
+                if self.csi:
+                    window = bin_start(bin_number, MIN_SHIFT, self.depth) >> MIN_SHIFT
+                    data.append(struct.pack('<Q', linear[min(window, len(linear) - 1)]))
+                chunks = merge_chunks([(virtual_offset(start), virtual_offset(end)) for start, end in chunks])
+                data.append(struct.pack('<i', len(chunks)))
+                for start, end in chunks:
+                    data.append(struct.pack('<QQ', start, end))
+            # pseudo bin with the span of the contig and its number of records
+            data.append(struct.pack('<I', meta_bin))
+            if self.csi:
+                data.append(struct.pack('<Q', 0))
+            data.append(struct.pack('<iQQQQ', 2, virtual_offset(index.first), virtual_offset(index.last), index.records, 0))
+            if not self.csi:
+                data.append(struct.pack('<i', len(linear)))
+                data.append(struct.pack(f'<{len(linear)}Q', *linear))
+
+        return b''.join(data)
+
+    @staticmethod
+    def linear_offsets(index, virtual_offset):
+        '''offset of the first record of every window, empty windows take the offset of the previous one'''
+        linear = [0] * (max(index.linear) + 1)
+        previous = virtual_offset(index.first)
+        for window in range(len(linear)):
+            if window in index.linear:
+                previous = virtual_offset(index.linear[window])
+            linear[window] = previous
+
+        return linear